@@ -29,6 +29,7 @@ from zim.config import data_dir
 
 config = {
 	'notebook': data_dir('manual'),
+	#~ 'snapshot': '/path/to/snapshot.db', # see "zim --snapshot"
 	#~ 'template': 'Default.html',
 }
 
@@ -36,7 +37,13 @@ import logging
 
 logging.basicConfig(level=logging.INFO)
 
+from zim.fs import File
+from zim.notebook import build_notebook
 from zim.www import WWWInterface
 from wsgiref.handlers import CGIHandler
 
-CGIHandler().run(WWWInterface(**config))
+snapshot = config.pop('snapshot', None)
+notebook, page = build_notebook(config.pop('notebook'), File(snapshot) if snapshot else None)
+	# with a snapshot the index is not opened nor checked
+
+CGIHandler().run(WWWInterface(notebook, **config))
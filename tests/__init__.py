@@ -8,6 +8,7 @@ from __future__ import with_statement
 
 
 import os
+import re
 import sys
 import tempfile
 import shutil
@@ -609,6 +610,22 @@ def new_page_from_text(text, format='wiki'):
 
 
 
+_fulltext_re = re.compile(r'(CREATE TABLE|INSERT INTO) [\'"]?fulltext')
+
+def dump_index(db):
+	'''Like C{db.iterdump()} for an index database, but also
+	supports the full text table, which is a virtual table.
+	@returns: a SQL script to re-create the database
+	'''
+	lines = [l for l in db.iterdump() if not _fulltext_re.match(l)]
+	if db.execute('SELECT 1 FROM sqlite_master WHERE name = ?', ('fulltext',)).fetchone():
+		lines.extend(r[0] for r in db.execute(
+			"SELECT 'INSERT INTO fulltext(rowid, text) VALUES(' "
+			"|| rowid || ', ' || quote(text) || ');' FROM fulltext"
+		))
+	return '\n'.join(lines)
+
+
 _notebook_data = None
 
 def new_notebook(fakedir=None):
@@ -647,8 +664,7 @@ def new_notebook(fakedir=None):
 
 		index = Index(':memory:', layout)
 		index.check_and_update()
-		lines = list(index._db.iterdump())
-		sql = '\n'.join(lines)
+		sql = dump_index(index._db)
 
 		_notebook_data = (templfolder, sql, manifest)
 
@@ -667,10 +683,11 @@ def new_notebook(fakedir=None):
 	index = Index(':memory:', layout)
 	tables = [r[0] for r in index._db.execute(
 		'SELECT name FROM sqlite_master '
-		'WHERE type="table" and name NOT LIKE "sqlite%"'
+		'WHERE type="table" and name NOT LIKE "sqlite%" '
+		'ORDER BY sql LIKE "CREATE VIRTUAL%" DESC'
 	)]
 	for table in tables:
-		index._db.execute('DROP TABLE %s' % table)
+		index._db.execute('DROP TABLE IF EXISTS %s' % table)
 	index._db.executescript(sql)
 	index._db.commit()
 
@@ -12,13 +12,15 @@ import os
 import sys
 import sqlite3
 import time
+import threading
 
 from zim.notebook.layout import FilesLayout
 from zim.newfs import LocalFolder, File
 from zim.newfs.mock import os_native_path
 
 from zim.notebook import Path
-from zim.notebook.index.files import FilesIndexer, TestFilesDBTable, FilesIndexChecker
+from zim.notebook.index.files import FilesIndexer, TestFilesDBTable, FilesIndexChecker, \
+	TYPE_FILE
 from zim.notebook.index.pages import PagesIndexer, TestPagesDBTable
 from zim.notebook.index.links import LinksIndexer
 from zim.notebook.index.tags import TagsIndexer
@@ -72,13 +74,18 @@ class TestFilesIndexer(tests.TestCase, TestFilesDBTable):
 		db = sqlite3.connect(':memory:')
 		db.row_factory = sqlite3.Row
 
-		indexer = FilesIndexer(db, self.root)
+		indexer = FilesIndexer(db, self.root, digest_extension='.txt')
 
 		def cb_filter_func(name, o, a):
 			#~ print '>>', name
 			if name in ('start-update', 'finish-update'):
 				self.assertFalse(a)
 				return ()
+			elif name == 'file-rows-pending':
+				rows, = a
+				for row in rows:
+					self.assertIsInstance(row, sqlite3.Row)
+				return [row['path'] for row in rows]
 			else:
 				row, = a
 				self.assertIsInstance(row, sqlite3.Row)
@@ -109,11 +116,16 @@ class TestFilesIndexer(tests.TestCase, TestFilesDBTable):
 		self.assertFilesDBConsistent(db)
 		self.assertFilesDBEquals(db, self.FILES)
 
+		for row in db.execute('SELECT * FROM files WHERE node_type = ?', (TYPE_FILE,)):
+			if row['path'].endswith('.txt'):
+				self.assertIsNotNone(row['digest'])
+			else:
+				self.assertIsNone(row['digest']) # attachments are not read
+
 		# 2. Check and update after new files appear
 		signals.clear()
-		self.create_files(
-			self.FILES_UPDATE + self.FILES_CHANGE
-		)
+		self.create_files(self.FILES_UPDATE)
+		self.change_files(self.FILES_CHANGE)
 		check_and_update_all()
 
 		files = set(f for f in self.FILES_UPDATE if not is_dir(f))
@@ -128,6 +140,18 @@ class TestFilesIndexer(tests.TestCase, TestFilesDBTable):
 			self.FILES + self.FILES_UPDATE
 		)
 
+		# 2b. Check and update after only mtime changed
+		signals.clear()
+		for name in self.FILES_CHANGE:
+			file = self.root.file(name)
+			file._set_mtime(file.mtime() + 10)
+		check_and_update_all()
+
+		self.assertEqual(signals['file-row-inserted'], [])
+		self.assertEqual(signals['file-row-changed'], [])
+		self.assertEqual(signals['file-row-deleted'], [])
+		self.assertEqual(signals['file-rows-pending'], [])
+
 		# 3. Check and update after files disappear
 		signals.clear()
 		self.remove_files(self.FILES_UPDATE)
@@ -150,6 +174,10 @@ class TestFilesIndexer(tests.TestCase, TestFilesDBTable):
 			else:
 				self.root.file(name).write(self.PAGE_TEXT)
 
+	def change_files(self, files):
+		for name in files:
+			self.root.file(name).write(self.PAGE_TEXT + 'changed\n')
+
 	def remove_files(self, files):
 		for name in reversed(files):
 			if is_dir(name):
@@ -158,6 +186,53 @@ class TestFilesIndexer(tests.TestCase, TestFilesDBTable):
 				self.root.child(name).remove()
 
 
+class TestFilesIndexerBatches(TestFilesIndexer):
+
+	# Same test, but force many small batches in update_iter() to
+	# check that folders are still indexed before files
+
+	def setUp(self):
+		self._batch_size = FilesIndexer.BATCH_SIZE
+		FilesIndexer.BATCH_SIZE = 2
+
+	def tearDown(self):
+		FilesIndexer.BATCH_SIZE = self._batch_size
+
+
+class TestQueueCheckAll(tests.TestCase):
+
+	def runTest(self):
+		# A file edited in place does not change the mtime of the
+		# folder, so it is only found when files are checked as well
+		root = self.setUpFolder(mock=tests.MOCK_DEFAULT_REAL)
+		db = sqlite3.connect(':memory:')
+		db.row_factory = sqlite3.Row
+		indexer = FilesIndexer(db, root)
+		checker = FilesIndexChecker(db, root)
+
+		# Use integer mtimes, setting a float mtime loses precision
+		file = root.file('foo/bar.txt')
+		file.write('test 123\n')
+		folder = root.folder('foo')
+		mtime = int(folder.mtime())
+		folder._set_mtime(mtime)
+		checker.queue_check()
+		for out_of_date in checker.check_iter():
+			if out_of_date:
+				for i in indexer.update_iter():
+					pass
+
+		file.write('test 123\nchanged\n')
+		file._set_mtime(int(file.mtime()) + 10)
+		folder._set_mtime(mtime)
+
+		checker.queue_check_folders()
+		self.assertFalse(any(checker.check_iter()))
+
+		checker.queue_check_all()
+		self.assertTrue(any(checker.check_iter()))
+
+
 class TestPagesIndexer(TestPagesDBTable, tests.TestCase):
 
 	FILES = tuple(map(os_native_path, (
@@ -332,7 +407,8 @@ class TestLinksIndexer(tests.TestCase):
 		indexer = LinksIndexer(db, pageindexer, tests.MockObject())
 
 		for i, name, cont in self.PAGES:
-			row = {'id': i, 'name': name, 'sortkey': natural_sort_key(name)}
+			row = {'id': i, 'name': name, 'sortkey': natural_sort_key(name),
+				'is_link_placeholder': False}
 			indexer.on_page_row_inserted(pageindexer, row)
 
 		###
@@ -350,8 +426,28 @@ class TestLinksIndexer(tests.TestCase):
 		)
 		self.assertEqual(links, [(3,2), (3,4)])
 
-		###
+		### Only changed links are updated
+		rowids = dict(
+			(r['names'], r['rowid'])
+				for r in db.execute('SELECT rowid, * FROM links')
+		)
+		tree = WikiParser().parse('[[Bar]]\n[[Foo]]\n')
+		indexer.on_page_changed(pageindexer, {'id': 3, 'name': 'Foo'}, tree)
+		links = dict(
+			(r['names'], (r['rowid'], r['target']))
+				for r in db.execute('SELECT rowid, * FROM links')
+		)
+		self.assertEqual(sorted(links.keys()), ['Bar', 'Foo'])
+		self.assertEqual(links['Bar'], (rowids['Bar'], 2)) # untouched
+		self.assertEqual(links['Foo'][1], 3)
+
+		### Placeholder that lost its link is removed
 		pageindexer.setObjectAccess('remove_page')
+		indexer.on_finish_update(None)
+		rows = db.execute('SELECT name FROM pages WHERE id > 1').fetchall()
+		self.assertEqual(sorted(r['name'] for r in rows), ['Bar', 'Foo'])
+
+		###
 		for i, name, cont in self.PAGES:
 			row = {'id': i, 'name': name}
 			indexer.on_page_row_deleted(pageindexer, row)
@@ -404,6 +500,41 @@ class TestTagsIndexer(tests.TestCase):
 		self.assertEqual(tagsources, wantedsources)
 
 
+class TestTagsIndexerCleanup(TestTagsIndexer):
+
+	def runTest(self):
+		db = sqlite3.connect(':memory:')
+		db.row_factory = sqlite3.Row
+
+		indexer = TagsIndexer(db, tests.MockObject(), tests.MockObject())
+		for i, name, text in self.PAGES:
+			tree = WikiParser().parse(text)
+			row = {'id': i, 'name': name}
+			indexer.on_page_changed(None, row, tree)
+		indexer.on_finish_update(None)
+
+		# Only tags that lost a source are candidates for removal
+		self.assertEqual(indexer._orphans, set())
+		tree = WikiParser().parse('@tag2 @tag4')
+		indexer.on_page_changed(None, {'id': 2, 'name': 'foo'}, tree)
+		self.assertEqual(indexer._orphans, set([1]))
+		indexer.on_finish_update(None)
+
+		self.assertTags(db,
+			[('tag2', 2), ('tag3', 3), ('tag4', 4)],
+			[(2, 2), (2, 3), (3, 3), (4, 2)]
+		)
+
+		indexer.on_page_row_deleted(None, {'id': 3, 'name': 'bar'})
+		self.assertEqual(indexer._orphans, set([2, 3]))
+		indexer.on_finish_update(None)
+
+		self.assertTags(db,
+			[('tag2', 2), ('tag4', 4)],
+			[(2, 2), (4, 2)]
+		)
+
+
 from zim.notebook.index import IndexUpdateIter
 
 
@@ -445,3 +576,416 @@ class TestFullIndexer(TestFilesIndexer):
 		# 3. Check and update after files disappear
 		self.remove_files(self.FILES_UPDATE)
 		update_iter.check_and_update()
+
+
+from zim.notebook.index import ParserPool
+
+
+class TestParserPool(tests.TestCase):
+
+	def runTest(self):
+		folder = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		layout = FilesLayout(folder)
+		file = folder.file('foo.txt')
+		file.write('test 123\n[[bar]]\n@tagfoo\n')
+		format = layout.get_format(file)
+		wanted = format.Parser().parse(file.read()).tostring()
+
+		pool = ParserPool(2)
+		try:
+			pool.queue(file, format)
+			tree = pool.get_parsetree(file, file.mtime())
+			self.assertIsNotNone(tree)
+			self.assertEqual(tree.tostring(), wanted)
+
+			# Result is dropped when file changed after parsing
+			pool.queue(file, format)
+			self.assertIsNone(pool.get_parsetree(file, file.mtime() + 1))
+
+			# Files not queued are not known
+			self.assertIsNone(pool.get_parsetree(file, file.mtime()))
+		finally:
+			pool.close()
+
+
+class TestFullIndexerParallel(TestFullIndexer):
+
+	def runTest(self):
+		self.root = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		self.create_files(self.FILES)
+
+		wanted = buildUpdateIter(self.root)
+		wanted.update()
+
+		update_iter = buildUpdateIter(self.root)
+		update_iter.start_parser_pool(2)
+		try:
+			update_iter.update()
+		finally:
+			update_iter.stop_parser_pool()
+
+		for table in ('pages', 'links', 'tags', 'tagsources'):
+			self.assertEqual(
+				[tuple(r) for r in update_iter.db.execute('SELECT * FROM %s ORDER BY 1, 2' % table)],
+				[tuple(r) for r in wanted.db.execute('SELECT * FROM %s ORDER BY 1, 2' % table)],
+			)
+
+
+class TestIndexStats(TestFullIndexer):
+
+	def runTest(self):
+		self.root = self.setUpFolder()
+		self.create_files(self.FILES)
+		n_pages = len([f for f in self.FILES if f.endswith('.txt')])
+
+		update_iter = buildUpdateIter(self.root)
+		stats = update_iter.enable_stats()
+		update_iter.check_and_update()
+		stats.stop()
+
+		data = stats.as_dict()
+		self.assertEqual(data['pages'], n_pages)
+		self.assertGreater(data['pages_per_second'], 0)
+		timers = data['timers']
+		for name in (
+			'files.check', 'files.update_node', 'pages.parse', 'commit',
+			'page-changed/LinksIndexer.on_page_changed',
+			'page-changed/TagsIndexer.on_page_changed',
+			'finish-update/LinksIndexer.on_finish_update',
+		):
+			self.assertIn(name, timers)
+		self.assertEqual(timers['pages.parse']['calls'], n_pages)
+		self.assertEqual(
+			timers['page-changed/LinksIndexer.on_page_changed']['calls'], n_pages)
+
+		# Nested timers are not counted twice
+		total = sum(t['seconds'] for t in timers.values())
+		self.assertTrue(total <= data['seconds'])
+		self.assertIn('pages/sec', stats.format())
+
+
+from zim.notebook.index import Index, ReaderConnections
+from zim.notebook.index.pages import PagesView
+
+
+class TestReaderConnections(tests.TestCase):
+
+	def runTest(self):
+		folder = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		folder.file('foo.txt').write('test 123\n')
+		dbpath = os.path.join(self.create_tmp_dir('db'), 'index.db')
+		index = Index(dbpath, FilesLayout(folder))
+		try:
+			self.assertEqual(
+				index._db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+			self.assertIsInstance(index._db_reader, ReaderConnections)
+
+			pages = PagesView.new_from_index(index)
+			self.assertEqual(pages.n_all_pages(), 0)
+			index.check_and_update()
+			self.assertEqual(pages.n_all_pages(), 1)
+
+			# Readers only see committed data
+			with index.lock:
+				index._db.execute('DELETE FROM pages WHERE id > 1')
+				self.assertEqual(pages.n_all_pages(), 1)
+				index._db.commit()
+			self.assertEqual(pages.n_all_pages(), 0)
+
+			# Readers can not write
+			self.assertRaises(sqlite3.OperationalError,
+				index._db_reader.execute, 'DELETE FROM pages')
+
+			# Threads can close their connection explicitly
+			readers = index._db_reader
+			self.assertEqual(len(readers._connections), 1)
+			counts = []
+			def thread_main():
+				pages.n_all_pages()
+				counts.append(len(readers._connections))
+				readers.close_thread()
+				counts.append(len(readers._connections))
+			thread = threading.Thread(target=thread_main)
+			thread.start()
+			thread.join()
+			self.assertEqual(counts, [2, 1])
+
+			# Connections of finished threads are closed when the
+			# next connection is opened
+			thread = threading.Thread(target=pages.n_all_pages)
+			thread.start()
+			thread.join()
+			self.assertEqual(len(readers._connections), 2)
+			db = readers._connections[thread]
+			thread = threading.Thread(target=pages.n_all_pages)
+			thread.start()
+			thread.join()
+			self.assertEqual(len(readers._connections), 2)
+			self.assertIn(thread, readers._connections)
+			self.assertRaises(sqlite3.ProgrammingError, db.execute, 'SELECT 1')
+
+			# Connection is re-opened after close_thread()
+			readers.close_thread()
+			self.assertEqual(pages.n_all_pages(), 0)
+			self.assertIn(threading.current_thread(), readers._connections)
+		finally:
+			index.close()
+
+
+class TestIndexWatcher(tests.TestCase):
+
+	def runTest(self):
+		from zim.newfs import inotify
+		from zim.notebook.index.files import \
+			STATUS_UPTODATE, STATUS_CHECK, TYPE_FOLDER
+		if not inotify.supported():
+			self.skipTest('inotify not supported')
+
+		folder = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		folder.file('foo.txt').write('test 123\n')
+		folder.file('bar/baz.txt').write('test 123\n')
+		dbpath = os.path.join(self.create_tmp_dir('db'), 'index.db')
+		index = Index(dbpath, FilesLayout(folder))
+		try:
+			index.check_and_update()
+			started = []
+			index.background_check.start = lambda: started.append(True)
+			watcher = index.watcher
+
+			def reset():
+				with index.lock:
+					index._db.execute(
+						'UPDATE files SET index_status = ?', (STATUS_UPTODATE,))
+					index._db.commit()
+
+			def flagged(node_type=None):
+				with index.lock:
+					if node_type is None:
+						return index._db.execute(
+							'SELECT COUNT(*) FROM files WHERE index_status = ?',
+							(STATUS_CHECK,)
+						).fetchone()[0]
+					else:
+						return index._db.execute(
+							'SELECT COUNT(*) FROM files '
+							'WHERE index_status = ? and node_type = ?',
+							(STATUS_CHECK, node_type)
+						).fetchone()[0]
+
+			n_files = index._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+			n_folders = index._db.execute(
+				'SELECT COUNT(*) FROM files WHERE node_type = ?', (TYPE_FOLDER,)
+			).fetchone()[0]
+
+			# First start checks all files
+			reset()
+			index.start_background_check(None)
+			thread = watcher._thread
+			self.assertTrue(watcher.is_running())
+			self.assertEqual(flagged(), n_files)
+
+			# Restart of a running watcher only checks folders
+			reset()
+			index.start_background_check(None)
+			self.assertIs(watcher._thread, thread)
+			self.assertEqual(flagged(), n_folders)
+			self.assertEqual(flagged(TYPE_FOLDER), n_folders)
+
+			# Stop waits for the thread, a restart checks all files
+			index.stop_background_check()
+			self.assertFalse(thread.is_alive())
+			self.assertFalse(watcher.is_running())
+			reset()
+			index.start_background_check(None)
+			self.assertIsNot(watcher._thread, thread)
+			self.assertTrue(watcher.is_running())
+			self.assertEqual(flagged(), n_files)
+
+			# Changes are flagged by the watcher thread
+			reset()
+			started[:] = []
+			folder.file('bar/new.txt').write('test 123\n')
+			for i in range(50):
+				if flagged():
+					break
+				time.sleep(0.1)
+			self.assertEqual(flagged(TYPE_FOLDER), 1) # parent of new file
+			self.assertTrue(started)
+		finally:
+			index.close()
+		self.assertFalse(watcher._thread.is_alive())
+
+
+class TestPluginDB(tests.TestCase):
+
+	def runTest(self):
+		folder = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		folder.file('foo.txt').write('test 123\n')
+		dbpath = os.path.join(self.create_tmp_dir('db'), 'index.db')
+		index = Index(dbpath, FilesLayout(folder))
+		try:
+			index.check_and_update()
+			pages = PagesView.new_from_index(index)
+			self.assertEqual(pages.n_all_pages(), 1) # open reader connection
+
+			schema = index.attach_plugin_db('test', '0.1')
+			self.assertEqual(schema, 'plugin_test')
+			plugindb = os.path.join(os.path.dirname(dbpath), 'index-test.db')
+			self.assertTrue(os.path.isfile(plugindb))
+			self.assertFalse(index.is_uptodate) # flagged for re-index
+
+			with index.lock:
+				index._db.execute('CREATE TABLE plugin_test.foo (source INTEGER)')
+				index._db.execute('INSERT INTO foo SELECT id FROM pages')
+				index._db.commit()
+			self.assertEqual(
+				index._db_reader.execute('SELECT COUNT(*) FROM foo').fetchone()[0], 2)
+
+			# Same format, data is kept
+			index.attach_plugin_db('test', '0.1')
+			self.assertEqual(
+				index._db.execute('SELECT COUNT(*) FROM foo').fetchone()[0], 2)
+
+			# Flush of the main index only clears the data
+			index.flush()
+			self.assertEqual(
+				index._db.execute('SELECT COUNT(*) FROM foo').fetchone()[0], 0)
+			index.vacuum_plugin_db('test')
+
+			# New format, tables are dropped
+			index.attach_plugin_db('test', '0.2')
+			self.assertRaises(sqlite3.OperationalError,
+				index._db.execute, 'SELECT * FROM foo')
+
+			index.drop_plugin_db('test')
+			self.assertFalse(os.path.isfile(plugindb))
+		finally:
+			index.close()
+
+
+class TestResumableUpdate(TestFullIndexer):
+
+	def runTest(self):
+		self.root = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		self.create_files(self.FILES)
+
+		wanted = buildUpdateIter(self.root)
+		wanted.update()
+
+		def new_update_iter(dbpath):
+			db = sqlite3.connect(dbpath)
+			db.row_factory = sqlite3.Row
+			update_iter = IndexUpdateIter(db, FilesLayout(self.root))
+			update_iter.COMMIT_INTERVAL = 2
+			return update_iter
+
+		# Interrupt the update half way
+		dbpath = os.path.join(self.create_tmp_dir('db'), 'index.db')
+		update_iter = new_update_iter(dbpath)
+		commits = []
+		update_iter.connect('commit', lambda o: commits.append(1))
+		iter = update_iter.__iter__()
+		for i in range(5):
+			iter.next()
+		iter.close()
+		self.assertEqual(len(commits), 2)
+		update_iter.db.close() # drops uncommitted changes
+
+		# Resume in a new "process"
+		update_iter = new_update_iter(dbpath)
+		self.assertEqual(update_iter._get_progress(), '4')
+		update_iter.update()
+		self.assertIsNone(update_iter._get_progress())
+
+		for table in ('pages', 'links', 'tags', 'tagsources'):
+			self.assertEqual(
+				[tuple(r) for r in update_iter.db.execute('SELECT * FROM %s ORDER BY 1, 2' % table)],
+				[tuple(r) for r in wanted.db.execute('SELECT * FROM %s ORDER BY 1, 2' % table)],
+			)
+
+
+class TestFlagReindex(TestFullIndexer):
+
+	def runTest(self):
+		self.root = self.setUpFolder(mock=tests.MOCK_ALWAYS_REAL)
+		self.create_files(self.FILES)
+		index = Index(':memory:', FilesLayout(self.root))
+		index.check_and_update()
+
+		def dump(table):
+			return [tuple(r) for r in index._db.execute(
+				'SELECT * FROM %s ORDER BY 1, 2' % table)]
+
+		wanted = dict((t, dump(t)) for t in ('pages', 'links', 'tags'))
+		n_sources, = index._db.execute(
+			'SELECT COUNT(*) FROM pages JOIN files ON pages.source_file = files.id '
+			'WHERE files.node_type = ?', (TYPE_FILE,)
+		).fetchone()
+		self.assertTrue(n_sources > 0)
+
+		changed = []
+		update_iter = index.update_iter
+		update_iter.pages.connect('page-changed', lambda *a: changed.append(a[1]['name']))
+		inserted = []
+		update_iter.files.connect('file-row-inserted', lambda *a: inserted.append(a))
+
+		index.flag_reindex()
+		self.assertIs(index.update_iter, update_iter) # no flush
+		self.assertFalse(index.is_uptodate)
+		update_iter.update()
+		self.assertTrue(index.is_uptodate)
+
+		self.assertEqual(len(changed), n_sources)
+		self.assertEqual(inserted, [])
+		for table in ('pages', 'links', 'tags'):
+			self.assertEqual(dump(table), wanted[table])
+
+
+from zim.notebook.index.pages import CachedPagesViewInternal
+
+
+class TestCachedPagesViewInternal(tests.TestCase):
+
+	FILES = (
+		'Foo.txt', 'Foo/Bar.txt', 'Foo/Bar/Baz.txt', 'Foo/bar/Dus.txt',
+		'Dus.txt', 'Dus/Foo.txt', 'Dus/Foo/Bar.txt', 'Page_1.txt',
+	)
+	FILES_UPDATE = ('Dus/Bar.txt', 'Foo/Dus/Foo.txt')
+	PAGE_TEXT = '[[Bar]]\n[[foo:Dus]]\n[[Baz]]\n[[+Bar]]\n'
+
+	LINKS = ('Foo', 'foo', 'Bar', 'Bar:Baz', 'Dus:Foo', 'Page 1', 'page_1',
+		':Foo:Bar', '+Bar', '+Foo:bar', 'Baz', 'Bar:NonExisting')
+
+	def runTest(self):
+		folder = self.setUpFolder()
+		for path in self.FILES:
+			folder.file(path).write(self.PAGE_TEXT)
+		update_iter = buildUpdateIter(folder)
+		update_iter.update()
+
+		pages = PagesViewInternal(update_iter.db)
+		cached = CachedPagesViewInternal(update_iter.db, update_iter.pages)
+		self.assertResolveEqual(pages, cached)
+
+		# Cache is updated by signals
+		for path in self.FILES_UPDATE:
+			folder.file(path).write(self.PAGE_TEXT)
+		update_iter.check_and_update()
+		self.assertResolveEqual(pages, cached)
+
+		for path in self.FILES_UPDATE:
+			folder.file(path).remove()
+		update_iter.check_and_update()
+		self.assertResolveEqual(pages, cached)
+
+	def assertResolveEqual(self, pages, cached):
+		sources = [Path(r[0]) for r in pages.db.execute('SELECT name FROM pages WHERE id>1')]
+		self.assertGreater(len(sources), len(self.FILES))
+		for source in sources:
+			for link in self.LINKS:
+				href = HRef.new_from_wiki_link(link)
+				self.assertEqual(
+					cached.resolve_link(source, href),
+					pages.resolve_link(source, href),
+					'Resolving "%s" from %s' % (link, source)
+				)
@@ -80,8 +80,7 @@ def new_test_database():
 		for path, text in FILES:
 			folder.file(path).write(text)
 		indexer.check_and_update()
-		lines = list(indexer.db.iterdump())
-		_SQL = '\n'.join(lines)
+		_SQL = tests.dump_index(indexer.db)
 		indexer.db.close()
 
 	db = sqlite3.Connection(':memory:')
@@ -244,6 +243,61 @@ class TestPagesView(tests.TestCase):
 		self.assertIsNone(p)
 		self.assertRaises(IndexNotFoundError, model.find, Path('non-existing-page'))
 
+	def testTreeModelCacheOnInsert(self):
+		db = new_test_database()
+		mockindex = tests.MockObject()
+		mockindex._db = db
+		mockindex.update_iter = tests.MockObject()
+		mockindex.update_iter.pages = tests.MockObject()
+
+		class MockTreeModel(PagesTreeModelMixin):
+
+			def get_iter(self, treepath):
+				return self.get_mytreeiter(treepath)
+
+			def emit(self, signal, treepath, *args):
+				signals.append((signal, treepath))
+
+			def flush_cache(self):
+				self.cache.clear()
+
+		signals = []
+		model = MockTreeModel(mockindex)
+		for name, treepath in TREEPATHS:
+			model.get_mytreeiter(treepath)
+
+		# Insert between "Foo:Child1" and "Foo:Child2"
+		indexer = PagesIndexer(db, None, tests.MockObject())
+		indexer.insert_page(Path('Foo:Child1a'), None)
+		for name in ('Foo', 'Foo:Child1a'):
+			row = db.execute('SELECT * FROM pages WHERE name=?', (name,)).fetchone()
+			if name == 'Foo':
+				model.on_page_row_changed(indexer, row)
+			else:
+				model.on_page_row_inserted(indexer, row)
+
+		self.assertIn(('row-inserted', (1, 1)), signals)
+		self.assertEqual(model.cache[(1,)].n_children, 4)
+
+		# All records are still cached, but shifted
+		model.cache_hits = model.cache_misses = 0
+		wanted = [
+			('Bar', (0,)),
+			('Foo', (1,)),
+			('Foo:Child1', (1,0)),
+			('Foo:Child1:GrandChild1', (1,0,0)),
+			('Foo:Child1:GrandChild2', (1,0,1)),
+			('Foo:Child1a', (1,1)),
+			('Foo:Child2', (1,2)),
+			('Foo:Child3', (1,3)),
+		]
+		for name, treepath in wanted:
+			myiter = model.get_mytreeiter(treepath)
+			self.assertEqual(myiter.row['name'], name)
+			self.assertEqual(myiter.treepath, treepath)
+		self.assertEqual(model.cache_misses, 0)
+		self.assertEqual(model.cache_hits, len(wanted))
+
 
 from zim.notebook.index.tags import TagsIndexer, TagsView, IndexTag, \
 		TaggedPagesTreeModelMixin, TagsTreeModelMixin
@@ -409,3 +463,213 @@ class TestLinksView(tests.TestCase):
 		uclinks = [(l.source, l.target) for l in linksview.list_floating_links('FOO')]
 		self.assertGreater(len(lclinks), 0)
 		self.assertEqual(lclinks, uclinks)
+
+
+import re
+
+from zim.notebook.index.content import ContentView
+
+
+class TestContentView(tests.TestCase):
+
+	def runTest(self):
+		db = new_test_database()
+		content = ContentView(db)
+		if not content.is_available():
+			self.skipTest('SQLite full text search not available')
+
+		names = lambda it: sorted(p.name for p in it)
+		self.assertEqual(names(content.list_pages('lorem')), sorted(n for n, t in TREEPATHS if n != 'Foo:Child3'))
+			# placeholder has no content
+		self.assertEqual(names(content.list_pages('LOREM Ipsum')), names(content.list_pages('lorem')))
+		self.assertEqual(names(content.list_pages('tag2')), sorted(TAGS['tag2']))
+		self.assertEqual(names(content.list_pages('tag', prefix=True)), sorted(TAGS['tag2']))
+		self.assertEqual(names(content.list_pages('tag')), [])
+		self.assertEqual(names(content.list_pages('child3')), ['Foo:Child2'])
+		self.assertRaises(ValueError, list, content.list_pages('*!'))
+
+		ranked = list(content.list_ranked(['tag2', 'child3']))
+		self.assertEqual(names(p for p, r, s in ranked), sorted(TAGS['tag2']))
+		for path, relevance, snippet in ranked:
+			self.assertTrue(relevance > 0)
+			self.assertIn('[tag2]', snippet)
+		relevance = dict((p.name, r) for p, r, s in ranked)
+		self.assertTrue(relevance['Foo:Child2'] > relevance['Bar'])
+			# Child2 also matches "child3"
+		ranked = list(content.list_ranked(['tag*'], markers=('<', '>')))
+		self.assertEqual(names(p for p, r, s in ranked), sorted(TAGS['tag2']))
+		self.assertIn('<tag2>', ranked[0][2])
+		self.assertRaises(ValueError, list, content.list_ranked([]))
+
+
+from zim.notebook.index.trigrams import TrigramsView
+
+class TestTrigramsView(tests.TestCase):
+
+	def runTest(self):
+		db = new_test_database()
+		trigrams = TrigramsView(db)
+		self.assertTrue(trigrams.is_available())
+
+		names = lambda it: sorted(p.name for p in it)
+		self.assertEqual(sorted(trigrams.list_words('hil')),
+			['child1', 'child2', 'child3', 'grandchild1', 'grandchild2'])
+		self.assertEqual(names(trigrams.list_pages_by_name('HILD')),
+			sorted(n for n, t in TREEPATHS if n not in ('Bar', 'Foo')))
+		self.assertEqual(names(trigrams.list_pages_by_name('child1:grand')),
+			['Foo:Child1:GrandChild1', 'Foo:Child1:GrandChild2'])
+		self.assertEqual(names(trigrams.list_pages_by_name('xyz')), [])
+		self.assertRaises(ValueError, list, trigrams.list_pages_by_name('ab'))
+
+		if ContentView(db).is_available():
+			self.assertEqual(names(trigrams.list_pages_by_content('OREM')),
+				sorted(n for n, t in TREEPATHS if n != 'Foo:Child3'))
+			self.assertEqual(names(trigrams.list_pages_by_content('ag2')), sorted(TAGS['tag2']))
+			self.assertRaises(ValueError, list, trigrams.list_pages_by_content('*!'))
+
+
+class RecordingConnection(object):
+	# Wrapper for a database connection that records all queries
+
+	def __init__(self, db):
+		self.db = db
+		self.queries = set()
+
+	def execute(self, query, *args):
+		self.queries.add(query)
+		return self.db.execute(query, *args)
+
+
+class TestQueryPlans(tests.TestCase):
+	'''Check "EXPLAIN QUERY PLAN" for all queries used by the index
+	views and tree models. Queries that filter rows should be able to
+	use an index, a full table scan is only accepted for queries that
+	have no "WHERE" clause anyway.
+	'''
+
+	TABLES = ('files', 'pages', 'links', 'tags', 'tagsources')
+
+	def runTest(self):
+		db = RecordingConnection(new_test_database())
+		self.exercisePagesView(db)
+		self.exerciseLinksView(db)
+		self.exerciseTagsView(db)
+		self.exerciseTreeModels(db)
+		self.assertGreater(len(db.queries), 30)
+
+		errors = []
+		for query in sorted(db.queries):
+			for scan in self.get_full_scans(db.db, query):
+				errors.append('%s\n\t--> SCAN %s' % (' '.join(query.split()), scan))
+
+		self.assertFalse(errors, 'Queries without index:\n' + '\n'.join(errors))
+
+	def get_full_scans(self, db, query):
+		if not re.search(r'\bWHERE\b', query, re.I):
+			return []
+
+		n_params = query.count('?')
+		scans = []
+		for row in db.execute('EXPLAIN QUERY PLAN ' + query, (1,) * n_params):
+			detail = row[-1] # last column is "detail" for all sqlite versions
+			m = re.match(r'SCAN (?:TABLE )?(\w+)(.*)', detail)
+			if m and m.group(1) in self.TABLES and not 'USING' in m.group(2):
+				scans.append(m.group(1))
+		return scans
+
+	def exercisePagesView(self, db):
+		pages = PagesView(db)
+		pagelist = list(pages.walk())
+		pages.n_all_pages()
+		for path in pagelist:
+			pages.lookup_by_pagename(path)
+			pages.n_list_pages(path)
+			pages.get_previous(path)
+			pages.get_next(path)
+		pages.lookup_from_user_input('foo:child1')
+		pages.lookup_from_user_input('Child2', Path('Foo:Child1'))
+		pages.resolve_link(Path('Foo:Child1'), HRef.new_from_wiki_link('Child2'))
+		pages.resolve_link(Path('Foo:Child1'), HRef.new_from_wiki_link('+GrandChild1'))
+		pages.resolve_link(Path('Foo:Child1'), HRef.new_from_wiki_link(':Bar'))
+		pages.create_link(Path('Foo:Child1'), Path('Foo:Child2'))
+		list(pages.list_recent_changes(limit=3, offset=0))
+
+	def exerciseLinksView(self, db):
+		links = LinksView(db)
+		for name, x, y in LINKS:
+			path = Path(name)
+			for dir in (LINK_DIR_FORWARD, LINK_DIR_BACKWARD, LINK_DIR_BOTH):
+				list(links.list_links(path, dir))
+				links.n_list_links(path, dir)
+				list(links.list_links_section(path, dir))
+				links.n_list_links_section(path, dir)
+		list(links.list_floating_links('foo'))
+
+	def exerciseTagsView(self, db):
+		tags = TagsView(db)
+		list(tags.list_all_tags())
+		list(tags.list_all_tags_by_n_pages())
+		tags.n_list_all_tags()
+		for name in TAGS:
+			tag = tags.lookup_by_tagname(name)
+			list(tags.list_pages(name))
+			tags.n_list_pages(name)
+			list(tags.list_intersecting_tags([tag]))
+		list(tags.list_tags(Path('Bar')))
+		tags.n_list_tags(Path('Bar'))
+
+	def exerciseTreeModels(self, db):
+		mockindex = tests.MockObject()
+		mockindex._db = db
+		mockindex.update_iter = tests.MockObject()
+		mockindex.update_iter.pages = tests.MockObject()
+		mockindex.update_iter.tags = tests.MockObject()
+
+		for model in (
+			PagesTreeModelMixin(mockindex),
+			TaggedPagesTreeModelMixin(mockindex, tags=('tag1', 'tag2')),
+			TagsTreeModelMixin(mockindex, tags=('tag1', 'tag2')),
+		):
+			model.n_children_top()
+			for treepath in ((0,), (1,), (1, 0), (1, 0, 1), (5, 5)):
+				model.get_mytreeiter(treepath)
+				model.cache.clear()
+			for name, treepath in TREEPATHS:
+				try:
+					model.find_all(Path(name))
+				except IndexNotFoundError:
+					pass
+
+
+import itertools
+
+from zim.notebook.index.files import FilesIndexChecker
+
+
+class TestFilesIndexCheckerQueryPlans(TestQueryPlans):
+	'''Check the queries used to drain the check queue use an index
+	for both the lookup and the sorting. These run once per row in the
+	"files" table after startup.
+	'''
+
+	def runTest(self):
+		db = RecordingConnection(new_test_database())
+		checker = FilesIndexChecker(db, MockFolder('/mock/notebook/'))
+		checker.queue_check_all()
+		for i in itertools.islice(checker.check_iter(), 20):
+			pass # files do not exist, so all get flagged
+
+		errors = []
+		for query in sorted(db.queries):
+			if not query.startswith('SELECT'):
+				continue
+
+			for scan in self.get_full_scans(db.db, query):
+				errors.append('%s\n\t--> SCAN %s' % (' '.join(query.split()), scan))
+
+			n_params = query.count('?')
+			for row in db.db.execute('EXPLAIN QUERY PLAN ' + query, (1,) * n_params):
+				if 'TEMP B-TREE' in row[-1]:
+					errors.append('%s\n\t--> %s' % (' '.join(query.split()), row[-1]))
+
+		self.assertFalse(errors, 'Queries without index:\n' + '\n'.join(errors))
@@ -12,12 +12,14 @@ import tests
 from tests.config import EnvironmentConfigContext, ConfigManager
 
 import sys
+import json
 import cStringIO as StringIO
 import threading
 import time
 
 
 from zim.fs import Dir, File, FS
+from zim.notebook import Path
 from zim.environ import environ
 
 from zim.main import *
@@ -178,6 +180,78 @@ class TestServerGui(tests.TestCase):
 
 
 
+class TestSearchCommand(tests.TestCase):
+
+	def setUp(self):
+		from zim.notebook import init_notebook, Notebook
+		self.dir = self.create_tmp_dir()
+		init_notebook(Dir(self.dir))
+		notebook = Notebook.new_from_dir(Dir(self.dir))
+		for i in range(5):
+			page = notebook.get_page(Path('Page%i' % i))
+			page.parse('wiki', 'Some foo text\n' * (i + 1))
+			notebook.store_page(page)
+		page = notebook.get_page(Path('Other'))
+		page.parse('wiki', 'Some bar text\n')
+		notebook.store_page(page)
+		notebook.index.check_and_update()
+
+	def search(self, *args):
+		cmd = SearchCommand('search')
+		cmd.parse_options(self.dir, *args)
+		with capture_stdout() as output:
+			cmd.run()
+		return output.getvalue().splitlines()
+
+	def runTest(self):
+		names = ['Page%i' % i for i in range(5)]
+		self.assertEqual(sorted(self.search('foo')), names)
+		self.assertEqual(self.search('Other'), ['Other'])
+
+		first = self.search('foo', '--limit', '2')
+		self.assertEqual(len(first), 2)
+		rest = self.search('foo', '--offset', '2')
+		self.assertEqual(sorted(first + rest), names)
+		self.assertEqual(self.search('foo', '--offset', '2', '--limit', '1'), rest[:1])
+
+		results = [json.loads(line) for line in self.search('foo', '--json')]
+		self.assertEqual(sorted(r['name'] for r in results), names)
+		for r in results:
+			self.assertEqual(r['score'], int(r['name'][-1]) + 1) # one per line
+			if r['snippet'] is not None:
+				self.assertIn('[foo]', r['snippet'])
+
+		self.assertRaises(SearchTimeoutError, self.search, 'foo', '--timeout', '0')
+		self.assertEqual(sorted(self.search('foo', '--timeout', '60')), names)
+		self.assertRaises(UsageError, self.search, 'foo', '--limit', 'x')
+
+
+class TestSearchCommandPaging(TestSearchCommand):
+
+	def setUp(self):
+		from zim.notebook import init_notebook, Notebook
+		self.dir = self.create_tmp_dir()
+		init_notebook(Dir(self.dir))
+		notebook = Notebook.new_from_dir(Dir(self.dir))
+		for i in range(60):
+			page = notebook.get_page(Path('Page%02i' % i))
+			page.parse('wiki', 'Some foo text\n' * (i % 7 + 1))
+			notebook.store_page(page)
+		notebook.index.check_and_update()
+
+	def runTest(self):
+		# Worker processes are used, but pages still come in a fixed order
+		names = ['Page%02i' % i for i in range(60)]
+		all = self.search('foo', '--jobs', '4', '--limit', '60')
+		self.assertEqual(sorted(all), names)
+		for i in range(3):
+			pages = []
+			for offset in range(0, 60, 10):
+				pages.extend(self.search('foo', '--jobs', '4',
+					'--offset', str(offset), '--limit', '10'))
+			self.assertEqual(pages, all)
+
+
 ## ExportCommand() is tested in tests/export.py
 
 
@@ -978,3 +978,34 @@ class TestTrash(tests.TestCase):
 		self.assertFalse(helper.trash(dir))
 
 		# How can we cause gio to give an error and test that case ??
+
+
+from zim.newfs import inotify
+
+@tests.slowTest
+@tests.skipUnless(inotify.supported(), 'inotify not supported')
+class TestInotifyWatcher(tests.TestCase):
+
+	def runTest(self):
+		root = LocalFolder(self.create_tmp_dir())
+		watcher = inotify.InotifyWatcher()
+		watcher.add_watch(root.encodedpath, 'root')
+		self.assertEqual(watcher.read_events(timeout=0), [])
+
+		root.file('test.txt').write('test 123\n')
+		events = watcher.read_events(timeout=1)
+		self.assertTrue(events)
+		for mask, key, name in events:
+			self.assertEqual(key, 'root')
+		# atomic write: tmp file is moved in place
+		self.assertIn((inotify.IN_MOVED_TO, 'root', 'test.txt'), events)
+
+		root.folder('dir').touch()
+		events = watcher.read_events(timeout=1)
+		self.assertTrue(
+			any(e[0] & inotify.IN_CREATE and e[0] & inotify.IN_ISDIR for e in events))
+
+		self.assertRaises(OSError,
+			watcher.add_watch, root.file('test.txt').encodedpath, 'file')
+
+		watcher.close()
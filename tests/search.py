@@ -199,6 +199,205 @@ class TestSearch(tests.TestCase):
 		# TODO test Name
 
 
+class TestSearchFullText(tests.TestCase):
+
+	QUERIES = (
+		'foo', 'foo bar', 'TODO -bar', 'TODO or bar', 'Content: foo*',
+		'Content: "foo bar"', 'Content: fo*o', 'Content: *oo', 'Content: tags',
+		'Content: foo -Content: bar', 'Content: foo or Content: tags',
+		'ThisWordDoesNotExistingInTheTestNotebook',
+		'ask', '*ask', 'Name: *rand*', 'Name: *son', 'Name: *:son:*',
+		'Content: *ormat*', 'Content: *ormat* -Content: *xyz*',
+		'Content: *ormat* or Name: *rand*', 'Name: *ab*',
+	)
+
+	def runTest(self):
+		'''Test search using the full text and trigram index gives same results'''
+		notebook = tests.new_notebook()
+		if not notebook.content.is_available():
+			self.skipTest('SQLite full text search not available')
+
+		for string in self.QUERIES:
+			query = Query(string)
+			results = SearchSelection(notebook)
+			results.search(query)
+
+			notebook.content.is_available = lambda: False
+			expected = SearchSelection(notebook)
+			expected._lookup_name = lambda glob: None
+			expected.search(Query(string))
+			del notebook.content.is_available
+
+			self.assertEqual(results, expected, string)
+			self.assertEqual(results.scores, expected.scores, string)
+
+
+class TestQueryPlan(tests.TestCase):
+
+	def runTest(self):
+		'''Test query planner puts cheap and selective terms first'''
+		notebook = tests.new_notebook()
+		selection = SearchSelection(notebook)
+
+		query = Query('foo -Name: Test:* Name: *ask* @bar Content: foo*')
+		plan = selection.plan(query)
+		self.assertEqual(plan.operator, OPERATOR_AND)
+		self.assertEqual(plan.indexterms, [
+			QueryTerm('tag', 'bar'),
+			QueryTerm('name', '*ask*'),
+			QueryTerm('name', 'Test:*', inverse=True),
+		])
+		self.assertEqual(plan.subgroups, [])
+		self.assertEqual(sorted(t.keyword for t in plan.contentterms),
+			['content', 'contentorname'])
+		self.assertEqual(plan.indexterms[0].cost, COST_INDEX)
+		self.assertEqual(plan.indexterms[0].estimate, 1)
+		self.assertEqual(plan.cost, COST_CONTENT)
+		self.assertEqual(plan.estimate, 1)
+
+		lines = selection.explain(query).splitlines()
+		self.assertEqual(len(lines), 6)
+		self.assertEqual(lines[0], 'AND [content, ~1 pages]')
+		self.assertEqual(lines[1], '\ttag: bar [index, ~1 pages]')
+		self.assertEqual(lines[3], '\tNOT name: Test:* [names]')
+
+		plan = selection.plan(Query('Name: Test:foo or @bar'))
+		self.assertEqual(plan.operator, OPERATOR_OR)
+		self.assertEqual(plan.indexterms, [
+			QueryTerm('name', 'Test:foo'),
+			QueryTerm('tag', 'bar'),
+		]) # OR keeps the order of the query
+		self.assertEqual(plan.estimate, 2)
+
+		# Order of the query does not change results or scores
+		expected = None
+		for string in ('foo @bar -Name: Test:*', '-Name: Test:* @bar foo'):
+			results = SearchSelection(notebook)
+			results.search(Query(string))
+			self.assertEqual(results, set([Path('roundtrip')]))
+			if expected:
+				self.assertEqual(results.scores, expected.scores)
+			expected = results
+
+
+class TestSearchCache(tests.TestCase):
+
+	def runTest(self):
+		'''Test search cache is updated for changed pages'''
+		notebook = tests.new_notebook()
+		cache = SearchCache(notebook.index, maxsize=2)
+
+		get_page = notebook.get_page
+		parsed = []
+		def my_get_page(path):
+			parsed.append(path.name)
+			return get_page(path)
+		notebook.get_page = my_get_page
+
+		results = SearchSelection(notebook, cache=cache)
+		results.search(Query('foo'))
+		self.assertIn('foo', cache)
+		self.assertTrue(parsed)
+		self.assertIn(Path('roundtrip'), results)
+		expected = set(results)
+		scores = results.scores
+
+		# Cached results, no pages parsed
+		parsed[:] = []
+		results = SearchSelection(notebook, cache=cache)
+		results.search(Query('foo'))
+		self.assertEqual(parsed, [])
+		self.assertEqual(results, expected)
+		self.assertEqual(results.scores, scores)
+
+		# Changed and new page, only these are parsed
+		generation = cache.generation
+		page = get_page(Path('roundtrip'))
+		page.get_parsetree() # read content, needed to store it again
+		page.parse('wiki', 'No match here\n')
+		notebook.store_page(page)
+		page = get_page(Path('Test:New'))
+		page.parse('wiki', 'Match foo here\n')
+		notebook.store_page(page)
+		self.assertTrue(cache.generation > generation)
+
+		parsed[:] = []
+		results.search(Query('foo'))
+		self.assertIn('Test:New', parsed)
+		self.assertTrue(set(parsed) <= set(['Test', 'Test:New', 'roundtrip']))
+			# parent "Test" has a new child, so it may be checked as well,
+			# "roundtrip" can be skipped based on the full text index
+
+		# The placeholders "foo" and "foo:bar" were created by links
+		# in "roundtrip", they were deleted when that page changed
+		for name in ('foo', 'foo:bar'):
+			self.assertIn(Path(name), expected)
+			self.assertRaises(IndexNotFoundError,
+				notebook.pages.lookup_by_pagename, Path(name))
+
+		expected = (
+			expected - set([Path('roundtrip'), Path('foo'), Path('foo:bar')])
+		) | set([Path('Test:New')])
+		self.assertEqual(results, expected)
+		self.assertEqual(set(results.scores.keys()), expected)
+
+		# Deleted page is removed
+		notebook.delete_page(Path('Test:New'))
+		parsed[:] = []
+		results.search(Query('foo'))
+		self.assertTrue(set(parsed) <= set(['Test']))
+		self.assertNotIn(Path('Test:New'), results)
+
+		# Queries with links are dropped when any page changes
+		results.search(Query('LinksTo: Test:foo'))
+		self.assertIn('LinksTo: Test:foo', cache)
+		self.assertIn('foo', cache)
+		page = get_page(Path('roundtrip'))
+		page.get_parsetree()
+		page.parse('wiki', 'Link to [[Test:foo]]\n')
+		notebook.store_page(page)
+		self.assertNotIn('LinksTo: Test:foo', cache)
+
+		# Least recently used query is dropped first
+		results.search(Query('bar'))
+		results.search(Query('foo'))
+		results.search(Query('TODO'))
+		self.assertEqual(len(cache), 2)
+		self.assertNotIn('bar', cache)
+		self.assertIn('foo', cache)
+
+
+class TestRankedResults(tests.TestCase):
+
+	def runTest(self):
+		'''Test ranking results with relevance and snippets'''
+		notebook = tests.new_notebook()
+		results = SearchSelection(notebook)
+		results.search(Query('foo -Name: TaskList:*'))
+		ranked = results.ranked_results()
+		self.assertEqual(set(ranked), results)
+		for path in ranked:
+			self.assertIsInstance(path, ResultPath)
+			self.assertEqual(path.score, results.scores[path])
+
+		if notebook.content.is_available():
+			keys = [(-p.relevance, -p.score, p.name) for p in ranked]
+			self.assertEqual(keys, sorted(keys))
+			self.assertTrue(ranked[0].relevance > 0)
+			self.assertIn('[foo]', ranked[0].snippet.lower())
+
+			ranked = results.ranked_results(markers=('<b>', '</b>'))
+			self.assertIn('<b>foo</b>', ranked[0].snippet.lower())
+
+		# Without content terms order by score
+		results.search(Query('Name: *foo*'))
+		ranked = results.ranked_results()
+		self.assertEqual(set(ranked), results)
+		self.assertTrue(all(p.relevance == 0.0 and p.snippet is None for p in ranked))
+		keys = [(-p.score, p.name) for p in ranked]
+		self.assertEqual(keys, sorted(keys))
+
+
 @tests.slowTest
 class TestSearchFiles(TestSearch):
 
@@ -209,3 +408,62 @@ class TestSearchFiles(TestSearch):
 	def runTest(self):
 		'''Test search API with file based notebook'''
 		TestSearch.runTest(self)
+
+
+@tests.slowTest
+class TestSearchParallel(tests.TestCase):
+
+	def runTest(self):
+		'''Test content scan with worker processes gives same results'''
+		notebook = tests.new_files_notebook(self.create_tmp_dir())
+		notebook.content.is_available = lambda: False # force full scan
+
+		for string in TestSearchFullText.QUERIES:
+			expected = SearchSelection(notebook)
+			expected.search(Query(string))
+
+			results = SearchSelection(notebook, processes=2)
+			results.parallel_min_pages = 1
+			results.search(Query(string))
+
+			self.assertEqual(results, expected, string)
+			self.assertEqual(results.scores, expected.scores, string)
+
+		# Page loaded in this process with content that is not stored
+		page = notebook.get_page(Path('Test:foo'))
+		page.get_parsetree() # else the content is reloaded from disk
+		page.parse('wiki', 'xyzzy\n')
+		page.modified = True
+		results = SearchSelection(notebook, processes=2)
+		results.parallel_min_pages = 1
+		results.search(Query('Content: xyzzy'))
+		self.assertEqual(results, set([Path('Test:foo')]))
+
+		# One pool is used for all content terms of a query
+		import zim.search
+		pools = []
+		scans = []
+		class MockContentScanPool(ContentScanPool):
+
+			def __init__(self, processes=None):
+				ContentScanPool.__init__(self, processes)
+				self.closed = False
+				pools.append(self)
+
+			def scan(self, files, regexes, ordered=False):
+				scans.append(self)
+				return ContentScanPool.scan(self, files, regexes, ordered)
+
+			def close(self):
+				self.closed = True
+				ContentScanPool.close(self)
+
+		zim.search.ContentScanPool = MockContentScanPool
+		self.addCleanup(setattr, zim.search, 'ContentScanPool', ContentScanPool)
+
+		results = SearchSelection(notebook, processes=2)
+		results.parallel_min_pages = 1
+		results.search(Query('foo bar or TODO'))
+		self.assertTrue(len(scans) > 1)
+		self.assertEqual(len(pools), 1)
+		self.assertTrue(pools[0].closed)
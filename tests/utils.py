@@ -38,6 +38,31 @@ class TestNaturalSorting(tests.TestCase):
 		self.assertEqual(result, wanted)
 		self.assertTrue(id(result) != id(input))
 
+	def testSortKey(self):
+		import re
+		import locale
+
+		def hex_sort_key(string):
+			# previous implementation, keys were hex encoded
+			string = re.sub(r'\d+', lambda m: '%05i' % int(m.group()), string)
+			string = string.lower()
+			return ''.join(["%02x" % ord(c) for c in locale.strxfrm(string)])
+
+		input = [
+			'a', 'Aa', 'AA', 'b', 'ab', 'abc', 'abd', 'ab c', 'a-b', 'a_b',
+			'foo2bar', 'foo10bar', 'foo01bar', 'Journal', 'journal2017',
+			'z' * 20, 'y' * 21, '',
+		]
+		wanted = sorted(input, key=lambda s: (hex_sort_key(s), s))
+		result = sorted(input, key=lambda s: (natural_sort_key(s), s))
+		self.assertEqual(result, wanted)
+
+		for s in input:
+			key = natural_sort_key(s)
+			self.assertTrue(re.match(r'^[\w\-]*$', key), key)
+			self.assertTrue(len(key) <= len(hex_sort_key(s)))
+			self.assertEqual(natural_sort_key(s), key) # cached
+
 
 class TestOrderedDict(tests.TestCase):
 
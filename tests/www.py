@@ -13,10 +13,11 @@ import logging
 import wsgiref.validate
 import wsgiref.handlers
 
-from zim.fs import File
+from zim.fs import File, Dir
 from zim.www import WWWInterface
 from zim.config import VirtualConfigManager
-from zim.notebook import Path
+from zim.notebook import Notebook, Path
+from zim.notebook.index.snapshot import write_snapshot, SnapshotIndex, TitlesView
 
 # TODO how to test fetching from a socket while mainloop is running ?
 
@@ -59,11 +60,15 @@ class TestWWWInterface(tests.TestCase):
 		self.file_not_found_paths = ['/Test', '/nonexistingpage.html', '/nonexisting/']
 		self.file_found_paths = ['/favicon.ico', '/+resources/checked-box.png']
 
+	def new_notebook(self):
+		notebook = tests.new_notebook(fakedir=self.get_tmp_name())
+		notebook.index.check_and_update()
+		return notebook
+
 	def runTest(self):
 		'Test WWW interface'
 		config = VirtualConfigManager()
-		notebook = tests.new_notebook(fakedir=self.get_tmp_name())
-		notebook.index.check_and_update()
+		notebook = self.new_notebook()
 		interface = WWWInterface(notebook, config=config, template=self.template)
 		validator = wsgiref.validate.validator(interface)
 
@@ -135,6 +140,45 @@ class TestWWWInterface(tests.TestCase):
 			self.assertEqual(header[0], 'HTTP/1.0 200 OK')
 
 
+class TestWWWInterfaceSnapshot(TestWWWInterface):
+
+	def new_notebook(self):
+		notebook = TestWWWInterface.new_notebook(self)
+		file = Dir(self.create_tmp_dir('snapshot')).file('index.db')
+		write_snapshot(notebook, file)
+
+		index = SnapshotIndex(file.path, notebook.layout)
+		snapshot = Notebook(notebook.dir, None, notebook.config,
+			notebook.folder, notebook.layout, index)
+		snapshot.readonly = True
+
+		self.assertEqual(list(snapshot.pages.walk()), list(notebook.pages.walk()))
+		self.assertEqual(
+			[t.name for t in snapshot.tags.list_all_tags()],
+			[t.name for t in notebook.tags.list_all_tags()]
+		)
+		titles = TitlesView.new_from_index(index)
+		self.assertEqual(titles.get_title(Path('Test:foo')), 'Foo')
+		self.assertIsNone(titles.get_title(Path('NonExistingPage')))
+
+		# Tree models, like used in the gui, work with a snapshot
+		from zim.notebook.index.pages import PagesTreeModelMixin
+		from zim.notebook.index.tags import TagsTreeModelMixin
+		for klass in (PagesTreeModelMixin, TagsTreeModelMixin):
+			model = klass(index)
+			wanted = klass(notebook.index)
+			self.assertEqual(model.n_children_top(), wanted.n_children_top())
+			self.assertEqual(
+				model.find_all(Path('Test:foo')),
+				wanted.find_all(Path('Test:foo'))
+			)
+		return snapshot
+
+	def runTest(self):
+		'Test WWW interface with an index snapshot'
+		TestWWWInterface.runTest(self)
+
+
 #~ class TestWWWInterfaceTemplate(TestWWWInterface):
 #~
 	#~ def assertResponseOK(self, response, expectbody=True):
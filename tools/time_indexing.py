@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''Benchmark for the notebook index. Builds mock notebooks of
+increasing size and times a full index of each of them, and some other
+index operations. For a linear update the time per page should stay
+roughly constant.
+
+Usage: time_indexing.py [N_PAGES ...]
+
+E.g. use "time_indexing.py 100000" to check the page walk and the
+previous / next lookups scale to large notebooks.
+'''
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import sqlite3
+
+from zim.newfs import File
+from zim.newfs.mock import MockFolder
+from zim.notebook.page import Path, HRef
+from zim.notebook.layout import FilesLayout
+from zim.notebook.index import IndexUpdateIter
+from zim.notebook.index.pages import PagesView, PagesViewInternal, \
+	CachedPagesViewInternal
+
+
+WIDTH = 10 # number of pages per namespace
+
+CONTENT = '''\
+Content-Type: text/x-zim-wiki
+Wiki-Format: zim 0.4
+
+====== %(name)s ======
+Some text with @tag%(i)i and a link to [[%(link)s]]
+And a [[:Page0:Page1|absolute link]] and a [[+Child]] link
+
+'''
+
+
+def build_notebook(n_pages):
+	'''Build a mock notebook with C{n_pages} pages, nested C{WIDTH}
+	pages per namespace
+	@returns: a L{MockFolder}
+	'''
+	folder = MockFolder('/mock/notebook/%i' % n_pages)
+	for i in range(n_pages):
+		parts = []
+		j = i
+		while True:
+			parts.insert(0, 'Page%i' % (j % WIDTH))
+			j = j // WIDTH
+			if j == 0:
+				break
+		name = ':'.join(parts)
+		link = 'Page%i' % ((i + 1) % WIDTH)
+		folder.file('/'.join(parts) + '.txt').write(
+			CONTENT % {'name': name, 'i': i % 100, 'link': link}
+		)
+	return folder
+
+
+def new_update_iter(folder):
+	db = sqlite3.connect(':memory:')
+	db.row_factory = sqlite3.Row
+	layout = FilesLayout(folder)
+	return IndexUpdateIter(db, layout)
+
+
+def timeFullIndex(folder):
+	update_iter = new_update_iter(folder)
+	start = time.time()
+	update_iter.update()
+	return time.time() - start
+
+
+def timeTouchedReindex(folder):
+	# Like a branch switch that changes the mtime of all files but
+	# not their content
+	update_iter = new_update_iter(folder)
+	update_iter.update()
+	for file in folder.walk():
+		if isinstance(file, File):
+			file._set_mtime(file.mtime() + 10)
+
+	start = time.time()
+	update_iter.check_and_update()
+	return time.time() - start
+
+
+def _floating_links(folder):
+	# Index the notebook, return source pages and floating links to
+	# resolve from them - every page links to the top level pages, so
+	# most links need to walk up all namespaces
+	update_iter = new_update_iter(folder)
+	update_iter.update()
+	sources = [
+		Path(r[0]) for r in update_iter.db.execute(
+			'SELECT name FROM pages WHERE id > 1')
+	]
+	hrefs = [HRef.new_from_wiki_link('Page%i' % i) for i in range(WIDTH)]
+	return update_iter, sources, hrefs
+
+
+def _time_resolve(pages, sources, hrefs):
+	start = time.time()
+	for source in sources:
+		for href in hrefs:
+			pages.resolve_link(source, href)
+	return time.time() - start
+
+
+def timeResolveFloatingLinks(folder):
+	update_iter, sources, hrefs = _floating_links(folder)
+	return _time_resolve(PagesViewInternal(update_iter.db), sources, hrefs)
+
+
+def timeResolveFloatingLinksCached(folder):
+	update_iter, sources, hrefs = _floating_links(folder)
+	pages = CachedPagesViewInternal(update_iter.db, update_iter.pages)
+	return _time_resolve(pages, sources, hrefs) # includes loading the cache
+
+
+def _pages_view(folder):
+	update_iter = new_update_iter(folder)
+	update_iter.update()
+	return PagesView(update_iter.db)
+
+
+def timeWalk(folder):
+	pages = _pages_view(folder)
+	start = time.time()
+	for path in pages.walk():
+		pass
+	return time.time() - start
+
+
+def timePreviousNext(folder):
+	pages = _pages_view(folder)
+	paths = list(pages.walk())
+	start = time.time()
+	for path in paths:
+		pages.get_previous(path)
+		pages.get_next(path)
+	return time.time() - start
+
+
+if __name__ == '__main__':
+	sizes = map(int, sys.argv[1:]) or [1000, 2000, 4000, 8000]
+
+	print "Func\tPages\tTotal [sec]\tPer page [msec]"
+	for n in sizes:
+		folder = build_notebook(n)
+		for func in (
+			timeFullIndex, timeTouchedReindex,
+			timeResolveFloatingLinks, timeResolveFloatingLinksCached,
+			timeWalk, timePreviousNext,
+		):
+			t = func(folder)
+			print "%s\t%i\t%.2f\t%.3f" % (func.__name__, n, t, 1E+3 * t / n)
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''Benchmark for L{natural_sort_key()}. Compares the current
+implementation with the previous hex encoded keys: checks the ordering
+is the same and prints timing and the average key size.
+
+Usage: time_sortkeys.py [N_NAMES]
+'''
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import random
+import locale
+import unicodedata
+
+from zim.utils import natural_sort_key, _num_re
+
+
+def hex_sort_key(string, numeric_padding=5):
+	# Previous implementation of natural_sort_key()
+	templ = '%0' + str(numeric_padding) + 'i'
+	string = _num_re.sub(lambda m: templ % int(m.group()), string)
+	if isinstance(string, unicode):
+		string = unicodedata.normalize('NFKC', string)
+	string = string.lower()
+	try:
+		bytestring = locale.strxfrm(string)
+	except MemoryError:
+		bytestring = string.encode('utf-8')
+	return ''.join(["%02x" % ord(c) for c in bytestring])
+
+
+WORDS = ('Foo', 'foo', 'Bar', 'Journal', 'Page', 'page', 'Notes', 'Todo', 'a', 'Zz')
+
+
+def build_names(n):
+	random.seed(n)
+	names = []
+	for i in range(n):
+		name = random.choice(WORDS)
+		if random.random() < 0.5:
+			name += str(random.randint(0, 2000))
+		if random.random() < 0.3:
+			name += ' ' + random.choice(WORDS).lower()
+		names.append(name)
+	return names
+
+
+def timeKeys(func, names):
+	start = time.time()
+	keys = [func(n) for n in names]
+	return time.time() - start, keys
+
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	names = build_names(n)
+
+	print "Func\tNames\tTotal [sec]\tAvg key size"
+	results = {}
+	for func in (hex_sort_key, natural_sort_key, natural_sort_key):
+		# natural_sort_key twice: first time fills the cache
+		t, keys = timeKeys(func, names)
+		size = float(sum(map(len, keys))) / n
+		print "%s\t%i\t%.3f\t%.1f" % (func.__name__, n, t, size)
+		results[func] = keys
+
+	old = sorted(zip(results[hex_sort_key], names))
+	new = sorted(zip(results[natural_sort_key], names))
+	if [t[1] for t in old] == [t[1] for t in new]:
+		print 'Ordering is unchanged'
+	else:
+		print 'ERROR: ordering differs'
+		sys.exit(1)
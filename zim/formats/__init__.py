@@ -511,6 +511,17 @@ class ParseTree(object):
 
 		return count
 
+	def iter_text(self):
+		'''Generator for the text in this tree
+		@returns: yields strings, these are the same pieces of text
+		that are matched by L{count()} and L{countre()}
+		'''
+		for element in self._etree.getiterator():
+			if element.text:
+				yield element.text
+			if element.tail:
+				yield element.tail
+
 	def countre(self, regex):
 		'''Returns the number of matches for a regular expression
 		in this tree.
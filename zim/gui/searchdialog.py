@@ -9,7 +9,8 @@ import gobject
 import logging
 
 from zim.notebook import Path
-from zim.gui.widgets import Dialog, BrowserTreeView, InputEntry, ErrorDialog, ScrolledWindow
+from zim.gui.widgets import Dialog, BrowserTreeView, InputEntry, ErrorDialog, ScrolledWindow, \
+	encode_markup_text
 from zim.search import *
 
 
@@ -139,14 +140,16 @@ class SearchResultsTreeView(BrowserTreeView):
 	NAME_COL = 0
 	SCORE_COL = 1
 	PATH_COL = 2
+	SNIPPET_COL = 3
 
 	def __init__(self, window):
-		model = gtk.ListStore(str, int, object)
-			# NAME_COL, SCORE_COL, PATH_COL
+		model = gtk.ListStore(str, int, object, str)
+			# NAME_COL, SCORE_COL, PATH_COL, SNIPPET_COL
 		BrowserTreeView.__init__(self, model)
 		self.app_window = window
 		self.query = None
-		self.selection = SearchSelection(window.ui.notebook) # XXX
+		self.selection = SearchSelection(window.ui.notebook, # XXX
+			cache=get_search_cache(window.ui.notebook))
 		self.cancelled = False
 
 		cell_renderer = gtk.CellRendererText()
@@ -163,6 +166,10 @@ class SearchResultsTreeView(BrowserTreeView):
 		model.set_sort_column_id(1, gtk.SORT_DESCENDING)
 			# By default sort by score
 
+		if gtk.gtk_version >= (2, 12) \
+		and gtk.pygtk_version >= (2, 12):
+			self.set_tooltip_column(self.SNIPPET_COL)
+
 		self.connect('row-activated', self._do_open_page)
 		self.connect('destroy', self.__class__._cancel)
 
@@ -179,6 +186,8 @@ class SearchResultsTreeView(BrowserTreeView):
 		self.query = Query(query)
 		self.selection.search(self.query, callback=self._search_callback)
 		self._update_results(self.selection)
+		if not self.selection.cancelled:
+			self._update_snippets()
 
 	def _search_callback(self, results, path):
 		# Returning False will cancel the search
@@ -214,7 +223,7 @@ class SearchResultsTreeView(BrowserTreeView):
 		new = results - seen
 		for path in new:
 			score = results.scores.get(path, 0)
-			model.append((path.name, score, path))
+			model.append((path.name, score, path, None))
 			i += 1
 			order.append((score, i))
 
@@ -222,6 +231,22 @@ class SearchResultsTreeView(BrowserTreeView):
 		order.sort() # sort on first item, which is score
 		model.reorder([x[1] for x in order]) # use second item
 
+	def _update_snippets(self):
+		# Show snippets of the content as tooltips, markers are replaced
+		# after escaping the snippet text
+		model = self.get_model()
+		if not model:
+			return
+
+		snippets = {}
+		for path in self.selection.ranked_results(markers=('\x02', '\x03')):
+			if path.snippet:
+				snippets[path.name] = encode_markup_text(path.snippet) \
+					.replace('\x02', '<b>').replace('\x03', '</b>')
+
+		for row in model:
+			row[self.SNIPPET_COL] = snippets.get(row[self.PATH_COL].name)
+
 	def _do_open_page(self, view, path, col):
 		page = Path( self.get_model()[path][0].decode('utf-8') )
 		self.app_window.ui.open_page(page) # XXX
@@ -10,6 +10,8 @@ takes core of the process life cycle.
 
 import os
 import sys
+import time
+import json
 import logging
 import signal
 
@@ -40,8 +42,9 @@ class HelpCommand(Command):
 usage: zim [OPTIONS] [NOTEBOOK [PAGE]]
    or: zim --server [OPTIONS] [NOTEBOOK]
    or: zim --export [OPTIONS] NOTEBOOK [PAGE]
-   or: zim --search NOTEBOOK QUERY
-   or: zim --index  NOTEBOOK
+   or: zim --search [OPTIONS] NOTEBOOK QUERY
+   or: zim --index  [OPTIONS] NOTEBOOK
+   or: zim --snapshot NOTEBOOK FILE
    or: zim --plugin PLUGIN [ARGUMENTS]
    or: zim --manual [OPTIONS] [PAGE]
    or: zim --help
@@ -53,6 +56,7 @@ General Options:
   --export         export to a different format
   --search         run a search query on a notebook
   --index          build an index for a notebook
+  --snapshot       write a read-only index snapshot for the server
   --plugin         call a specific plugin function
   --manual         open the user manual
   -V, --verbose    print information to terminal
@@ -71,6 +75,7 @@ Server Options:
   --port           port to use (defaults to 8080)
   --template       name of the template to use
   --gui            run the gui wrapper for the server
+  --snapshot=FILE  use an index snapshot instead of the index
 
 Export Options:
   -o, --output     output directory (mandatory option)
@@ -83,10 +88,21 @@ Export Options:
   -O, --overwrite  force overwriting existing file(s)
 
 Search Options:
-  None
+  --limit          max number of results to print
+  --offset         number of results to skip
+  --json           print one json object per result with the name,
+                   score, relevance and a snippet of the content
+  --timeout        max number of seconds to search, prints the
+                   results found so far when the time is up
+  -j, --jobs       number of processes used to search the page
+                   content (defaults to the number of CPUs)
 
 Index Options:
-  None
+  -j, --jobs       number of processes used to parse pages
+                   (defaults to the number of CPUs)
+  -i, --incremental  only update what changed instead of rebuilding
+                   the whole index
+  --stats          print timing statistics when done
 
 Try 'zim --manual' for more help.
 '''
@@ -160,12 +176,14 @@ class NotebookCommand(Command):
 		else:
 			return notebookinfo, None
 
-	def build_notebook(self, ensure_uptodate=True):
+	def build_notebook(self, ensure_uptodate=True, snapshot=None):
 		'''Get the L{Notebook} object for this command
 		Tries to automount the file location if needed.
 		@param ensure_uptodate: if C{True} index is updated when needed.
 		Only set to C{False} when index update is handled explicitly
 		(e.g. in the main gui).
+		@param snapshot: optional L{File} object for an index snapshot
+		to use instead of the index, gives a read-only notebook
 		@returns: a L{Notebook} object and a L{Path} object or C{None}
 		@raises NotebookLookupError: if the notebook could not be
 		resolved or is not given
@@ -177,7 +195,7 @@ class NotebookCommand(Command):
 		notebookinfo, page = self.get_notebook_argument() 	# can raise NotebookLookupError
 		if not notebookinfo:
 			raise NotebookLookupError, _('Please specify a notebook')
-		notebook, uripage = build_notebook(notebookinfo) # can raise FileNotFound
+		notebook, uripage = build_notebook(notebookinfo, snapshot) # can raise FileNotFound
 
 		if ensure_uptodate and not notebook.index.is_uptodate:
 			for info in notebook.index.update_iter():
@@ -266,13 +284,17 @@ class ServerCommand(NotebookCommand):
 		('port=', 'p', 'port number to use (defaults to 8080)'),
 		('template=', 't', 'name or path of the template to use'),
 		('standalone', '', 'start a single instance, no background process'),
+		('snapshot=', '', 'use an index snapshot instead of the index'),
 	)
 
 	def run(self):
 		import zim.www
 		self.opts['port'] = int(self.opts.get('port', 8080))
 		self.opts.setdefault('template', 'Default')
-		notebook, page = self.build_notebook()
+		if self.opts.get('snapshot'):
+			notebook, page = self.build_notebook(snapshot=zim.fs.File(self.opts['snapshot']))
+		else:
+			notebook, page = self.build_notebook()
 
 		self.server = httpd = zim.www.make_server(notebook, public=True, **self.get_options('template', 'port'))
 			# server attribute used in testing to stop sever in thread
@@ -410,13 +432,33 @@ class ExportCommand(NotebookCommand):
 
 
 
+class SearchTimeoutError(Error):
+	'''Error when a search is stopped by the C{--timeout} option'''
+
+	description = 'Results found before the timeout are printed, ' \
+		'use a larger timeout to get all results'
+
+
 class SearchCommand(NotebookCommand):
-	'''Class implementing the C{--search} command'''
+	'''Class implementing the C{--search} command. Results are
+	printed as soon as they are found, so the order is not fixed,
+	except when C{--limit} or C{--offset} is used for paging.
+	When the search times out the results found so far are printed
+	and a L{SearchTimeoutError} is raised, so the command exits with
+	an error status.
+	'''
 
 	arguments = ('NOTEBOOK', 'QUERY')
+	options = (
+		('limit=', '', 'max number of results'),
+		('offset=', '', 'number of results to skip'),
+		('json', '', 'print results as json with score and snippet'),
+		('timeout=', '', 'max number of seconds to search'),
+		('jobs=', 'j', 'number of processes used to search page content'),
+	)
 
 	def run(self):
-		from zim.search import SearchSelection, Query
+		from zim.search import SearchSelection, Query, ResultPath
 
 		notebook, p = self.build_notebook()
 		n, query = self.get_arguments()
@@ -427,22 +469,132 @@ class SearchCommand(NotebookCommand):
 		else:
 			raise ValueError, 'Empty query'
 
-		selection = SearchSelection(notebook)
-		selection.search(query)
-		for path in sorted(selection, key=lambda p: p.name):
-			print path.name
+		try:
+			limit = int(self.opts['limit']) if 'limit' in self.opts else None
+			offset = int(self.opts.get('offset', 0))
+			timeout = float(self.opts['timeout']) if 'timeout' in self.opts else None
+			jobs = int(self.opts.get('jobs', 0)) or None # None means CPU count
+		except ValueError:
+			raise UsageError, 'Options --limit, --offset, --timeout and --jobs need a number'
+
+		# Paging needs the same order of results for each call
+		ordered = limit is not None or 'offset' in self.opts
+		selection = SearchSelection(notebook, processes=jobs, ordered=ordered)
+		if self.opts.get('json'):
+			relevance = selection.lookup_relevance(query)
+		else:
+			relevance = None
+
+		seen = set()
+		def output(path):
+			# Print a result once, skip results before the offset
+			seen.add(path)
+			if len(seen) <= offset:
+				return
+			elif relevance is None:
+				print path.name
+			else:
+				path = ResultPath(path.name, selection.scores.get(path, 0),
+					*relevance.get(path.name, (0.0, None)))
+				print json.dumps({
+					'name': path.name,
+					'score': path.score,
+					'relevance': path.relevance,
+					'snippet': path.snippet,
+				})
+			sys.stdout.flush()
+
+		def done():
+			return limit is not None and len(seen) >= offset + limit
+
+		start = time.time()
+		timedout = []
+		def callback(results, path):
+			# Content is processed last, so when a path is in the
+			# results here its score is final and it can be printed
+			if results is not None and path is not None \
+			and path in results and path not in seen:
+				output(path)
+
+			if done():
+				return False
+			elif timeout is not None and time.time() - start >= timeout:
+				timedout.append(True)
+				return False
+			else:
+				return True
+
+		selection.search(query, callback=callback)
+
+		# Results from the index only are known when the search is done
+		for path in sorted(selection - seen, key=lambda p: p.name):
+			if done():
+				break
+			output(path)
+
+		if timedout:
+			raise SearchTimeoutError, 'Search timed out, results are incomplete'
 
 
 class IndexCommand(NotebookCommand):
 	'''Class implementing the C{--index} command'''
 
 	arguments = ('NOTEBOOK',)
+	options = (
+		('jobs=', 'j', 'number of processes used to parse pages'),
+		('incremental', 'i', 'only update what changed instead of rebuilding'),
+		('stats', '', 'print timing statistics when done'),
+	)
 
 	def run(self):
 		notebook, p = self.build_notebook(ensure_uptodate=False)
-		notebook.index.flush()
-		for info in notebook.index.update_iter():
-			logger.info('Indexing %s', info)
+		index = notebook.index
+		progress = index.get_property('update_progress')
+		if self.opts.get('incremental'):
+			# Files still pending from an interrupted update keep their
+			# status, so the check picks up where it stopped
+			if progress is not None:
+				logger.info('Resuming interrupted index update after %s files', progress)
+			else:
+				logger.info('Updating index')
+			update_iter = index.update_iter
+			iter = update_iter.check_and_update_iter()
+		else:
+			if progress is not None:
+				logger.info('Discarding interrupted index update, use --incremental to resume')
+			index.flush()
+			update_iter = index.update_iter # flush() creates a new object
+			iter = update_iter()
+
+		stats = None
+		if self.opts.get('stats'):
+			stats = update_iter.enable_stats()
+
+		jobs = int(self.opts.get('jobs', 0)) or None # None means CPU count
+		if jobs != 1:
+			update_iter.start_parser_pool(jobs)
+		try:
+			for info in iter:
+				logger.info('Indexing %s', info)
+		finally:
+			update_iter.stop_parser_pool()
+
+		if stats:
+			stats.stop()
+			print stats.format()
+
+
+class SnapshotCommand(NotebookCommand):
+	'''Class implementing the C{--snapshot} command'''
+
+	arguments = ('NOTEBOOK', 'FILE')
+
+	def run(self):
+		from zim.notebook.index.snapshot import write_snapshot
+
+		notebook, p = self.build_notebook()
+		n, file = self.get_arguments()
+		write_snapshot(notebook, zim.fs.File(file))
 
 
 commands = {
@@ -455,6 +607,7 @@ commands = {
 	'export': ExportCommand,
 	'search': SearchCommand,
 	'index': IndexCommand,
+	'snapshot': SnapshotCommand,
 }
 
 
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''Minimal wrapper for the linux "inotify" API, based on C{ctypes}.
+
+Only supports what is needed to watch a tree of folders: watches are
+added per folder and events are returned for the folder itself and for
+the files and folders it contains. On other platforms, or if the C
+library does not provide inotify, L{supported()} returns C{False}.
+'''
+
+import os
+import errno
+import select
+import struct
+import logging
+
+logger = logging.getLogger('zim.newfs')
+
+try:
+	import ctypes
+	import ctypes.util
+	_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+	_libc.inotify_init1
+	_libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+	_libc = None
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+	| IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT_STRUCT = 'iIII' # wd, mask, cookie, len
+_EVENT_SIZE = struct.calcsize(_EVENT_STRUCT)
+
+
+def supported():
+	'''Returns C{True} when inotify can be used on this platform'''
+	return _libc is not None
+
+
+def _raise_errno(path=None):
+	code = ctypes.get_errno()
+	raise OSError(code, os.strerror(code), path)
+
+
+class InotifyWatcher(object):
+	'''Object that wraps an inotify file descriptor
+
+	Each watch is added with a key, events are reported with the key of
+	the folder they belong to. This allows callers to use e.g. relative
+	paths instead of the encoded file system path.
+	'''
+
+	def __init__(self):
+		if not supported():
+			raise OSError(errno.ENOSYS, 'inotify not supported')
+
+		self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			_raise_errno()
+		self._keys = {}
+
+	def add_watch(self, encodedpath, key):
+		'''Watch a folder
+		@param encodedpath: the path of the folder in file system encoding
+		@param key: key used to report events for this folder
+		@raises OSError: if the watch could not be added, e.g. with
+		C{ENOSPC} when the maximum number of watches is reached
+		'''
+		wd = _libc.inotify_add_watch(self.fd, encodedpath, WATCH_MASK)
+		if wd < 0:
+			_raise_errno(encodedpath)
+		self._keys[wd] = key
+
+	def read_events(self, timeout=None):
+		'''Wait for events
+		@param timeout: timeout in seconds or C{None} to block
+		@returns: a list of 3-tuples C{(mask, key, name)} where C{name}
+		is the encoded basename of the child or C{None} for events for
+		the watched folder itself. On overflow of the kernel event queue
+		a single C{(IN_Q_OVERFLOW, None, None)} tuple is included.
+		'''
+		readable, w, x = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return []
+
+		try:
+			data = os.read(self.fd, 64 * 1024)
+		except OSError, error:
+			if error.errno in (errno.EAGAIN, errno.EINTR):
+				return []
+			else:
+				raise
+
+		events = []
+		i = 0
+		while i + _EVENT_SIZE <= len(data):
+			wd, mask, cookie, length = struct.unpack_from(_EVENT_STRUCT, data, i)
+			i += _EVENT_SIZE
+			name = data[i:i+length].rstrip('\0') or None
+			i += length
+
+			if mask & IN_Q_OVERFLOW:
+				events.append((IN_Q_OVERFLOW, None, None))
+			elif mask & IN_IGNORED:
+				self._keys.pop(wd, None) # watch removed by the kernel
+			elif wd in self._keys:
+				events.append((mask, self._keys[wd], name))
+
+		return events
+
+	def close(self):
+		'''Close the file descriptor, removes all watches'''
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+			self._keys = {}
@@ -55,10 +55,13 @@ from .index import IndexNotFoundError, \
 
 
 
-def build_notebook(location):
+def build_notebook(location, snapshot=None):
 	'''Create a L{Notebook} object for a file location
 	Tries to automount file locations first if needed
 	@param location: a L{FilePath} or a L{NotebookInfo}
+	@param snapshot: optional L{File} object for an index snapshot,
+	if given a read-only notebook is created that uses the snapshot
+	instead of the index, see L{Notebook.new_from_snapshot()}
 	@returns: a L{Notebook} object and a L{Path} object or C{None}
 	@raises FileNotFoundError: if file location does not exist and could not be mounted
 	'''
@@ -107,7 +110,10 @@ def build_notebook(location):
 		page = Path(path)
 
 	# And finally create the notebook
-	notebook = Notebook.new_from_dir(dir)
+	if snapshot:
+		notebook = Notebook.new_from_snapshot(dir, snapshot)
+	else:
+		notebook = Notebook.new_from_dir(dir)
 	return notebook, page
 
 
@@ -6,6 +6,8 @@
 from __future__ import with_statement
 
 
+import os
+import time
 import sqlite3
 import threading
 import logging
@@ -18,7 +20,8 @@ except ImportError:
 	gtk = None
 
 
-from zim.newfs import LocalFile, File, Folder, FileNotFoundError
+from zim.newfs import LocalFile, LocalFolder, File, Folder, FileNotFoundError
+from zim.newfs import inotify, FS_ENCODING
 from zim.signals import SignalEmitter
 
 from zim.notebook.operations import NotebookOperation, NotebookOperationOngoing
@@ -28,9 +31,14 @@ from .base import *
 from .pages import *
 from .links import *
 from .tags import *
+from .content import *
+from .trigrams import *
 
+from .parserpool import ParserPool
+from .stats import IndexStats
 
-DB_VERSION = '0.7'
+
+DB_VERSION = '0.14'
 
 
 class Index(SignalEmitter):
@@ -48,6 +56,18 @@ class Index(SignalEmitter):
 	For convenience the L{Notebook} class also exposes these three
 	views with the respective attributes C{pages}, C{links} and C{tags}.
 
+	The database is opened in "WAL" mode. All writes go through a single
+	connection that is used by the L{IndexUpdateIter} and protected by
+	C{lock}. Index views get a L{ReaderConnections} object instead, that
+	gives each thread its own read-only connection. Thus lookups do not
+	block while an update is running, but they only see committed data.
+	(For an in-memory database there is only a single connection.)
+	The tree models for the gui are the exception, they keep using the
+	writer connection, see L{TreeModelMixinBase}.
+
+	Plugin indexers can keep their tables in a separate database file
+	that is attached to all connections, see L{attach_plugin_db()}.
+
 	@signal: C{new-update-iter (update_iter)}: signal used for plugins wanting
 	to extend the indexer
 	@signal: C{changed ()}: emitted after changes have been committed
@@ -66,13 +86,19 @@ class Index(SignalEmitter):
 		self.dbpath = dbpath
 		self.layout = layout
 		self.lock = threading.RLock()
+		self._plugin_dbs = {} # schema name -> path
 		self._db = self.new_connection()
 		self._db_check()
+		if self.dbpath == ':memory:':
+			self._db_reader = self._db
+		else:
+			self._db_reader = ReaderConnections(self.new_connection)
 		if not hasattr(self, 'update_iter'):
 			self._update_iter_init()
 		# else _update_iter_init already called view _db_check --> _db_init
 
 		self.background_check = BackgroundCheck(self._db, self.layout, self.lock, None)
+		self.watcher = IndexWatcher(self._db, self.layout, self.lock, self.background_check)
 
 	def _update_iter_init(self):
 		self.update_iter = IndexUpdateIter(self._db, self.layout)
@@ -96,14 +122,14 @@ class Index(SignalEmitter):
 		except sqlite3.DatabaseError:
 			assert not self.dbpath == ':memory:'
 			logger.warning('Overwriting possibly corrupt database: %s', self.dbpath)
-			self.db.close()
+			self._db.close()
 			file = LocalFile(self.dbpath)
 			try:
 				file.remove()
 			except:
 				logger.exception('Could not delete: %s', file)
 			finally:
-				db = self.new_connection()
+				self._db = self.new_connection()
 				self._db_init()
 
 		# TODO checks on locale, others?
@@ -111,10 +137,19 @@ class Index(SignalEmitter):
 	def _db_init(self):
 		tables = [r[0] for r in self._db.execute(
 			'SELECT name FROM sqlite_master '
-			'WHERE type="table" and name NOT LIKE "sqlite%"'
+			'WHERE type="table" and name NOT LIKE "sqlite%" '
+			'ORDER BY sql LIKE "CREATE VIRTUAL%" DESC'
 		)]
 		for table in tables:
-			self._db.execute('DROP TABLE %s' % table)
+			# Virtual tables go first, they drop their own shadow tables
+			self._db.execute('DROP TABLE IF EXISTS %s' % table)
+
+		# Plugin databases keep their tables, but the data refers
+		# to page ids that are no longer valid
+		for schema in self._plugin_dbs:
+			for table in self._list_plugin_tables(schema):
+				if table != 'zim_plugin':
+					self._db.execute('DELETE FROM %s.%s' % (schema, table))
 
 		logger.debug('(Re-)Initializing database for index')
 		self._db.executescript('''
@@ -129,6 +164,108 @@ class Index(SignalEmitter):
 		self._update_iter_init() # Force re-init of all tables
 		self._db.commit()
 
+	def attach_plugin_db(self, name, db_format):
+		'''Attach a separate database for the tables of a plugin
+		indexer. The database is a file next to the index database,
+		so it can be dropped or vacuumed on its own and the plugin
+		format can change without re-building the main index.
+
+		Tables in the attached database can be used in queries without
+		the schema name, but they must be created with the schema name.
+		E.g. "CREATE TABLE plugin_foo.foo (...)" and
+		"CREATE INDEX plugin_foo.foo_source ON foo(source)".
+
+		@param name: the plugin name
+		@param db_format: version of the tables used by the plugin, if
+		it does not match the version the database was created with,
+		all tables in the database are dropped and all pages are
+		flagged to be indexed again
+		@returns: the schema name of the attached database, e.g.
+		C{"plugin_tasklist"}
+		'''
+		schema = 'plugin_' + name
+		with self.lock:
+			if not schema in self._plugin_dbs:
+				if self.dbpath == ':memory:':
+					path = ':memory:'
+				else:
+					path = os.path.splitext(self.dbpath)[0] + '-' + name + '.db'
+				self._plugin_dbs[schema] = path
+
+				self._db.commit() # can not attach within a transaction
+				self._db.execute('ATTACH DATABASE ? AS %s' % schema, (path,))
+				if path != ':memory:':
+					self._db.execute('PRAGMA %s.journal_mode=WAL;' % schema)
+				if self._db_reader is not self._db:
+					self._db_reader.attach(path, schema)
+
+			if self._get_plugin_db_format(schema) != db_format:
+				logger.debug('Plugin db format out of date for: %s', name)
+				for table in self._list_plugin_tables(schema):
+					self._db.execute('DROP TABLE %s.%s' % (schema, table))
+				self._db.execute(
+					'CREATE TABLE %s.zim_plugin ('
+					'key TEXT, value TEXT, CONSTRAINT uc_MetaOnce UNIQUE (key))'
+					% schema
+				)
+				self._db.execute(
+					'INSERT INTO %s.zim_plugin VALUES (?, ?)' % schema,
+					('db_format', db_format)
+				)
+				self._db.commit()
+				self.flag_reindex()
+
+		return schema
+
+	def drop_plugin_db(self, name):
+		'''Detach and delete the database of a plugin indexer
+		@param name: the plugin name
+		'''
+		schema = 'plugin_' + name
+		with self.lock:
+			if not schema in self._plugin_dbs:
+				return
+
+			path = self._plugin_dbs.pop(schema)
+			self._db.commit()
+			self._db.execute('DETACH DATABASE %s' % schema)
+			if self._db_reader is not self._db:
+				self._db_reader.detach(schema)
+
+			if path != ':memory:':
+				for suffix in ('', '-wal', '-shm'):
+					file = LocalFile(path + suffix)
+					if file.exists():
+						file.remove()
+
+	def vacuum_plugin_db(self, name):
+		'''Rebuild the database file of a plugin indexer to free unused
+		space. This does not touch the main index.
+		@param name: the plugin name
+		'''
+		schema = 'plugin_' + name
+		with self.lock:
+			assert schema in self._plugin_dbs, 'Not attached: %s' % name
+			self._db.commit()
+			self._db.execute('VACUUM %s' % schema)
+
+	def _get_plugin_db_format(self, schema):
+		try:
+			row = self._db.execute(
+				'SELECT value FROM %s.zim_plugin WHERE key=?' % schema,
+				('db_format',)
+			).fetchone()
+		except sqlite3.OperationalError:
+			return None # table does not exist
+		else:
+			return row[0] if row else None
+
+	def _list_plugin_tables(self, schema):
+		return [r[0] for r in self._db.execute(
+			'SELECT name FROM %s.sqlite_master '
+			'WHERE type="table" and name NOT LIKE "sqlite%%"' % schema
+		)]
+
 	def get_property(self, key):
 		c = self._db.execute('SELECT value FROM zim_index WHERE key=?', (key,))
 		row = c.fetchone()
@@ -175,20 +312,49 @@ class Index(SignalEmitter):
 		'''This methods flags all pages with content to be re-indexed.
 		Main reason to use this would be when loading a new plugin that
 		wants to index all pages.
+
+		Unlike L{flush()} this keeps the structure of files and pages.
+		Only the source files of pages are flagged, on the next update
+		they are parsed again and "page-changed" is emitted for each
+		page, so the content indexers can update their data.
 		'''
-		self.flush()
-		# TODO: make this softer than "flush" and really only re-index content
-		# of known pages, no need to re-index file structure here.
-		# Set NEEDS_UPDATE for files that are actual source file only, don't
-		# check folders and other files
+		with self.lock:
+			self._db.execute(
+				'UPDATE files SET index_status = ?, digest = NULL '
+				'WHERE node_type = ? AND id IN ('
+				'	SELECT source_file FROM pages WHERE source_file IS NOT NULL'
+				')',
+				(STATUS_NEED_UPDATE, TYPE_FILE)
+			) # reset digest, else unchanged content is skipped
+			self._db.commit()
 
 	def start_background_check(self, notebook):
-		self.check_async(notebook, [Path(':')], recursive=True)
+		'''Start watching the notebook for changes. When a watcher is
+		available the mtime of all files and folders is checked once for
+		changes made while we were not watching. Else a full recursive
+		check of the notebook is done.
+		'''
+		watching = self.watcher.is_running()
+		if self.watcher.start():
+			with self.lock:
+				if watching:
+					self.background_check.checker.queue_check_folders()
+				else:
+					self.background_check.checker.queue_check_all()
+			self.background_check.callback = lambda *a: on_out_of_date_found(notebook)
+			self.background_check.start()
+		else:
+			self.check_async(notebook, [Path(':')], recursive=True)
 
 	def stop_background_check(self):
+		self.watcher.stop()
 		self.background_check.stop()
 
-	def new_connection(self):
+	def new_connection(self, readonly=False):
+		'''Open a new connection to the database
+		@param readonly: if C{True} the connection refuses any writes
+		@returns: a C{sqlite3.Connection}
+		'''
 		if self.dbpath == ':memory:' and hasattr(self, '_db'):
 			return self._db
 		else:
@@ -197,8 +363,25 @@ class Index(SignalEmitter):
 			db.execute('PRAGMA synchronous=OFF;')
 			# Don't wait for disk writes, we can recover from crashes
 			# anyway. Allows us to use commit more frequently.
+			if readonly:
+				db.execute('PRAGMA query_only=ON;')
+			elif self.dbpath != ':memory:':
+				try:
+					db.execute('PRAGMA journal_mode=WAL;')
+					# Readers do not block the writer and vice versa
+				except sqlite3.DatabaseError:
+					pass # corrupt db - handled by _db_check()
+			for schema, path in self._plugin_dbs.items():
+				db.execute('ATTACH DATABASE ? AS %s' % schema, (path,))
 			return db
 
+	def close(self):
+		'''Close all database connections'''
+		self.stop_background_check()
+		if self._db_reader is not self._db:
+			self._db_reader.close()
+		self._db.close()
+
 	def update_file(self, file):
 		with self.lock:
 			path = file.relpath(self.layout.root)
@@ -257,6 +440,11 @@ class Index(SignalEmitter):
 
 		with self.lock:
 			# cleanup
+			for row in self._db.execute(
+				'SELECT target FROM links WHERE source=?',
+				(ROOT_ID,)
+			):
+				self.update_iter.links.queue_placeholder_check(row['target'])
 			self._db.execute(
 				'DELETE FROM links WHERE source=?',
 				(ROOT_ID,)
@@ -280,33 +468,216 @@ class Index(SignalEmitter):
 			self.emit('changed')
 
 
+class ReaderConnections(object):
+	'''Wrapper for read-only access to the index database. Each thread
+	gets its own connection, which is opened on first use. Supports the
+	same query methods as C{sqlite3.Connection}, so it can be used by
+	index views instead of a connection object.
+
+	Threads that are done with the index can call L{close_thread()}
+	to close their connection. Connections of threads that ended
+	without doing so are closed the next time a connection is opened.
+	'''
+
+	def __init__(self, new_connection):
+		'''Constructor
+		@param new_connection: function to open a new connection,
+		called with C{readonly=True}
+		'''
+		self._new_connection = new_connection
+		self._local = threading.local()
+		self._connections = {} # thread -> connection
+		self._lock = threading.Lock()
+
+	def _get_connection(self):
+		try:
+			return self._local.db
+		except AttributeError:
+			db = self._new_connection(readonly=True)
+			self._local.db = db
+			with self._lock:
+				self._close_finished_threads()
+				self._connections[threading.current_thread()] = db
+			return db
+
+	def _close_finished_threads(self):
+		# So threads that come and go - like the request handlers
+		# of the www server - do not leak connections
+		for thread in self._connections.keys():
+			if not thread.is_alive():
+				self._connections.pop(thread).close()
+
+	def close_thread(self):
+		'''Close the connection for the current thread, to be called
+		by threads that are done using the index. A new connection is
+		opened if the thread uses the index again.
+		'''
+		with self._lock:
+			db = self._connections.pop(threading.current_thread(), None)
+		if db is not None:
+			db.close()
+		self._local.__dict__.pop('db', None)
+
+	def execute(self, *args):
+		return self._get_connection().execute(*args)
+
+	def executemany(self, *args):
+		return self._get_connection().executemany(*args)
+
+	def attach(self, path, schema):
+		'''Attach a database to all open connections, connections
+		opened later should attach it themselves
+		@param path: the database file
+		@param schema: the schema name
+		'''
+		with self._lock:
+			for db in self._connections.values():
+				db.execute('ATTACH DATABASE ? AS %s' % schema, (path,))
+
+	def detach(self, schema):
+		'''Detach a database from all open connections
+		@param schema: the schema name
+		'''
+		with self._lock:
+			for db in self._connections.values():
+				db.execute('DETACH DATABASE %s' % schema)
+
+	def close(self):
+		'''Close all connections, new connections are opened on next use'''
+		with self._lock:
+			for db in self._connections.values():
+				db.close()
+			self._connections = {}
+			self._local = threading.local()
+
+
 class IndexUpdateIter(SignalEmitter):
+	'''Object that runs the indexers to update the database
+
+	Long updates are committed in batches, so when the process is
+	interrupted the work done so far is kept. Files still waiting to
+	be updated keep their status in the "files" table, so the next
+	update continues where this one stopped. While an update is in
+	progress the number of files done is recorded in the
+	"update_progress" key of the "zim_index" table.
+
+	@signal: C{commit ()}: emitted after changes have been committed,
+	both for intermediate and final commits
+	'''
 
 	__signals__ = {
 		'commit': (None, None, ()),
 	}
 
-	def __init__(self, db, layout):
+	COMMIT_INTERVAL = 100 #: max number of files updated between commits
+	COMMIT_TIMEOUT = 5.0 #: max number of seconds between commits
+
+	def __init__(self, db, layout, use_digest=True):
+		'''Constructor
+		@param db: a C{sqlite3.Connection} object
+		@param layout: a L{NotebookLayout} instance to index
+		@param use_digest: if C{True} a content digest is kept for page
+		source files, so pages where only the mtime changed are not
+		indexed again
+		'''
 		self.db = db
 		self.layout = layout
-		self.files = FilesIndexer(db, layout.root)
+		self.db.execute(
+			'CREATE TABLE IF NOT EXISTS zim_index ('
+			'key TEXT, value TEXT, CONSTRAINT uc_MetaOnce UNIQUE (key))'
+		) # normally created by Index, needed for progress
+		self.files = FilesIndexer(db, layout.root,
+			digest_extension=layout.default_extension if use_digest else None)
 		self.pages = PagesIndexer(db, layout, self.files)
 		self.links = LinksIndexer(db, self.pages, self.files)
 		self.tags = TagsIndexer(db, self.pages, self.files)
+		self.content = ContentIndexer(db, self.pages)
+		self.trigrams = TrigramsIndexer(db, self.pages, self.files,
+			fulltext=self.content.module is not None)
+		self.stats = None
 
 	def __call__(self):
 		return self
 
+	def enable_stats(self):
+		'''Collect statistics for the following updates. Timed are
+		the file system checks and updates of the "files" table,
+		parsing of pages, each signal handler of the indexers - which
+		includes plugin indexers that connect to the L{PagesIndexer} -
+		and the database commits. Call C{stats.stop()} when done.
+		@returns: a L{IndexStats} object
+		'''
+		if self.stats is None:
+			self.stats = IndexStats()
+			for indexer in (
+				self.files, self.pages, self.links, self.tags,
+				self.content, self.trigrams
+			):
+				indexer._signal_timer = self.stats.signal_timer
+			for obj, attr, name in (
+				(self.files, '_update_node', 'files.update_node'),
+				(self.pages, '_parse', 'pages.parse'),
+				(self.pages, 'update_page', 'pages.update_page'),
+				(self, '_commit', 'commit'),
+			):
+				setattr(obj, attr, self.stats.wrap(name, getattr(obj, attr)))
+		return self.stats
+
+	def start_parser_pool(self, processes=None):
+		'''Start a pool of worker processes that parse pages in
+		parallel during updates. Database updates are still done in
+		this thread. Call L{stop_parser_pool()} when done.
+		@param processes: number of processes, defaults to the
+		number of CPUs
+		'''
+		self.stop_parser_pool()
+		self.pages.parserpool = ParserPool(processes)
+
+	def stop_parser_pool(self):
+		'''Stop the pool started by L{start_parser_pool()}'''
+		if self.pages.parserpool is not None:
+			self.pages.parserpool.close()
+			self.pages.parserpool = None
+
 	def __iter__(self):
-		for i in self.files.update_iter():
+		for i in self._update_iter():
 			yield
-		self.db.commit()
-		self.emit('commit')
+		self._commit()
 
 	def update(self):
 		'''Convenience method to do a full update at once'''
-		for i in self.files.update_iter():
+		for i in self._update_iter():
 			pass
+		self._commit()
+
+	def _update_iter(self):
+		# Wrapper for files.update_iter() that does intermediate commits
+		done = int(self._get_progress() or 0)
+		n, t = 0, time.time()
+		for i in self.files.update_iter():
+			n += 1
+			if n >= self.COMMIT_INTERVAL \
+			or time.time() - t > self.COMMIT_TIMEOUT:
+				done += n
+				self._commit(progress=done)
+				n, t = 0, time.time()
+			yield
+
+	def _get_progress(self):
+		row = self.db.execute(
+			'SELECT value FROM zim_index WHERE key = ?', ('update_progress',)
+		).fetchone()
+		return row[0] if row else None
+
+	def _commit(self, progress=None):
+		if progress is None:
+			self.db.execute(
+				'DELETE FROM zim_index WHERE key = ?', ('update_progress',))
+		else:
+			self.db.execute(
+				'INSERT OR REPLACE INTO zim_index VALUES (?, ?)',
+				('update_progress', str(progress))
+			)
 		self.db.commit()
 		self.emit('commit')
 
@@ -318,13 +689,15 @@ class IndexUpdateIter(SignalEmitter):
 	def check_and_update_iter(self, file=None):
 		checker = FilesIndexChecker(self.db, self.layout.root)
 		checker.queue_check(file=file)
-		for out_of_date in checker.check_iter():
+		iter = checker.check_iter()
+		if self.stats is not None:
+			iter = self.stats.wrap_iter('files.check', iter)
+		for out_of_date in iter:
 			yield
 			if out_of_date:
-				for i in self.files.update_iter():
+				for i in self._update_iter():
 					yield
-		self.db.commit()
-		self.emit('commit')
+		self._commit()
 
 
 
@@ -373,6 +746,148 @@ class BackgroundCheck(object):
 		logger.debug('BackgroundCheck finished')
 
 
+class IndexWatcher(object):
+	'''Watches the notebook folder for changes and flags the rows in
+	the "files" table for the paths that changed. The actual check is
+	done by the L{BackgroundCheck}, so it only looks at those rows.
+
+	Uses inotify, so only works on linux for notebooks on the local file
+	system. If events are lost because the kernel queue overflows, a
+	full recursive check is queued instead.
+	'''
+
+	def __init__(self, db, layout, lock, background_check):
+		self.db = db
+		self.layout = layout
+		self.lock = lock
+		self.background_check = background_check
+		self.checker = background_check.checker
+		self.stopped = None
+		self._inotify = None
+		self._thread = None
+
+	def start(self):
+		'''Start watching
+		@returns: C{True} if the watcher is running, C{False} if
+		watching is not supported for this notebook
+		'''
+		if self.is_running():
+			return True
+		elif not inotify.supported() \
+		or not isinstance(self.layout.root, LocalFolder):
+			return False
+
+		try:
+			self._inotify = inotify.InotifyWatcher()
+			with self.lock:
+				paths = [r[0] for r in self.db.execute(
+					'SELECT path FROM files WHERE node_type = ?',
+					(TYPE_FOLDER,)
+				)]
+			for path in paths:
+				self._add_watch(path)
+		except OSError, error:
+			# E.g. ENOSPC when max number of watches is reached
+			logger.info('Could not watch notebook folder: %s', error)
+			if self._inotify:
+				self._inotify.close()
+				self._inotify = None
+			return False
+
+		self.stopped = False
+		self._thread = threading.Thread(
+			target=self._thread_main,
+			name=self.__class__.__name__ + '--%i' % id(self)
+		)
+		self._thread.daemon = True
+		self._thread.start()
+		return True
+
+	def stop(self):
+		'''Stop watching and wait for the thread to finish. Changes
+		made while the watcher is stopped are missed, so after a restart
+		all files need to be checked, see L{Index.start_background_check()}
+		'''
+		self.stopped = True
+		if self._thread and self._thread is not threading.current_thread():
+			self._thread.join()
+
+	def is_running(self):
+		'''Returns C{True} if the watcher thread is running and did
+		not miss any events because it was stopped
+		'''
+		return bool(self._thread and self._thread.is_alive()) \
+			and not self.stopped
+
+	def _add_watch(self, path):
+		if path == '.':
+			folder = self.layout.root
+		else:
+			folder = self.layout.root.folder(path)
+		self._inotify.add_watch(folder.encodedpath, path)
+		return folder
+
+	def _add_watch_recursive(self, path):
+		# New or moved-in folder, may contain sub-folders
+		folder = self._add_watch(path)
+		for child in folder.list_folders():
+			self._add_watch_recursive(child.relpath(self.layout.root)) # recurs
+
+	def _thread_main(self):
+		logger.debug('IndexWatcher started')
+		try:
+			while not self.stopped:
+				events = self._inotify.read_events(timeout=1)
+				if not events:
+					continue
+
+				# Also flag events read while stopping, the rows are
+				# checked when the background check runs again
+				with self.lock:
+					for mask, key, name in events:
+						self._on_event(mask, key, name)
+					self.db.commit()
+				if not self.stopped:
+					self.background_check.start()
+		except:
+			logger.exception('Error in IndexWatcher')
+		finally:
+			self._inotify.close()
+			self._inotify = None
+		logger.debug('IndexWatcher finished')
+
+	def _on_event(self, mask, key, name):
+		if mask & inotify.IN_Q_OVERFLOW:
+			logger.info('Lost file system events, doing full check')
+			self.checker.queue_check(None, recursive=True)
+			return
+		elif name is None:
+			# Event for watched folder itself, e.g. deleted or moved,
+			# parent folder will also see an event
+			return
+
+		name = name.decode(FS_ENCODING)
+		if name[0] in ('.', '~') or name[-1] == '~':
+			return # Ignore hidden files and tmp files, like FilesIndexer
+
+		path = name if key == '.' else key + os.sep + name
+		isdir = mask & inotify.IN_ISDIR
+		if isdir and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+			try:
+				self._add_watch_recursive(path)
+			except (OSError, FileNotFoundError):
+				pass # already gone again
+
+		# Flag the row for this path, or the first parent folder that
+		# is in the index. New folders do not need a recursive check
+		# because all content is new when the parent is updated.
+		if isdir:
+			obj = self.layout.root.folder(path)
+		else:
+			obj = self.layout.root.file(path)
+		self.checker.queue_check(obj, recursive=False)
+
+
 def on_out_of_date_found(notebook):
 	# Callback runs in thread, use event to handshake op really started
 	# before returning for next loop of the thread
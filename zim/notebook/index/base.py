@@ -27,7 +27,7 @@ class IndexView(object):
 
 	@classmethod
 	def new_from_index(cls, index):
-		return cls(index._db)
+		return cls(index._db_reader)
 
 	def __init__(self, db):
 		self.db = db
@@ -61,14 +61,26 @@ class TreeModelMixinBase(ConnectorMixin):
 	Treepaths are simply tuples with integers. This Mixin assumes L{MyTreeIter}
 	objects for iters. (Which should not be confused with C{gtk.TreeIter} as
 	used by the interface!)
+
+	Unlike the index views, the models query the writer connection of
+	the index, not the L{ReaderConnections}. This is intentional: the
+	models follow the row signals of the indexers, which are emitted
+	before the changes are committed. A reader connection does not see
+	these rows yet, so the model would not match the signals it passes
+	on to the view. The signals and the queries both run in the main
+	thread, so they do not wait for the lock of a background update.
 	'''
 
 	def __init__(self, index):
 		self.index = index
 		self.db = index._db
 		self.cache = {}
-		self.connect_to_updateiter(index, index.update_iter)
-		self.connectto(index, 'new-update-iter', self.connect_to_updateiter)
+		self.cache_hits = 0 # statistics for the cache, used in tests
+		self.cache_misses = 0
+		if index.update_iter is not None:
+			self.connect_to_updateiter(index, index.update_iter)
+			self.connectto(index, 'new-update-iter', self.connect_to_updateiter)
+		# else read-only index, like a snapshot, the model never changes
 
 	def connect_to_updateiter(self, update_iter):
 		'''Connect to a new L{IndexUpdateIter}
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''This module defines the full text index for page content. The text
+of each page is kept in a virtual table using the sqlite full text
+search extension, FTS5 or FTS4 depending on what sqlite supports. If
+neither is available the table is not created and searching falls
+back to parsing all pages, see L{ContentView.is_available()}.
+'''
+
+from __future__ import with_statement
+
+import re
+import math
+import struct
+import sqlite3
+import logging
+
+logger = logging.getLogger('zim.notebook.index')
+
+from .base import IndexerBase, IndexView
+from .pages import PageIndexRecord
+
+
+FTS_MODULES = (
+	# in order of preference
+	('fts5', 'fts5(text)'),
+	('fts4', 'fts4(text, tokenize=unicode61)'),
+)
+
+_word_re = re.compile(r'[^\W_]+', re.U) # same as the "unicode61" tokenizer
+
+
+def _fulltext_module(db):
+	# Returns the module used for the "fulltext" table, or None if the
+	# table does not exist
+	row = db.execute(
+		'SELECT sql FROM sqlite_master WHERE name = ?', ('fulltext',)
+	).fetchone()
+	if row:
+		for module, args in FTS_MODULES:
+			if module in row[0].lower():
+				return module
+	return None
+
+
+def _bm25(matchinfo, k1=1.2, b=0.75):
+	# Compute the BM25 relevance from the "pcnalx" matchinfo of FTS4,
+	# the same way as the bm25() function of FTS5 does, but positive
+	info = struct.unpack('%iI' % (len(matchinfo) // 4), str(matchinfo))
+	p, c, n, a, l = info[:5] # only one column
+	score = 0.0
+	for i in range(p):
+		tf, x, df = info[5+3*i:8+3*i]
+		if tf:
+			idf = max(math.log((n - df + 0.5) / (df + 0.5)), 1e-6)
+			score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * l / float(a or 1)))
+	return score
+
+
+def split_words(text):
+	'''Split a text in words the same way the full text index does
+	@param text: a string
+	@returns: a list of lower case words
+	'''
+	return [w.lower() for w in _word_re.findall(text)]
+
+
+class ContentIndexer(IndexerBase):
+	'''Indexer that keeps the text of each page in the "fulltext"
+	table. The rowid of the table is the page id.
+	'''
+
+	def __init__(self, db, pagesindexer):
+		IndexerBase.__init__(self, db)
+		self.module = self._init_table()
+		if self.module:
+			self.connectto_all(pagesindexer, (
+				'page-changed', 'page-row-changed', 'page-row-deleted'
+			))
+
+	def _init_table(self):
+		row = self.db.execute(
+			'SELECT sql FROM sqlite_master WHERE name = ?', ('fulltext',)
+		).fetchone()
+		if row:
+			return _fulltext_module(self.db)
+
+		for module, args in FTS_MODULES:
+			try:
+				self.db.execute('CREATE VIRTUAL TABLE fulltext USING %s' % args)
+			except sqlite3.OperationalError:
+				pass # module not compiled in
+			else:
+				return module
+
+		logger.info('SQLite full text search not available, content search will be slow')
+		return None
+
+	def on_page_changed(self, o, row, doc):
+		self.db.execute('DELETE FROM fulltext WHERE rowid = ?', (row['id'],))
+		self.db.execute(
+			'INSERT INTO fulltext(rowid, text) VALUES (?, ?)',
+			(row['id'], u'\n'.join(doc.iter_text()))
+		)
+
+	def on_page_row_changed(self, o, row):
+		if row['source_file'] is None:
+			self.db.execute('DELETE FROM fulltext WHERE rowid = ?', (row['id'],))
+
+	def on_page_row_deleted(self, o, row):
+		self.db.execute('DELETE FROM fulltext WHERE rowid = ?', (row['id'],))
+
+
+class ContentView(IndexView):
+	'''Index view for the full text index of page content'''
+
+	def is_available(self):
+		'''Returns C{True} if the index has a full text table, if not
+		the other methods of this view can not be used
+		'''
+		row = self.db.execute(
+			'SELECT 1 FROM sqlite_master WHERE name = ?', ('fulltext',)
+		).fetchone()
+		return row is not None
+
+	def list_pages(self, text, prefix=False):
+		'''List pages that contain all words in C{text}. Matching is
+		case insensitive and ignores diacritics, it does not check the
+		order of the words or what is in between them. Thus the result
+		includes all pages that contain the text, but may contain more.
+		@param text: a string, split in words with L{split_words()}
+		@param prefix: if C{True} the last word also matches longer
+		words starting with it
+		@returns: yields L{PageIndexRecord} objects
+		@raises ValueError: if C{text} does not contain any words
+		'''
+		words = split_words(text)
+		if not words:
+			raise ValueError, 'No words in: %s' % text
+
+		query = ' '.join(words)
+		if prefix:
+			query += '*'
+
+		for row in self.db.execute(
+			'SELECT pages.* FROM fulltext '
+			'JOIN pages ON fulltext.rowid = pages.id '
+			'WHERE fulltext MATCH ?',
+			(query,)
+		):
+			yield PageIndexRecord(row)
+
+	def list_ranked(self, words, markers=('[', ']'), tokens=10):
+		'''List pages that contain any of the given words, with the
+		BM25 relevance of the page and a snippet of the text. This only
+		uses the index, pages are not parsed.
+		@param words: a list of lower case words, e.g. from
+		L{split_words()}, a word ending in "*" matches as a prefix
+		@param markers: a 2-tuple with the strings to put before and
+		after each matching word in the snippet
+		@param tokens: the max number of words in the snippet, up to 64
+		@returns: yields 3-tuples of a L{PageIndexRecord}, the relevance
+		as a float, where higher is better, and the snippet
+		@raises ValueError: if C{words} is empty
+		'''
+		if not words:
+			raise ValueError, 'No words to look up'
+
+		query = ' OR '.join(words)
+		start, end = markers
+		if _fulltext_module(self.db) == 'fts5':
+			for row in self.db.execute(
+				'SELECT pages.*, -bm25(fulltext) AS relevance, '
+				'snippet(fulltext, 0, ?, ?, \'...\', ?) AS snippet '
+				'FROM fulltext JOIN pages ON fulltext.rowid = pages.id '
+				'WHERE fulltext MATCH ?',
+				(start, end, tokens, query)
+			):
+				yield PageIndexRecord(row), row['relevance'], row['snippet']
+		else:
+			for row in self.db.execute(
+				'SELECT pages.*, matchinfo(fulltext, \'pcnalx\') AS matchinfo, '
+				'snippet(fulltext, ?, ?, \'...\', -1, ?) AS snippet '
+				'FROM fulltext JOIN pages ON fulltext.rowid = pages.id '
+				'WHERE fulltext MATCH ?',
+				(start, end, tokens, query)
+			):
+				yield PageIndexRecord(row), _bm25(row['matchinfo']), row['snippet']
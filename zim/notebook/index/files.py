@@ -1,5 +1,6 @@
 
 
+import hashlib
 import logging
 
 logger = logging.getLogger('zim.notebook.index')
@@ -34,6 +35,10 @@ class FilesIndexer(SignalEmitter):
 	@signal: C{file-row-inserted (row, file)}: on new file found
 	@signal: C{file-row-changed (row, file)}: on file content changed
 	@signal: C{file-row-deleted (row)}: on file deleted
+	@signal: C{file-rows-pending (rows)}: list of file rows that are about
+	to be updated, allows content indexers to prepare work in advance.
+	Files where the digest shows the content did not change are not
+	included.
 
 	'''
 
@@ -45,17 +50,31 @@ class FilesIndexer(SignalEmitter):
 	# Exception is a callback to let explicitly add a new file from
 	# page save in notebook
 
+	BATCH_SIZE = 100 #: Number of pending nodes fetched per query in L{update_iter()}
+	MAX_DIGEST_SIZE = 1024 * 1024 #: Files larger than this only use mtime to detect changes
+
 	__signals__ = {
 		'start-update': (None, None, ()),
 		'finish-update': (None, None, ()),
 		'file-row-inserted': (None, None, (object,)),
 		'file-row-changed': (None, None, (object,)),
 		'file-row-deleted': (None, None, (object,)),
+		'file-rows-pending': (None, None, (object,)),
 	}
 
-	def __init__(self, db, folder):
+	def __init__(self, db, folder, digest_extension=None):
+		'''Constructor
+		@param db: a C{sqlite3.Connection} object
+		@param folder: the L{Folder} to index
+		@param digest_extension: file extension of page source files,
+		e.g. C{".txt"}. If given a content digest is stored for these
+		files and files that only got a new mtime are not updated. If
+		C{None} only the mtime is used to detect changes.
+		'''
 		self.db = db
 		self.folder = folder
+		self.digest_extension = digest_extension
+		self._digests = {} # node_id -> (mtime, digest) see _check_unchanged()
 
 		self.db.executescript('''
 		CREATE TABLE IF NOT EXISTS files(
@@ -65,9 +84,12 @@ class FilesIndexer(SignalEmitter):
 			path TEXT UNIQUE NOT NULL,
 			node_type INTEGER NOT NULL,
 			mtime TIMESTAMP,
+			digest TEXT,
 
 			index_status INTEGER DEFAULT 3
 		);
+		CREATE INDEX IF NOT EXISTS files_status ON files(index_status, node_type, id);
+		CREATE INDEX IF NOT EXISTS files_parent ON files(parent);
 		''')
 		row = self.db.execute('SELECT * FROM files WHERE id == 1').fetchone()
 		if row is None:
@@ -85,44 +107,107 @@ class FilesIndexer(SignalEmitter):
 		# sort folders before files: first index structure, then contents
 		# this makes e.g. index links more efficient and robust
 		# sort by id to ensure parents are found before children
+		#
+		# Pending nodes are drained in batches using the "files_status"
+		# index, so each step is a lookup instead of a table scan.
+		# Updating a folder can flag new children, therefore a batch is
+		# abandoned once a folder was updated and the next node is a file.
 		while True:
-			row = self.db.execute(
+			batch = self.db.execute(
 				'SELECT id, path, node_type FROM files'
 				' WHERE index_status = ?'
-				' ORDER BY node_type, id',
-				(STATUS_NEED_UPDATE, )
-			).fetchone()
-
-			if row:
-				node_id, path, node_type = row
-				#print ">> UPDATE", node_id, path, node_type
-			else:
+				' ORDER BY node_type, id LIMIT ?',
+				(STATUS_NEED_UPDATE, self.BATCH_SIZE)
+			).fetchall()
+			if not batch:
 				break
 
-			try:
-				if node_type == TYPE_FOLDER:
-					folder = self.folder.folder(path)
-					if folder.exists():
-						self.update_folder(node_id, folder)
-					else:
-						self.delete_folder(node_id)
+			if batch[0]['node_type'] == TYPE_FILE:
+				# Compare digests before announcing the batch, so no work
+				# is prepared for files where only the mtime changed
+				pending = []
+				for row in batch:
+					if not self._check_unchanged(row['id'], row['path']):
+						pending.append(row)
+					yield
+				if pending:
+					self.emit('file-rows-pending', pending)
+
+			seen_folder = False
+			for node_id, path, node_type in batch:
+				if node_type == TYPE_FILE and seen_folder:
+					break # re-query, may have new folders pending
+
+				row = self.db.execute(
+					'SELECT path, node_type FROM files'
+					' WHERE id = ? and index_status = ?',
+					(node_id, STATUS_NEED_UPDATE)
+				).fetchone()
+				if row is None:
+					continue # deleted or updated in the mean time
 				else:
-					file = self.folder.file(path)
-					if file.exists():
-						self.update_file(node_id, file)
-					else:
-						self.delete_file(node_id)
-			except:
-				logger.exception('Error while indexing: %s', path)
-				self.db.execute( # avoid looping
-					'UPDATE files SET index_status = ? WHERE id = ?',
-					(STATUS_UPTODATE, node_id)
-				)
+					path, node_type = row
+					#print ">> UPDATE", node_id, path, node_type
 
-			yield
+				if node_type == TYPE_FOLDER:
+					seen_folder = True
+
+				self._update_node(node_id, path, node_type)
+				yield
 
+		self._digests.clear()
 		self.emit('finish-update')
 
+	def _update_node(self, node_id, path, node_type):
+		try:
+			if node_type == TYPE_FOLDER:
+				folder = self.folder.folder(path)
+				if folder.exists():
+					self.update_folder(node_id, folder)
+				else:
+					self.delete_folder(node_id)
+			else:
+				file = self.folder.file(path)
+				if file.exists():
+					self.update_file(node_id, file)
+				else:
+					self.delete_file(node_id)
+		except:
+			logger.exception('Error while indexing: %s', path)
+			self.db.execute( # avoid looping
+				'UPDATE files SET index_status = ? WHERE id = ?',
+				(STATUS_UPTODATE, node_id)
+			)
+
+	def _check_unchanged(self, node_id, path):
+		# Returns C{True} when the content of a pending file did not
+		# change, in that case the file is set up to date right away.
+		# Else the digest is kept for L{update_file()} to avoid reading
+		# the file twice.
+		try:
+			file = self.folder.file(path)
+			if not file.exists():
+				return False
+
+			mtime = file.mtime()
+			digest = self._get_digest(file)
+			if digest is None:
+				return False
+
+			row = self.db.execute(
+				'SELECT digest FROM files WHERE id = ? and index_status = ?',
+				(node_id, STATUS_NEED_UPDATE)
+			).fetchone()
+			if row is not None and row['digest'] == digest:
+				self.set_node_uptodate(node_id, mtime)
+				return True
+			else:
+				self._digests[node_id] = (mtime, digest)
+				return False
+		except:
+			logger.exception('Error while indexing: %s', path)
+			return False # let update_file() deal with it
+
 	def interactive_add_file(self, file):
 		assert isinstance(file, File) and file.exists()
 		parent_id = self._add_parent(file.parent())
@@ -213,10 +298,38 @@ class FilesIndexer(SignalEmitter):
 
 	def update_file(self, node_id, file):
 		# get mtime before contents /signal
-		self.set_node_uptodate(node_id, file.mtime())
+		mtime = file.mtime()
+		mymtime, digest = self._digests.pop(node_id, (None, None))
+		if mymtime != mtime:
+			digest = self._get_digest(file)
 		row = self.db.execute('SELECT * FROM files WHERE id=?', (node_id,)).fetchone()
 		assert row is not None, 'No row matching id: %r' % node_id
-		self.emit('file-row-changed', row)
+
+		if digest is not None and digest == row['digest']:
+			# Only mtime changed, e.g. after a checkout or restoring
+			# a backup - no need to re-index the content
+			self.set_node_uptodate(node_id, mtime)
+		else:
+			self.db.execute(
+				'UPDATE files SET index_status = ?, mtime = ?, digest = ? WHERE id = ?',
+				(STATUS_UPTODATE, mtime, digest, node_id)
+			)
+			row = self.db.execute('SELECT * FROM files WHERE id=?', (node_id,)).fetchone()
+			self.emit('file-row-changed', row)
+
+	def _get_digest(self, file):
+		# Returns C{None} for files that are not page sources, these are
+		# never parsed so reading them would only add I/O. Also C{None}
+		# for large files, reading them would be expensive.
+		if not self.digest_extension \
+		or not file.basename.endswith(self.digest_extension) \
+		or file.size() > self.MAX_DIGEST_SIZE:
+			return None
+
+		data = file.read_binary()
+		if isinstance(data, unicode):
+			data = data.encode('utf-8')
+		return hashlib.md5(data).hexdigest()
 
 	def set_node_uptodate(self, node_id, mtime):
 		self.db.execute(
@@ -281,6 +394,31 @@ class FilesIndexChecker(object):
 				(new_status, node_id)
 			)
 
+	def queue_check_folders(self):
+		'''Flag all folders to be checked, but not the files they
+		contain. A folder that changed is updated, which in turn checks
+		the mtime of all its children. Used when a watcher is already
+		running and takes care of changes to files, but folders may
+		have changed while the watcher was restarted.
+		'''
+		self.db.execute(
+			'UPDATE files SET index_status = ? '
+			'WHERE node_type = ? and index_status < ?',
+			(STATUS_CHECK, TYPE_FOLDER, STATUS_CHECK)
+		)
+
+	def queue_check_all(self):
+		'''Flag all folders and files to be checked, but not
+		recursively. Compared to L{queue_check_folders()} this also
+		finds files that were edited in place, as that does not change
+		the mtime of the folder. Costs one stat per file, used on
+		startup to find changes made while we were not watching.
+		'''
+		self.db.execute(
+			'UPDATE files SET index_status = ? WHERE index_status < ?',
+			(STATUS_CHECK, STATUS_CHECK)
+		)
+
 	def check_iter(self):
 		'''Generator function that walks existing records and flags
 		records that are not longer valid. Yields in between checks
@@ -288,76 +426,85 @@ class FilesIndexChecker(object):
 		@returns: Yields C{True} when an out of
 		date record is found.
 		'''
-		# Check for pending updates first
-		row = self.db.execute(
-			'SELECT id FROM files WHERE index_status=?',
-			(STATUS_NEED_UPDATE,)
-		)
-		if row is not None:
-			yield True
-
 		# sort folders before files: first index structure, then contents
 		# this makes e.g. index links more efficient and robust
 		# sort by id to ensure parents are found before children
-
+		#
+		# Flagged nodes are drained in batches per status using the
+		# "files_status" index, like FilesIndexer.update_iter(), so each
+		# step is a lookup instead of a table scan plus sort.
 		while True:
+			# Check for pending updates first
 			row = self.db.execute(
-				'SELECT id, path, node_type, mtime, index_status FROM files'
-				' WHERE index_status > ? '
-				' ORDER BY node_type, id',
-				(STATUS_UPTODATE,)
+				'SELECT id FROM files WHERE index_status = ? LIMIT 1',
+				(STATUS_NEED_UPDATE,)
 			).fetchone()
+			if row is not None:
+				yield True
+				continue
 
-			if row:
-				node_id, path, node_type, mtime, check = row
+			for status in (STATUS_CHECK_RECURS, STATUS_CHECK):
+				batch = self.db.execute(
+					'SELECT id, path, node_type, mtime FROM files'
+					' WHERE index_status = ?'
+					' ORDER BY node_type, id LIMIT ?',
+					(status, FilesIndexer.BATCH_SIZE)
+				).fetchall()
+				if batch:
+					break
 			else:
 				break
 
-			if check == STATUS_NEED_UPDATE:
-				yield True
-				continue
-			# else in (STATUS_CHECK, STATUS_CHECK_RECURS)
+			for node_id, path, node_type, mtime in batch:
+				yield self._check_node(node_id, path, node_type, mtime, status)
+
+	def _check_node(self, node_id, path, node_type, mtime, check):
+		# Returns True if the node is out of date. Rows are only
+		# changed when they still have the status they had when the
+		# batch was fetched, an update in between yields may have
+		# changed them already.
+		try:
+			if node_type == TYPE_FOLDER:
+				obj = self.folder.folder(path)
+			else:
+				obj = self.folder.file(path)
 
-			try:
-				if node_type == TYPE_FOLDER:
-					obj = self.folder.folder(path)
-				else:
-					obj = self.folder.file(path)
+			if not obj.exists():
+				check = STATUS_CHECK # update will drop children, no need to recurs anymore
+				new_status = STATUS_NEED_UPDATE
 
-				if not obj.exists():
-					check = STATUS_CHECK # update will drop children, no need to recurs anymore
+			else:
+				if mtime == obj.mtime():
+					new_status = STATUS_UPTODATE
+				else:
 					new_status = STATUS_NEED_UPDATE
 
-				else:
-					if mtime == obj.mtime():
-						new_status = STATUS_UPTODATE
-					else:
-						new_status = STATUS_NEED_UPDATE
+			c = self.db.execute(
+				'UPDATE files SET index_status = ?'
+				' WHERE id = ? and index_status = ?',
+				(new_status, node_id, check)
+			)
+			if c.rowcount == 0:
+				return False # changed in the mean time
 
+			if check == STATUS_CHECK_RECURS \
+			and node_type == TYPE_FOLDER:
 				self.db.execute(
-					'UPDATE files SET index_status = ?'
-					' WHERE id = ?',
-					(new_status, node_id)
+					'UPDATE files SET index_status = ? '
+					'WHERE parent = ? and index_status < ?',
+					(STATUS_CHECK_RECURS, node_id, STATUS_CHECK_RECURS)
 				)
+				# the "<" prevents overwriting a more important flag
 
-				if check == STATUS_CHECK_RECURS \
-				and node_type == TYPE_FOLDER:
-					self.db.execute(
-						'UPDATE files SET index_status = ? '
-						'WHERE parent = ? and index_status < ?',
-						(STATUS_CHECK_RECURS, node_id, STATUS_CHECK_RECURS)
-					)
-					# the "<" prevents overwriting a more important flag
-
-			except:
-				logger.exception('Error while indexing: %s', path)
-				self.db.execute( # avoid looping
-					'UPDATE files SET index_status = ? WHERE id = ?',
-					(STATUS_NEED_UPDATE, node_id)
-				)
-				new_status = STATUS_NEED_UPDATE
+		except:
+			logger.exception('Error while indexing: %s', path)
+			self.db.execute( # avoid looping
+				'UPDATE files SET index_status = ? WHERE id = ?',
+				(STATUS_NEED_UPDATE, node_id)
+			)
+			new_status = STATUS_NEED_UPDATE
 
-			yield new_status == STATUS_NEED_UPDATE
+		return new_status == STATUS_NEED_UPDATE
 
 
 
@@ -11,7 +11,7 @@ from zim.notebook.page import Path, HRef, \
 
 
 from .base import IndexerBase, IndexView
-from .pages import PagesViewInternal, ROOT_ID
+from .pages import PagesViewInternal, CachedPagesViewInternal, ROOT_ID
 
 
 LINK_DIR_FORWARD = 1 #: Constant for forward links
@@ -61,16 +61,20 @@ class LinksIndexer(IndexerBase):
 
 	def __init__(self, db, pagesindexer, filesindexer):
 		IndexerBase.__init__(self, db)
-		self._pages = PagesViewInternal(db)
+		self._pages = CachedPagesViewInternal(db, pagesindexer)
 		self._pagesindexer = pagesindexer
 		self.connectto_all(pagesindexer, (
-			'page-row-inserted', 'page-changed', 'page-row-deleted'
+			'page-row-inserted', 'page-row-changed', 'page-changed',
+			'page-row-deleted'
 		))
-		self.connectto(filesindexer,
-			'finish-update'
-		)
+		self.connectto_all(filesindexer, (
+			'start-update', 'file-row-inserted', 'finish-update'
+		))
+		self._resolved = {} # memo for _resolve_link()
+		self._placeholders = set() # ids of placeholders that may be unused
+		self._full_cleanup = True # placeholders of an interrupted update
 
-		self.db.execute('''
+		self.db.executescript('''
 			CREATE TABLE IF NOT EXISTS links (
 				source INTEGER REFERENCES pages(id),
 				target INTEGER REFERENCES pages(id),
@@ -87,29 +91,89 @@ class LinksIndexer(IndexerBase):
 
 				CONSTRAINT uc_LinkOnce UNIQUE (source, rel, names)
 			);
+			CREATE INDEX IF NOT EXISTS links_target ON links(target, source);
+			CREATE INDEX IF NOT EXISTS links_anchorkey ON links(rel, anchorkey);
+			CREATE INDEX IF NOT EXISTS links_needscheck ON links(needscheck);
 		''')
 
+	def on_start_update(self, o):
+		self._resolved.clear()
+
+	def on_file_row_inserted(self, o, filerow):
+		# New file can turn a placeholder into a real page, which
+		# changes how floating links resolve
+		self._resolved.clear()
+
 	def on_page_changed(self, o, row, doc):
-		# Drop links for this page and add new ones (don't bother
-		# determining delta and updating).
-		self.db.execute(
-			'DELETE FROM links WHERE source=?',
-			(row['id'],)
+		# Determine delta with the links in the database: existing
+		# links keep their target (changes in the page structure are
+		# handled by the "needscheck" flag), so only new links need to
+		# be resolved.
+		oldlinks = dict(
+			((r['rel'], r['names']), r['target']) for r in self.db.execute(
+				'SELECT rel, names, target FROM links WHERE source=?',
+				(row['id'],)
+			)
 		)
 		pagename = Path(row['name'])
+		seen = set()
 		for href in doc.iter_href():
-			target_id, targetname = self._pages.resolve_link(pagename, href)
-			if target_id is None:
-				target_id = self._pagesindexer.insert_link_placeholder(targetname)
+			key = (href.rel, href.names)
+			if key in seen:
+				continue # different text, but same link
+			seen.add(key)
 
-			anchorkey = natural_sort_key(href.parts()[0])
+			if key in oldlinks:
+				oldlinks.pop(key)
+			else:
+				target_id = self._resolve_link(pagename, href)
+				anchorkey = natural_sort_key(href.parts()[0])
+				self.db.execute(
+					'INSERT INTO links(source, target, rel, names, anchorkey) '
+					'VALUES (?, ?, ?, ?, ?)',
+					(row['id'], target_id, href.rel, href.names, anchorkey)
+				)
+
+		for rel, names in oldlinks:
 			self.db.execute(
-				'INSERT INTO links(source, target, rel, names, anchorkey) '
-				'VALUES (?, ?, ?, ?, ?)',
-				(row['id'], target_id, href.rel, href.names, anchorkey)
+				'DELETE FROM links WHERE source=? and rel=? and names=?',
+				(row['id'], rel, names)
 			)
+		self._placeholders.update(oldlinks.values())
+
+	def _resolve_link(self, source, href):
+		# Resolve link and create a placeholder if the target does not
+		# exist. Results are memoized for the duration of one update.
+		# Absolute links only depend on the href, for an existing
+		# source page floating links only depend on the namespace of
+		# the source. Relative links are unique per source and thus
+		# not memoized. Only links that resolve to an existing page
+		# are kept, so we never need to check for new placeholders.
+		if href.rel == HREF_REL_ABSOLUTE or source.isroot:
+			key = (HREF_REL_ABSOLUTE, href.names, None)
+		elif href.rel == HREF_REL_FLOATING:
+			key = (href.rel, href.names, source.parent.name)
+		else:
+			key = None
+
+		if key in self._resolved:
+			return self._resolved[key]
+
+		target_id, targetname = self._pages.resolve_link(source, href)
+		if target_id is None:
+			target_id = self._pagesindexer.insert_link_placeholder(targetname)
+		if key is not None:
+			self._resolved[key] = target_id
+		return target_id
 
 	def on_page_row_inserted(self, o, row):
+		# A new page can change how floating links resolve, but
+		# floating links do not resolve to placeholders
+		if not row['is_link_placeholder']:
+			self._resolved.clear()
+		else:
+			self._placeholders.add(row['id'])
+
 		# Placeholders for pages of the same name need to be
 		# recalculated, flag links to be checked with same anchorkey.
 		self.db.execute( # TODO turn query into a JOIN
@@ -120,10 +184,21 @@ class LinksIndexer(IndexerBase):
 			(HREF_REL_FLOATING, row['sortkey'])
 		)
 
+	def on_page_row_changed(self, o, row):
+		# Page can turn into a placeholder when it loses its content
+		if row['is_link_placeholder'] and row['n_children'] == 0:
+			self._placeholders.add(row['id'])
+
 	def on_page_row_deleted(self, o, row):
 		# Drop all outgoing links, flag incoming links to be checked.
 		# Check could result in page being re-created as placeholder
 		# at end of db update.
+		self._resolved.clear()
+		self._placeholders.update(r[0] for r in self.db.execute(
+			'SELECT target FROM links WHERE source=?',
+			(row['id'],)
+		))
+		self._placeholders.discard(row['id'])
 		self.db.execute(
 			'DELETE FROM links WHERE source=?',
 			(row['id'],)
@@ -141,27 +216,48 @@ class LinksIndexer(IndexerBase):
 		):
 			href = HRef(row['rel'], row['names'])
 			source = self._pages.get_pagename(row['source'])
-			target_id, targetname = self._pages.resolve_link(source, href)
-			if target_id is None:
-				target_id = self._pagesindexer.insert_link_placeholder(targetname)
-
+			target_id = self._resolve_link(source, href)
 			self.db.execute(
 				'UPDATE links SET target=?, needscheck=? WHERE source=? and names=?',
 				(target_id, False, row['source'], row['names'])
 			)
-
-		# Delete un-used placeholders
-		for row in self.db.execute('''
-			SELECT pages.id FROM pages LEFT JOIN links ON pages.id=links.target
-			WHERE pages.is_link_placeholder=1 and pages.n_children=0 and links.source IS NULL
-		'''):
-			pagename = self._pages.get_pagename(row['id'])
-			self._pagesindexer.remove_page(pagename, self._allow_cleanup)
+			if target_id != row['target']:
+				self._placeholders.add(row['target'])
+
+		# Delete un-used placeholders - only pages that were created as
+		# placeholder or lost a link during this update are candidates,
+		# so the cost does not depend on the size of the notebook.
+		if self._full_cleanup:
+			self._placeholders.update(r[0] for r in self.db.execute('''
+				SELECT pages.id FROM pages LEFT JOIN links ON pages.id=links.target
+				WHERE pages.is_link_placeholder=1 and pages.n_children=0 and links.source IS NULL
+			'''))
+			self._full_cleanup = False
+
+		while self._placeholders:
+			id = self._placeholders.pop()
+			row = self.db.execute(
+				'SELECT id FROM pages '
+				'WHERE id=? and is_link_placeholder=1 and n_children=0 '
+				'and NOT EXISTS (SELECT 1 FROM links WHERE target=?)',
+				(id, id)
+			).fetchone()
+			if row:
+				pagename = self._pages.get_pagename(row['id'])
+				self._pagesindexer.remove_page(pagename, self._allow_cleanup)
 
 			# The allow_cleanup function checks whether a parent has links or not.
 			# Without this guard function we would need to iterate several times
 			# through this cleanup function.
 
+	def queue_placeholder_check(self, page_id):
+		'''Have L{cleanup_placeholders()} check whether a page is an
+		unused placeholder, needed when links are removed without
+		going through this indexer
+		@param page_id: the id of the page in the "pages" table
+		'''
+		self._placeholders.add(page_id)
+
 	def _allow_cleanup(self, row):
 		c, = self.db.execute(
 			'SELECT COUNT(*) FROM links WHERE target=?', (row['id'],)
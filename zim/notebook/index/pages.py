@@ -5,6 +5,7 @@
 from __future__ import with_statement
 
 
+import itertools
 from datetime import datetime
 
 from zim.utils import natural_sort_key
@@ -28,6 +29,21 @@ PAGE_EXISTS_AS_LINK = 1 # placeholder for link target
 PAGE_EXISTS_HAS_CONTENT = 2 # either has content or children have content
 
 
+# The "sortpath" column materializes the position of a page in the tree:
+# it concatenates the sortkey and basename of all parents and the page
+# itself. Sorting on this column gives the same order as a depth first
+# walk that sorts each level by "sortkey, name". The separators sort
+# before any character in a sortkey or a page name, so parents come
+# before their children and a shorter sortkey before a longer one.
+# Since the sortpath of a page never changes once it is inserted, it
+# is cheap to keep up to date.
+SORTPATH_SEP = u'\x01' # between levels
+SORTPATH_KEY_SEP = u'\x02' # between sortkey and basename
+
+def _sortpath(parent_sortpath, sortkey, basename):
+	return parent_sortpath + SORTPATH_SEP + sortkey + SORTPATH_KEY_SEP + basename
+
+
 class PagesIndexer(IndexerBase):
 	'''Indexer for the "pages" table.
 
@@ -48,8 +64,10 @@ class PagesIndexer(IndexerBase):
 	def __init__(self, db, layout, filesindexer):
 		IndexerBase.__init__(self, db)
 		self.layout = layout
+		self.parserpool = None # optional L{ParserPool}, set by L{IndexUpdateIter}
 		self.connectto_all(filesindexer, (
-			'file-row-inserted', 'file-row-changed', 'file-row-deleted'
+			'file-row-inserted', 'file-row-changed', 'file-row-deleted',
+			'file-rows-pending', 'finish-update'
 		))
 
 		self.db.executescript('''
@@ -63,16 +81,23 @@ class PagesIndexer(IndexerBase):
 				mtime TIMESTAMP,
 
 				source_file INTEGER REFERENCES files(id),
-				is_link_placeholder BOOLEAN DEFAULT 0
+				is_link_placeholder BOOLEAN DEFAULT 0,
+
+				-- position in the tree, see _sortpath()
+				sortpath TEXT
 			);
-			CREATE UNIQUE INDEX IF NOT EXISTS pages_name ON pages(name)
+			CREATE UNIQUE INDEX IF NOT EXISTS pages_name ON pages(name);
+			CREATE INDEX IF NOT EXISTS pages_parent ON pages(parent, sortkey, name);
+			CREATE INDEX IF NOT EXISTS pages_sortkey ON pages(sortkey, name);
+			CREATE INDEX IF NOT EXISTS pages_mtime ON pages(mtime);
+			CREATE INDEX IF NOT EXISTS pages_sortpath ON pages(sortpath);
 		''')
 		row = self.db.execute('SELECT * FROM pages WHERE id == 1').fetchone()
 		if row is None:
 			c = self.db.execute(
-				'INSERT INTO pages(parent, name, sortkey, source_file) '
-				'VALUES (? , ?, ?, ?)',
-				(0, '', '', 1)
+				'INSERT INTO pages(parent, name, sortkey, source_file, sortpath) '
+				'VALUES (? , ?, ?, ?, ?)',
+				(0, '', '', 1, '')
 			)
 			assert c.lastrowid == 1 # ensure we start empty
 
@@ -113,11 +138,34 @@ class PagesIndexer(IndexerBase):
 			file = self.layout.root.file(filerow['path'])
 			format = self.layout.get_format(file)
 			mtime = file.mtime()
-			tree = format.Parser().parse(file.read())
+			tree = None
+			if self.parserpool is not None:
+				tree = self.parserpool.get_parsetree(file, mtime)
+			if tree is None:
+				tree = self._parse(file, format)
 			self.update_page(pagename, mtime, tree)
 		else:
 			pass # some conflict file changed
 
+	def _parse(self, file, format):
+		return format.Parser().parse(file.read())
+
+	def on_file_rows_pending(self, o, filerows):
+		# Hand over files to the parser pool while we are still
+		# busy with the database for previous files
+		if self.parserpool is None:
+			return
+
+		for filerow in filerows:
+			pagename, file_type = self.layout.map_filepath(filerow['path'])
+			if file_type == FILE_TYPE_PAGE_SOURCE:
+				file = self.layout.root.file(filerow['path'])
+				self.parserpool.queue(file, self.layout.get_format(file))
+
+	def on_finish_update(self, o):
+		if self.parserpool is not None:
+			self.parserpool.clear()
+
 	def on_file_row_deleted(self, o, filerow):
 		pagename, file_type = self.layout.map_filepath(filerow['path'])
 		if file_type != FILE_TYPE_PAGE_SOURCE:
@@ -161,10 +209,11 @@ class PagesIndexer(IndexerBase):
 
 		# update table
 		sortkey = natural_sort_key(pagename.basename)
+		sortpath = _sortpath(parent_row['sortpath'], sortkey, pagename.basename)
 		self.db.execute(
-			'INSERT INTO pages(name, sortkey, parent, is_link_placeholder, source_file)'
-			'VALUES (?, ?, ?, ?, ?)',
-			(pagename.name, sortkey, parent_row['id'], is_link_placeholder, file_id)
+			'INSERT INTO pages(name, sortkey, parent, is_link_placeholder, source_file, sortpath)'
+			'VALUES (?, ?, ?, ?, ?, ?)',
+			(pagename.name, sortkey, parent_row['id'], is_link_placeholder, file_id, sortpath)
 		)
 		self.update_parent(pagename.parent)
 
@@ -205,7 +254,8 @@ class PagesIndexer(IndexerBase):
 			if bool(row['is_link_placeholder']) is not is_placeholder:
 				self.update_parent(parentname.parent) # recurs
 
-			parentname = PageIndexRecord(self._select(parentname))
+			row = self._select(parentname) # get updated row
+			parentname = PageIndexRecord(row)
 
 			# notify others
 			if not parentname.isroot:
@@ -342,39 +392,7 @@ class PagesViewInternal(object):
 					i = [c for c,k in enumerate(keys) if k==anchorkey][-1]
 					return self.resolve_pagename(db, root, relnames[:i] + href.parts()[1:])
 
-			if ignore_link_placeholders:
-				c = self.db.execute(
-					'SELECT name FROM pages '
-					'WHERE sortkey=? and is_link_placeholder=0 '
-					'ORDER BY name DESC',
-					(anchor_key,)
-				) # sort longest first
-			else:
-				c = self.db.execute(
-					'SELECT name FROM pages '
-					'WHERE sortkey=? '
-					'ORDER BY name DESC',
-					(anchor_key,)
-				) # sort longest first
-
-			maxdepth = source.name.count(':')
-			depth = -1 # level where items were found
-			found = [] # candidates that match the link - these can only differ in case of the basename
-			for name, in c:
-				mydepth = name.count(':')
-				if mydepth > maxdepth:
-					continue
-				elif mydepth < depth:
-					break
-
-				if mydepth > 0: # check whether we have a common parent
-					parentname = name.rsplit(':', 1)[0]
-					if start.name.startswith(parentname):
-						depth = mydepth
-						found.append(name)
-				else: # resolve from root namespace
-					found.append(name)
-
+			found = self._find_floating(source, start, anchor_key, ignore_link_placeholders)
 			if found: # try to match case first, else just use first match
 				parts = href.parts()
 				anchor = parts.pop(0)
@@ -403,47 +421,92 @@ class PagesViewInternal(object):
 		pagename = parent
 		page_id = self.get_page_id(parent)
 		for i, basename in enumerate(names):
-			if page_id == ROOT_ID:
-				row = self.db.execute(
-					'SELECT id, name FROM pages WHERE name=?',
-					(basename,)
-				).fetchone()
-			else:
-				row = self.db.execute(
-					'SELECT id, name FROM pages WHERE parent=? and name LIKE ?',
-					(page_id, "%:"+basename)
-				).fetchone()
-
-			if row: # exact match
-				pagename = Path(row['name'])
-				page_id = row['id']
-			else:
-				sortkey = natural_sort_key(basename)
-				row = self.db.execute(
-					'SELECT id, name FROM pages '
-					'WHERE parent=? and sortkey=? ORDER BY name',
-					(page_id, sortkey)
-				).fetchone()
-				if row: # case insensitive match
-					pagename = Path(row['name'])
-					page_id = row['id']
-				else: # no match
-					return None, pagename.child(':'.join(names[i:]))
+			row = self._lookup_child(page_id, pagename, basename)
+			if row:
+				page_id, name = row
+				pagename = Path(name)
+			else: # no match
+				return None, pagename.child(':'.join(names[i:]))
 		else:
 			return page_id, pagename
 
+	def _find_floating(self, source, start, anchor_key, ignore_link_placeholders):
+		# Returns names of pages matching the anchor of a floating link
+		# in the deepest namespace above the source that has any. These
+		# candidates can only differ in case of the basename.
+		names = self._list_floating_candidates(anchor_key, ignore_link_placeholders)
+		names.sort(key=lambda n: (n.count(':'), n), reverse=True) # deepest first
+		maxdepth = source.name.count(':')
+		depth = -1 # level where items were found
+		found = []
+		for name in names:
+			mydepth = name.count(':')
+			if mydepth > maxdepth:
+				continue
+			elif mydepth < depth:
+				break
+
+			if mydepth > 0: # check whether we have a common parent
+				parentname = name.rsplit(':', 1)[0]
+				if start.name == parentname \
+				or start.name.startswith(parentname + ':'):
+					depth = mydepth
+					found.append(name)
+			else: # resolve from root namespace
+				found.append(name)
+
+		return found
+
+	def _list_floating_candidates(self, anchor_key, ignore_link_placeholders):
+		# Returns names of pages with a basename matching anchor_key
+		if ignore_link_placeholders:
+			c = self.db.execute(
+				'SELECT name FROM pages '
+				'WHERE sortkey=? and is_link_placeholder=0 '
+				'ORDER BY name DESC',
+				(anchor_key,)
+			)
+		else:
+			c = self.db.execute(
+				'SELECT name FROM pages '
+				'WHERE sortkey=? '
+				'ORDER BY name DESC',
+				(anchor_key,)
+			)
+		return [r[0] for r in c]
+
+	def _lookup_child(self, page_id, pagename, basename):
+		# Returns (id, name) for a child page matching basename,
+		# or None. Tries exact match first, then case insensitive.
+		row = self.db.execute(
+			'SELECT id, name FROM pages WHERE name=?',
+			(pagename.child(basename).name,)
+		).fetchone()
+		if not row:
+			sortkey = natural_sort_key(basename)
+			row = self.db.execute(
+				'SELECT id, name FROM pages '
+				'WHERE parent=? and sortkey=? ORDER BY name',
+				(page_id, sortkey)
+			).fetchone()
+
+		return tuple(row) if row else None
+
 	def walk(self, parent_id):
-		# Need to do this recursive to preserve sorting
-		#              else we could just do "name LIKE parent%"
+		# All descendants have the sortpath of the parent as prefix,
+		# so this is a single range query in the right order
+		parent = self.db.execute(
+			'SELECT sortpath FROM pages WHERE id=?', (parent_id,)
+		).fetchone()
+		if parent is None:
+			return
+
 		for row in self.db.execute(
-			'SELECT * FROM pages WHERE parent=? '
-			'ORDER BY sortkey, name',
-			(parent_id,)
+			'SELECT * FROM pages WHERE sortpath>? and sortpath<? '
+			'ORDER BY sortpath',
+			(parent['sortpath'] + SORTPATH_SEP, parent['sortpath'] + SORTPATH_KEY_SEP)
 		):
 			yield PageIndexRecord(row)
-			if row['n_children'] > 0:
-				for child in self.walk(row['id']): # recurs
-					yield child
 
 	def walk_bottomup(self, parent_id):
 		for row in self.db.execute(
@@ -457,6 +520,105 @@ class PagesViewInternal(object):
 			yield PageIndexRecord(row)
 
 
+class CachedPagesViewInternal(PagesViewInternal, ConnectorMixin):
+	'''Version of L{PagesViewInternal} that keeps the names of all
+	pages in memory, so links can be resolved without database queries.
+	Pages are indexed by name and by parent and sortkey of the basename,
+	so floating links are resolved with one lookup per namespace.
+
+	The cache is loaded on first use and kept in sync using the signals
+	of the L{PagesIndexer}. Therefore it can only be used on the same
+	connection the indexer writes to, e.g. by other indexers.
+	'''
+
+	def __init__(self, db, pagesindexer):
+		PagesViewInternal.__init__(self, db)
+		self._ids = None # name -> id, None while not loaded
+		self._names = {} # id -> name
+		self._placeholders = set() # ids
+		self._children = {} # (parent id, sortkey) -> set of ids
+		self.connectto_all(pagesindexer, (
+			'page-row-inserted', 'page-row-changed', 'page-row-deleted'
+		))
+
+	def _load(self):
+		self._ids = {}
+		for row in self.db.execute(
+			'SELECT id, name, parent, sortkey, is_link_placeholder FROM pages'
+		):
+			self._add(row)
+
+	def _add(self, row):
+		id = row['id']
+		self._ids[row['name']] = id
+		self._names[id] = row['name']
+		if row['is_link_placeholder']:
+			self._placeholders.add(id)
+		self._children.setdefault((row['parent'], row['sortkey']), set()).add(id)
+
+	def on_page_row_inserted(self, o, row):
+		if self._ids is not None:
+			self._add(row)
+
+	def on_page_row_changed(self, o, row):
+		if self._ids is not None:
+			if row['is_link_placeholder']:
+				self._placeholders.add(row['id'])
+			else:
+				self._placeholders.discard(row['id'])
+
+	def on_page_row_deleted(self, o, row):
+		if self._ids is not None and row['id'] in self._names:
+			id = row['id']
+			del self._ids[self._names.pop(id)]
+			self._placeholders.discard(id)
+			self._children[(row['parent'], row['sortkey'])].discard(id)
+
+	def get_page_id(self, pagename):
+		if self._ids is None:
+			self._load()
+
+		try:
+			return self._ids[pagename.name]
+		except KeyError:
+			raise IndexNotFoundError, 'Page not found in index: %s' % pagename.name
+
+	def _find_floating(self, source, start, anchor_key, ignore_link_placeholders):
+		# Instead of filtering all pages with the same basename, walk
+		# up the namespaces and look up the children matching the anchor
+		if self._ids is None:
+			self._load()
+
+		if start == source:
+			namespaces = start.parents()
+		else:
+			namespaces = itertools.chain([start], start.parents())
+
+		for namespace in namespaces:
+			ids = self._children.get((self._ids.get(namespace.name), anchor_key))
+			if ids and ignore_link_placeholders:
+				ids = [id for id in ids if id not in self._placeholders]
+			if ids:
+				return sorted((self._names[id] for id in ids), reverse=True)
+		else:
+			return []
+
+	def _lookup_child(self, page_id, pagename, basename):
+		if self._ids is None:
+			self._load()
+
+		name = pagename.child(basename).name
+		if name in self._ids:
+			return self._ids[name], name
+		else:
+			ids = self._children.get((page_id, natural_sort_key(basename)))
+			if ids:
+				name = min(self._names[id] for id in ids)
+				return self._ids[name], name
+			else:
+				return None
+
+
 class PagesView(IndexView):
 	'''Index view that exposes the "pages" table in the index'''
 
@@ -509,8 +671,6 @@ class PagesView(IndexView):
 		@returns: an iterator that yields L{Path} objects
 		@raises IndexNotFoundError: if C{path} does not exist in the index
 		'''
-		# Need to do this recursive to preserve sorting
-		#              else we could just do "name LIKE parent%"
 		page_id = self._pages.get_page_id(path) if path else ROOT_ID # can raise
 		return self._pages.walk(page_id)
 
@@ -530,37 +690,18 @@ class PagesView(IndexView):
 		@returns: a L{Path} object or C{None} if {path} is the first page in
 		the index
 		'''
-		# Find last (grand)child of previous item with same parent
-		# If no previous item, yield parent
 		if path.isroot: raise ValueError, 'Can\'t use root'
 
+		sortpath = self._get_sortpath(path)
 		r = self.db.execute(
-			'SELECT parent FROM pages WHERE name=?', (path.name,)
-		).fetchone()
-		if r is None:
-			raise IndexNotFoundError, 'No such page: %s', path
-		else:
-			parent_id = r[0]
-
-		r = self.db.execute(
-			'SELECT * FROM pages WHERE parent=? and sortkey<? and name<? '
-			'ORDER BY sortkey DESC, name DESC LIMIT 1',
-			(parent_id, natural_sort_key(path.basename), path.name)
+			'SELECT * FROM pages WHERE sortpath<? '
+			'ORDER BY sortpath DESC LIMIT 1',
+			(sortpath,)
 		).fetchone()
-		if not r:
-			parent = self._pages.get_pagename(parent_id)
-			return None if parent.isroot else parent
+		if r is None or r['id'] == ROOT_ID:
+			return None
 		else:
-			while r['n_children'] > 0:
-				r = self.db.execute(
-					'SELECT * FROM pages WHERE parent=? '
-					'ORDER BY sortkey DESC, name DESC LIMIT 1',
-					(r['id'],)
-				).fetchone()
-				if r is None:
-					raise IndexConsistencyError, 'Missing children'
-			else:
-				return PageIndexRecord(r)
+			return PageIndexRecord(r)
 
 	def get_next(self, path):
 		'''Get the next path in the index, in the same order that
@@ -569,44 +710,27 @@ class PagesView(IndexView):
 		@returns: a L{Path} object or C{None} if C{path} is the last page in
 		the index
 		'''
-		# If item has children, yield first child
-		# Else find next item with same parent
-		# If no next item, find next item for parent
 		if path.isroot: raise ValueError, 'Can\'t use root'
 
+		sortpath = self._get_sortpath(path)
 		r = self.db.execute(
-			'SELECT * FROM pages WHERE name=?', (path.name,)
+			'SELECT * FROM pages WHERE sortpath>? '
+			'ORDER BY sortpath LIMIT 1',
+			(sortpath,)
 		).fetchone()
 		if r is None:
-			raise IndexNotFoundError, 'No such page: %s', path
+			return None
+		else:
+			return PageIndexRecord(r)
 
-		if r['n_children'] > 0:
-			r = self.db.execute(
-				'SELECT name FROM pages WHERE parent=? '
-				'ORDER BY sortkey, name LIMIT 1',
-				(r['id'],)
-			).fetchone()
-			if r is None:
-				raise IndexConsistencyError, 'Missing children'
-			else:
-				return PageIndexRecord(r)
+	def _get_sortpath(self, path):
+		r = self.db.execute(
+			'SELECT sortpath FROM pages WHERE name=?', (path.name,)
+		).fetchone()
+		if r is None:
+			raise IndexNotFoundError, 'No such page: %s' % path
 		else:
-			while True:
-				n = self.db.execute(
-					'SELECT * FROM pages WHERE parent=? and sortkey>? and name>? '
-					'ORDER BY sortkey, name LIMIT 1',
-					(r['parent'], r['sortkey'], r['name'])
-				).fetchone()
-				if n is not None:
-					return PageIndexRecord(n)
-				elif r['parent'] == ROOT_ID:
-					return None
-				else:
-					r = self.db.execute(
-						'SELECT * FROM pages WHERE id=?', (r['parent'],)
-					).fetchone()
-					if r is None:
-						raise IndexConsistencyError, 'Missing parent'
+			return r[0]
 
 	def lookup_from_user_input(self, name, reference=None):
 		'''Lookup a pagename based on user input
@@ -715,6 +839,9 @@ class PagesTreeModelMixin(TreeModelMixinBase):
 	# Optimize lookup for finding records in the same level
 	# - always cache parent, to retrieve other children more quickly
 	# - cache a range of 20 records at once
+	# - on insert only shift the cached records after the new row,
+	#   on delete we flush because the GUI needs to invalidate iters
+	#   before dropping records
 
 	# Signals use "find_all" instead of "find" to allow for subclasses that
 	# have multiple entries, like models for tags
@@ -725,13 +852,41 @@ class PagesTreeModelMixin(TreeModelMixinBase):
 		)
 
 	def on_page_row_inserted(self, o, row):
-		self.flush_cache()
-		for treepath in self._find_all_pages(row['name']):
+		treepaths = self._find_all_pages(row['name'])
+		for treepath in treepaths:
+			self._shift_cache(treepath, row['name'])
+
+		for treepath in treepaths:
 			if treepath[-1] == 0 and len(treepath) > 1:
 				self._check_parent_has_child_toggled(treepath)
 			treeiter = self.get_iter(treepath) # not mytreeiter !
 			self.emit('row-inserted', treepath, treeiter)
 
+	def _shift_cache(self, treepath, name):
+		# Make room for a new row at "treepath": cached records at or
+		# after this position on the same level, and their children,
+		# move one position down. Lookup of the new row may already
+		# have cached it, that record stays in place.
+		new = self.cache.pop(treepath, None)
+		if new is not None and new.row['name'] != name:
+			self.cache[treepath] = new
+			new = None
+
+		depth = len(treepath) - 1
+		parent, offset = treepath[:-1], treepath[-1]
+		moved = [
+			k for k in self.cache
+				if len(k) > depth and k[depth] >= offset and k[:depth] == parent
+		]
+		moved.sort(reverse=True) # avoid overwriting keys still to be moved
+		for k in moved:
+			myiter = self.cache.pop(k)
+			myiter.treepath = parent + (k[depth] + 1,) + k[depth+1:]
+			self.cache[myiter.treepath] = myiter
+
+		if new is not None:
+			self.cache[treepath] = new
+
 	def _check_parent_has_child_toggled(self, treepath):
 		parent = self.get_mytreeiter(treepath[:-1])
 		if parent.row['n_children'] == 1:
@@ -743,6 +898,7 @@ class PagesTreeModelMixin(TreeModelMixinBase):
 		for treepath in self._find_all_pages(row['name']):
 			treeiter = self.get_iter(treepath) # not mytreeiter !
 			self.cache[treepath].row = row # ensure uptodate info
+			self.cache[treepath].n_children = row['n_children']
 			self.emit('row-changed', treepath, treeiter)
 
 	def on_page_row_deleted(self, o, row):
@@ -759,7 +915,10 @@ class PagesTreeModelMixin(TreeModelMixinBase):
 
 	def get_mytreeiter(self, treepath):
 		if treepath in self.cache:
+			self.cache_hits += 1
 			return self.cache[treepath]
+		else:
+			self.cache_misses += 1
 
 		# Find parent
 		parentpath = treepath[:-1]
@@ -878,6 +1037,15 @@ class TestPagesDBTable(object):
 				self.assertIsNotNone(parent,
 					'Missing parent for %s' % row['name'])
 
+				parent_sortpath, = db.execute(
+					'SELECT sortpath FROM pages WHERE id=?',
+					(row['parent'],)
+				).fetchone()
+				self.assertEqual(row['sortpath'],
+					_sortpath(parent_sortpath, row['sortkey'], Path(row['name']).basename),
+					'Sortpath for %s is inconsistent' % row['name']
+				)
+
 				if not row['is_link_placeholder']:
 					# Check upwards - parent(s) must not be placeholder either
 					self.assertFalse(parent['is_link_placeholder'],
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''This module defines a pool of worker processes that read and parse
+page source files ahead of the L{PagesIndexer}. The indexer itself
+still runs in a single thread and does all the database writes, it
+just picks up ready parse trees instead of parsing each page inline.
+'''
+
+import logging
+import multiprocessing
+
+logger = logging.getLogger('zim.notebook.index')
+
+from zim.newfs import LocalFile
+from zim.formats import get_format, ParseTree
+
+
+def _parse_file(path, format_name):
+	# Runs in the worker process - parse trees can not be pickled,
+	# so we pass them back as XML
+	file = LocalFile(path)
+	mtime = file.mtime() # get mtime before contents
+	tree = get_format(format_name).Parser().parse(file.read())
+	return mtime, tree.tostring()
+
+
+class ParserPool(object):
+	'''Pool of worker processes that parse page source files.
+
+	Files are submitted with L{queue()} as soon as the indexer knows
+	they need to be updated. When the indexer gets to the file it
+	calls L{get_parsetree()} to pick up the result. Only files on the
+	local file system are handled, for other files (and any failure in
+	the worker) the indexer falls back to parsing the page itself.
+	'''
+
+	def __init__(self, processes=None):
+		'''Constructor
+		@param processes: number of worker processes, defaults to the
+		number of CPUs
+		'''
+		self.processes = processes or multiprocessing.cpu_count()
+		self._pool = multiprocessing.Pool(self.processes)
+		self._pending = {}
+
+	def queue(self, file, format):
+		'''Queue a file to be parsed
+		@param file: a L{File} object
+		@param format: the format module for the file
+		'''
+		if isinstance(file, LocalFile) and not file.path in self._pending:
+			format_name = format.__name__.rsplit('.', 1)[-1]
+			self._pending[file.path] = \
+				self._pool.apply_async(_parse_file, (file.path, format_name))
+
+	def get_parsetree(self, file, mtime):
+		'''Get the parse tree for a queued file
+		@param file: a L{File} object
+		@param mtime: the mtime of the file as seen by the indexer,
+		results for an older version of the file are discarded
+		@returns: a L{ParseTree} or C{None} if the file was not queued,
+		could not be parsed or changed in the mean time
+		'''
+		result = self._pending.pop(file.path, None)
+		if result is None:
+			return None
+
+		try:
+			mymtime, xml = result.get()
+		except:
+			logger.exception('Error while parsing: %s', file)
+			return None
+
+		if mymtime != mtime:
+			return None # file changed after it was parsed
+		else:
+			return ParseTree().fromstring(xml)
+
+	def clear(self):
+		'''Drop results that were not picked up'''
+		self._pending.clear()
+
+	def close(self):
+		'''Stop the worker processes'''
+		self._pending.clear()
+		self._pool.terminate()
+		self._pool.join()
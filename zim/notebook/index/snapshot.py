@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''This module defines a read-only snapshot of the index. It is used
+to serve notebooks that do not change, e.g. with C{zim --server} or
+the cgi-bin script, without opening and checking the live index.
+
+A snapshot is a stand-alone sqlite database with only the tables
+needed by the index views -- pages, links and tags -- plus a table
+with the title of each page. It is written by L{write_snapshot()} and
+opened by L{SnapshotIndex}, which the L{Notebook} can use instead of
+an L{Index} object, see L{Notebook.new_from_snapshot()}.
+
+Opening a snapshot does not check or update anything. Connections are
+read-only and memory map the database file, so the snapshot can be
+shared by any number of processes without write locks.
+'''
+
+from __future__ import with_statement
+
+import os
+import re
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('zim.notebook.index')
+
+from zim.errors import Error
+from zim.notebook.page import Path
+
+from . import DB_VERSION, ReaderConnections
+from .base import IndexView
+
+
+SNAPSHOT_FORMAT = '1'
+
+_tables = ('pages', 'links', 'tags', 'tagsources')
+
+_create_re = re.compile(r'^(CREATE\s+(?:UNIQUE\s+)?(?:TABLE|INDEX)\s+)', re.I)
+
+
+class SnapshotError(Error):
+	'''Error raised when a file is not a valid index snapshot'''
+
+	description = _('The index snapshot was written by a different version of zim, please create a new snapshot')
+		# T: error description for an invalid index snapshot
+
+
+def write_snapshot(notebook, file):
+	'''Write a snapshot of the index of a notebook. The snapshot is a
+	copy of the current state of the index, so the index should be
+	up-to-date. An existing snapshot is replaced by renaming the new
+	file, processes that have the old snapshot open are not affected.
+	@param notebook: a L{Notebook} object
+	@param file: a L{File} object for the snapshot
+	'''
+	index = notebook.index
+
+	titles = []
+	for id, name in index._db_reader.execute(
+		'SELECT id, name FROM pages WHERE id > 1 ORDER BY id'
+	).fetchall():
+		page = notebook.get_page(Path(name))
+		if page.hascontent:
+			titles.append((id, page.get_title()))
+
+	tmp = file.path + '.new'
+	if os.path.exists(tmp):
+		os.remove(tmp)
+
+	with index.lock:
+		db = index._db
+		db.commit()
+		db.execute('ATTACH DATABASE ? AS snapshot', (tmp,))
+		try:
+			for table in _tables:
+				_copy_table(db, table)
+
+			db.execute('CREATE TABLE snapshot.titles (page INTEGER PRIMARY KEY, title TEXT)')
+			db.executemany('INSERT INTO snapshot.titles VALUES (?, ?)', titles)
+			db.execute('CREATE TABLE snapshot.zim_snapshot (key TEXT, value TEXT)')
+			db.executemany('INSERT INTO snapshot.zim_snapshot VALUES (?, ?)', (
+				('snapshot_format', SNAPSHOT_FORMAT),
+				('db_version', DB_VERSION),
+			))
+			db.commit()
+		except:
+			db.rollback()
+			db.execute('DETACH DATABASE snapshot')
+			os.remove(tmp)
+			raise
+		else:
+			db.execute('DETACH DATABASE snapshot')
+
+	if os.name == 'nt' and os.path.exists(file.path):
+		os.remove(file.path) # rename does not replace on windows
+	os.rename(tmp, file.path)
+	logger.info('Wrote index snapshot with %i pages: %s', len(titles), file.path)
+
+
+def _copy_table(db, table):
+	# Re-use the schema of the index, but create the indexes after
+	# copying the data
+	schema = db.execute(
+		'SELECT type, sql FROM main.sqlite_master '
+		'WHERE tbl_name = ? AND sql IS NOT NULL',
+		(table,)
+	).fetchall()
+	for type, sql in schema:
+		if type == 'table':
+			db.execute(_create_re.sub(r'\1snapshot.', sql, 1))
+	db.execute('INSERT INTO snapshot.%s SELECT * FROM main.%s ORDER BY rowid' % (table, table))
+	for type, sql in schema:
+		if type == 'index':
+			db.execute(_create_re.sub(r'\1snapshot.', sql, 1))
+
+
+class SnapshotIndex(object):
+	'''Read-only replacement for the L{Index} object, using a snapshot
+	written by L{write_snapshot()}. It supports index views, like
+	L{PagesView}, but no updates; the C{update_iter} attribute is
+	C{None}.
+
+	The C{_db} and C{lock} attributes are read-only equivalents of
+	those of the L{Index}, so tree models for the index can be used
+	with a snapshot as well.
+	'''
+
+	update_iter = None
+	is_uptodate = True
+
+	def __init__(self, dbpath, layout):
+		'''Constructor
+		@param dbpath: the file path of the snapshot
+		@param layout: a L{NotebookLayout} instance for the notebook
+		@raises SnapshotError: if the file is not a valid snapshot
+		'''
+		if not os.path.isfile(dbpath):
+			raise SnapshotError(_('No such index snapshot: %s') % dbpath)
+				# T: error message
+
+		self.dbpath = dbpath
+		self.layout = layout
+		self._mmap_size = os.path.getsize(dbpath)
+		self._db_reader = ReaderConnections(self.new_connection)
+		self._db = self._db_reader
+		self.lock = threading.RLock() # no writers, only for compatibility
+
+		try:
+			ok = self.get_property('snapshot_format') == SNAPSHOT_FORMAT \
+				and self.get_property('db_version') == DB_VERSION
+		except sqlite3.DatabaseError:
+			ok = False
+
+		if not ok:
+			self._db_reader.close()
+			raise SnapshotError(_('Invalid index snapshot: %s') % dbpath)
+				# T: error message
+
+	def new_connection(self, readonly=True):
+		'''Open a new connection to the snapshot
+		@param readonly: ignored, connections are always read-only
+		@returns: a C{sqlite3.Connection}
+		'''
+		db = sqlite3.Connection(self.dbpath, check_same_thread=False)
+		db.row_factory = sqlite3.Row
+		db.execute('PRAGMA query_only=ON;')
+		db.execute('PRAGMA mmap_size=%i;' % self._mmap_size)
+		return db
+
+	def get_property(self, key):
+		r = self._db_reader.execute(
+			'SELECT value FROM zim_snapshot WHERE key = ?', (key,)
+		).fetchone()
+		return r[0] if r else None
+
+	def close(self):
+		'''Close all database connections'''
+		self._db_reader.close()
+
+
+class TitlesView(IndexView):
+	'''Index view for the page titles in a snapshot'''
+
+	def get_title(self, path):
+		'''Get the title of a page
+		@param path: a L{Path} object
+		@returns: the title as string, or C{None} if the page has no
+		content
+		'''
+		row = self.db.execute(
+			'SELECT titles.title FROM titles '
+			'INNER JOIN pages ON titles.page = pages.id '
+			'WHERE pages.name = ?', (path.name,)
+		).fetchone()
+		return row[0] if row else None
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''This module defines an object to collect timing statistics for an
+index update. It is used for the C{--stats} option of the C{--index}
+command and by benchmarks.
+
+Timers can be nested, e.g. a signal handler that is called by an
+indexer method that is also timed. Each timer only counts its own
+time, the time spend in nested timers is subtracted. Thus the times of
+all timers add up to the time spend in instrumented code.
+'''
+
+from __future__ import with_statement
+
+import time
+
+
+class IndexStats(object):
+	'''Collects call counts and wall time for the phases of an index
+	update. See L{IndexUpdateIter.enable_stats()} for the phases that
+	are instrumented.
+	'''
+
+	def __init__(self):
+		self.timers = {} # name -> [calls, seconds]
+		self.start_time = time.time()
+		self.stop_time = None
+		self._stack = [] # for each running timer the time in nested timers
+
+	def stop(self):
+		'''Stop the clock for the total time'''
+		self.stop_time = time.time()
+
+	def timer(self, name):
+		'''Returns a context manager that times the code it wraps
+		@param name: the name of the timer
+		'''
+		return _Timer(self, name)
+
+	def _add(self, name, seconds):
+		record = self.timers.setdefault(name, [0, 0.0])
+		record[0] += 1
+		record[1] += seconds
+
+	def wrap(self, name, func):
+		'''Wrap a function with a timer
+		@param name: the name of the timer
+		@param func: the function to wrap
+		@returns: a function that calls C{func}
+		'''
+		def wrapper(*args, **kwargs):
+			with self.timer(name):
+				return func(*args, **kwargs)
+
+		return wrapper
+
+	def wrap_iter(self, name, iter):
+		'''Wrap an iterator, timing each step
+		@param name: the name of the timer
+		@param iter: the iterator to wrap
+		@returns: a generator yielding the same items as C{iter}
+		'''
+		iter = iter.__iter__()
+		while True:
+			with self.timer(name):
+				try:
+					item = iter.next()
+				except StopIteration:
+					return
+			yield item
+
+	def signal_timer(self, signal, handler):
+		'''Timer for signal handlers, used by L{SignalEmitter.emit()}
+		when set as its C{_signal_timer} attribute.
+		@param signal: the signal name
+		@param handler: the signal handler
+		@returns: a context manager
+		'''
+		try:
+			name = '%s.%s' % (handler.im_self.__class__.__name__, handler.__name__)
+		except AttributeError:
+			name = getattr(handler, '__name__', repr(handler))
+		return self.timer('%s/%s' % (signal, name))
+
+	def as_dict(self):
+		'''Returns the statistics as a dict with the following keys:
+			- C{seconds}: total wall time of the update
+			- C{pages}: number of pages updated
+			- C{pages_per_second}: pages per second
+			- C{timers}: dict that maps timer names to a dict with the
+			keys C{calls} and C{seconds}
+		'''
+		seconds = (self.stop_time or time.time()) - self.start_time
+		pages = self.timers.get('pages.update_page', (0, 0))[0]
+		return {
+			'seconds': seconds,
+			'pages': pages,
+			'pages_per_second': pages / seconds if seconds > 0 else 0.0,
+			'timers': dict(
+				(name, {'calls': calls, 'seconds': s})
+					for name, (calls, s) in self.timers.items()
+			),
+		}
+
+	def format(self):
+		'''Returns the statistics as a table in a string'''
+		stats = self.as_dict()
+		lines = [
+			'Updated %i pages in %.2f seconds (%.1f pages/sec)' % (
+				stats['pages'], stats['seconds'], stats['pages_per_second']),
+			'',
+			'%-60s %8s %10s' % ('Timer', 'Calls', 'Seconds'),
+		]
+		for name, timer in sorted(
+			stats['timers'].items(),
+			key=lambda i: i[1]['seconds'], reverse=True
+		):
+			lines.append('%-60s %8i %10.3f' % (name, timer['calls'], timer['seconds']))
+		return '\n'.join(lines)
+
+
+class _Timer(object):
+
+	__slots__ = ('stats', 'name', 'start')
+
+	def __init__(self, stats, name):
+		self.stats = stats
+		self.name = name
+
+	def __enter__(self):
+		self.stats._stack.append(0.0)
+		self.start = time.time()
+
+	def __exit__(self, *exc_info):
+		elapsed = time.time() - self.start
+		nested = self.stats._stack.pop()
+		self.stats._add(self.name, elapsed - nested)
+		if self.stats._stack:
+			self.stats._stack[-1] += elapsed
@@ -60,9 +60,9 @@ class TagsIndexer(IndexerBase):
 		self.connectto_all(pagesindexer, (
 			'page-changed', 'page-row-deleted'
 		))
-		self.connectto(filesindexer,
-			'finish-update'
-		)
+		self.connectto_all(filesindexer, (
+			'start-update', 'finish-update'
+		))
 
 		self.db.executescript('''
 			CREATE TABLE IF NOT EXISTS tags (
@@ -78,8 +78,31 @@ class TagsIndexer(IndexerBase):
 
 				CONSTRAINT uc_TagSourceOnce UNIQUE (source, tag)
 			);
+			CREATE INDEX IF NOT EXISTS tags_sortkey ON tags(sortkey, name);
+			CREATE INDEX IF NOT EXISTS tagsources_tag ON tagsources(tag, source);
 		''')
 
+		self._tagrows = {} # sortkey -> tag row, cached for one update
+		self._orphans = set() # ids of tags that may have lost all sources
+		self._full_cleanup = True # orphans of an interrupted update
+
+	def on_start_update(self, filesindexer):
+		self._tagrows.clear()
+
+	def _lookup_tags(self, sortkeys):
+		# Resolve a set of sortkeys with a single query, rows are kept
+		# till the end of the update, so tags that are used by many
+		# pages are looked up only once
+		todo = [k for k in sortkeys if k not in self._tagrows]
+		for i in range(0, len(todo), 500): # stay below the max number of sql variables
+			chunk = todo[i:i+500]
+			for row in self.db.execute(
+				'SELECT sortkey, name, id FROM tags WHERE sortkey IN (%s)'
+					% ','.join('?' * len(chunk)),
+				chunk
+			):
+				self._tagrows[row['sortkey']] = row
+
 	def on_page_changed(self, pagesindexer, pagerow, doc):
 		oldtags = dict(
 			(r[0], r) for r in self.db.execute(
@@ -90,6 +113,7 @@ class TagsIndexer(IndexerBase):
 			)
 		)
 
+		newtags = [] # list of (sortkey, name) in order of the page
 		seen = set()
 		for name in doc.iter_tag_names():
 			sortkey = natural_sort_key(name)
@@ -99,50 +123,76 @@ class TagsIndexer(IndexerBase):
 				oldtags.pop(sortkey)
 			else:
 				seen.add(sortkey)
-				row = self.db.execute(
-					'SELECT name, id FROM tags WHERE sortkey=?', (sortkey,)
-				).fetchone()
-				if not row:
-					# Create new tag
-					self.db.execute(
-						'INSERT INTO tags(name, sortkey) VALUES (?, ?)',
-						(name, sortkey)
-					)
-					row = self.db.execute(
-						'SELECT name, id FROM tags WHERE sortkey=?', (sortkey,)
-					).fetchone()
-					assert row
-					self.emit('tag-row-inserted', row)
-
-				self.db.execute(
-					'INSERT INTO tagsources(source, tag) VALUES (?, ?)',
-					(pagerow['id'], row['id'])
+				newtags.append((sortkey, name))
+
+		if newtags:
+			self._lookup_tags(seen)
+			missing = [(n, k) for k, n in newtags if k not in self._tagrows]
+			if missing:
+				# Create new tags
+				self.db.executemany(
+					'INSERT INTO tags(name, sortkey) VALUES (?, ?)',
+					missing
 				)
+				self._lookup_tags(k for n, k in missing)
+				for n, k in missing:
+					self.emit('tag-row-inserted', self._tagrows[k])
+
+			rows = [self._tagrows[k] for k, n in newtags]
+			self.db.executemany(
+				'INSERT INTO tagsources(source, tag) VALUES (?, ?)',
+				[(pagerow['id'], row['id']) for row in rows]
+			)
+			for row in rows:
 				self.emit('tag-added-to-page', row, pagerow)
 
-		for row in oldtags.values():
-			self.emit('tag-removed-from-page', row, pagerow)
-			self.db.execute(
+		if oldtags:
+			for row in oldtags.values():
+				self.emit('tag-removed-from-page', row, pagerow)
+			self.db.executemany(
 				'DELETE FROM tagsources WHERE source=? and tag=?',
-				(pagerow['id'], row['id'])
+				[(pagerow['id'], row['id']) for row in oldtags.values()]
 			)
+			self._orphans.update(row['id'] for row in oldtags.values())
 
 	def on_page_row_deleted(self, pageindexer, row):
+		self._orphans.update(r[0] for r in self.db.execute(
+			'SELECT tag FROM tagsources WHERE source=?',
+			(row['id'],)
+		))
 		self.db.execute(
 			'DELETE FROM tagsources WHERE source=?',
 			(row['id'],)
 		)
 
 	def on_finish_update(self, filesindexer):
-		for r in self.db.execute(
-			'SELECT tags.name, tags.id FROM tags '
-			'WHERE id not in (SELECT DISTINCT tag FROM tagsources)'
-		):
+		self._tagrows.clear()
+		if self._full_cleanup:
+			orphans = self.db.execute(
+				'SELECT tags.name, tags.id FROM tags '
+				'WHERE id not in (SELECT DISTINCT tag FROM tagsources)'
+			).fetchall()
+			self._full_cleanup = False
+		else:
+			# Only check tags that lost a source during this update,
+			# using the index on tagsources(tag)
+			orphans = []
+			for id in sorted(self._orphans):
+				row = self.db.execute(
+					'SELECT name, id FROM tags WHERE id=? AND NOT EXISTS '
+					'(SELECT 1 FROM tagsources WHERE tag=?)',
+					(id, id)
+				).fetchone()
+				if row:
+					orphans.append(row)
+		self._orphans.clear()
+
+		for r in orphans:
 			self.emit('tag-row-deleted', r)
 
-		self.db.execute(
-			'DELETE FROM tags '
-			'WHERE id not in (SELECT DISTINCT tag FROM tagsources)'
+		self.db.executemany(
+			'DELETE FROM tags WHERE id=?',
+			[(r['id'],) for r in orphans]
 		)
 
 
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Jaap Karssenberg <jaap.karssenberg@gmail.com>
+
+'''This module defines a trigram index, used to look up pages by
+substrings of words in the page name or the page content. This allows
+searching for e.g. "*foo*" without matching the name or the content of
+each page against a regex.
+'''
+
+from __future__ import with_statement
+
+from .base import IndexerBase, IndexView
+from .pages import PageIndexRecord
+from .content import split_words
+
+
+MIN_LENGTH = 3 #: words and substrings shorter than this are not indexed
+
+MAX_TRIGRAMS = 50 #: max number of trigrams used to look up a substring
+
+_chunk = 200 # stay below the max number of sql variables
+
+
+def _trigrams(word):
+	return set(word[i:i+3] for i in range(len(word) - 2))
+
+
+def _substrings(text):
+	# Split a search string in lower case parts that can be looked up
+	words = [w for w in split_words(text) if len(w) >= MIN_LENGTH]
+	if not words:
+		raise ValueError, 'No substrings to look up in: %s' % text
+	return words
+
+
+class TrigramsIndexer(IndexerBase):
+	'''Indexer for substrings of words in page names and page content.
+
+	All words are kept in the "words" table, with a row in the
+	"trigrams" table for each sequence of three characters in the word.
+	Words in page names are linked to pages in the "namewords" table,
+	for words in the page content the full text index is used. Words
+	are not removed when pages change, at worst a lookup gives some
+	pages that do not match.
+	'''
+
+	def __init__(self, db, pagesindexer, filesindexer, fulltext=False):
+		'''Constructor
+		@param db: the database connection
+		@param pagesindexer: the L{PagesIndexer}
+		@param filesindexer: the L{FilesIndexer}
+		@param fulltext: if C{True} also index words in the page
+		content, only useful when the "fulltext" table exists
+		'''
+		IndexerBase.__init__(self, db)
+		self.connectto_all(pagesindexer, (
+			'page-row-inserted', 'page-row-deleted'
+		))
+		if fulltext:
+			self.connectto(pagesindexer, 'page-changed')
+		self.connectto(filesindexer, 'finish-update')
+
+		self.db.executescript('''
+			CREATE TABLE IF NOT EXISTS words (
+				id INTEGER PRIMARY KEY,
+				word TEXT,
+
+				CONSTRAINT uc_WordOnce UNIQUE (word)
+			);
+			CREATE TABLE IF NOT EXISTS trigrams (
+				trigram TEXT,
+				word INTEGER REFERENCES words(id),
+
+				CONSTRAINT uc_TrigramOnce UNIQUE (trigram, word)
+			);
+			CREATE TABLE IF NOT EXISTS namewords (
+				word INTEGER REFERENCES words(id),
+				page INTEGER REFERENCES pages(id),
+
+				CONSTRAINT uc_NameWordOnce UNIQUE (word, page)
+			);
+			CREATE INDEX IF NOT EXISTS namewords_page ON namewords(page);
+		''')
+
+		self._wordids = {} # word -> id, cached for one update
+
+	def on_finish_update(self, filesindexer):
+		self._wordids.clear()
+
+	def _lookup_words(self, words):
+		# Returns ids for a set of words, inserts the ones that are new
+		todo = [w for w in words if w not in self._wordids]
+		for i in range(0, len(todo), _chunk):
+			chunk = todo[i:i+_chunk]
+			for row in self.db.execute(
+				'SELECT word, id FROM words WHERE word IN (%s)'
+					% ','.join('?' * len(chunk)),
+				chunk
+			):
+				self._wordids[row['word']] = row['id']
+
+		for word in todo:
+			if not word in self._wordids:
+				c = self.db.execute('INSERT INTO words(word) VALUES (?)', (word,))
+				self._wordids[word] = c.lastrowid
+				self.db.executemany(
+					'INSERT INTO trigrams(trigram, word) VALUES (?, ?)',
+					[(t, c.lastrowid) for t in _trigrams(word)]
+				)
+
+		return [self._wordids[w] for w in words]
+
+	def _split(self, text):
+		return set(w for w in split_words(text) if len(w) >= MIN_LENGTH)
+
+	def on_page_row_inserted(self, o, row):
+		ids = self._lookup_words(self._split(row['name']))
+		self.db.executemany(
+			'INSERT OR IGNORE INTO namewords(word, page) VALUES (?, ?)',
+			[(id, row['id']) for id in ids]
+		)
+
+	def on_page_row_deleted(self, o, row):
+		self.db.execute('DELETE FROM namewords WHERE page = ?', (row['id'],))
+
+	def on_page_changed(self, o, row, doc):
+		words = set()
+		for text in doc.iter_text():
+			words.update(self._split(text))
+		self._lookup_words(words)
+
+
+class TrigramsView(IndexView):
+	'''Index view for the trigram index
+
+	Lookups are case insensitive and give all pages that contain the
+	given text, but may give more pages, the order of words and the
+	characters in between them are not checked. Only words of at least
+	3 characters are used, the methods raise C{ValueError} if the text
+	has none.
+	'''
+
+	def is_available(self):
+		'''Returns C{True} if the index has a trigram table'''
+		row = self.db.execute(
+			'SELECT 1 FROM sqlite_master WHERE name = ?', ('trigrams',)
+		).fetchone()
+		return row is not None
+
+	def list_words(self, substring):
+		'''List words in the index that contain a substring
+		@param substring: a lower case string of at least 3 characters
+		@returns: yields words
+		'''
+		for row in self._select_words(substring):
+			yield row['word']
+
+	def _select_words(self, substring):
+		trigrams = sorted(_trigrams(substring))[:MAX_TRIGRAMS]
+		for row in self.db.execute(
+			'SELECT words.id, words.word FROM trigrams '
+			'JOIN words ON trigrams.word = words.id '
+			'WHERE trigrams.trigram IN (%s) '
+			'GROUP BY trigrams.word HAVING COUNT(*) = ?'
+				% ','.join('?' * len(trigrams)),
+			trigrams + [len(trigrams)]
+		):
+			if substring in row['word']:
+				yield row
+
+	def list_pages_by_name(self, text):
+		'''List pages with a name that contains C{text}
+		@param text: a string
+		@returns: yields L{PageIndexRecord} objects
+		@raises ValueError: if C{text} has no words to look up
+		'''
+		rows = None
+		for substring in _substrings(text):
+			ids = [r['id'] for r in self._select_words(substring)]
+			myrows = {}
+			for i in range(0, len(ids), _chunk):
+				chunk = ids[i:i+_chunk]
+				for row in self.db.execute(
+					'SELECT pages.* FROM namewords '
+					'JOIN pages ON namewords.page = pages.id '
+					'WHERE namewords.word IN (%s)'
+						% ','.join('?' * len(chunk)),
+					chunk
+				):
+					myrows[row['id']] = row
+			rows = self._intersect(rows, myrows)
+
+		for row in rows.values():
+			yield PageIndexRecord(row)
+
+	def list_pages_by_content(self, text):
+		'''List pages with content that contains C{text}, requires
+		the full text index
+		@param text: a string
+		@returns: yields L{PageIndexRecord} objects
+		@raises ValueError: if C{text} has no words to look up
+		'''
+		rows = None
+		for substring in _substrings(text):
+			words = list(self.list_words(substring))
+			myrows = {}
+			for i in range(0, len(words), _chunk):
+				query = ' OR '.join(words[i:i+_chunk])
+				for row in self.db.execute(
+					'SELECT pages.* FROM fulltext '
+					'JOIN pages ON fulltext.rowid = pages.id '
+					'WHERE fulltext MATCH ?',
+					(query,)
+				):
+					myrows[row['id']] = row
+			rows = self._intersect(rows, myrows)
+
+		for row in rows.values():
+			yield PageIndexRecord(row)
+
+	@staticmethod
+	def _intersect(rows, myrows):
+		if rows is None:
+			return myrows
+		else:
+			return dict((k, v) for k, v in rows.items() if k in myrows)
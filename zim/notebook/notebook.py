@@ -249,6 +249,36 @@ class Notebook(ConnectorMixin, SignalEmitter):
 		_NOTEBOOK_CACHE[dir.uri] = nb
 		return nb
 
+	@classmethod
+	def new_from_snapshot(klass, dir, snapshot):
+		'''Constructor to create a read-only notebook that uses an
+		index snapshot instead of the index database. This avoids
+		creating a cache folder and checking the index, which makes
+		it suitable for serving a notebook that does not change,
+		e.g. from a cgi-bin script.
+		See L{zim.notebook.index.snapshot} for details.
+
+		@param dir: a L{Dir} object
+		@param snapshot: a L{File} object for the snapshot
+		@returns: a L{Notebook} object
+		@raises SnapshotError: if the snapshot is not valid
+		'''
+		assert isinstance(dir, Dir)
+
+		from .index.snapshot import SnapshotIndex
+		from .layout import FilesLayout
+
+		config = NotebookConfig(dir.file('notebook.zim'))
+		endofline = config['Notebook']['endofline']
+
+		folder = LocalFolder(dir.path)
+		layout = FilesLayout(folder, endofline)
+		index = SnapshotIndex(snapshot.path, layout)
+
+		nb = klass(dir, None, config, folder, layout, index)
+		nb.readonly = True
+		return nb
+
 	def __init__(self, dir, cache_dir, config, folder, layout, index):
 		self.dir = dir # TODO remove
 		self.folder = folder
@@ -272,10 +302,11 @@ class Notebook(ConnectorMixin, SignalEmitter):
 		self.icon = None
 		self.document_root = None
 
-		from .index import PagesView, LinksView, TagsView
+		from .index import PagesView, LinksView, TagsView, ContentView
 		self.pages = PagesView.new_from_index(self.index)
 		self.links = LinksView.new_from_index(self.index)
 		self.tags = TagsView.new_from_index(self.index)
+		self.content = ContentView.new_from_index(self.index)
 
 		def on_page_row_changed(o, row):
 			if row['name'] in self._page_cache:
@@ -287,8 +318,9 @@ class Notebook(ConnectorMixin, SignalEmitter):
 				self._page_cache[row['name']].haschildren = False
 				self.emit('page-info-changed', self._page_cache[row['name']])
 
-		self.index.update_iter.pages.connect('page-row-changed', on_page_row_changed)
-		self.index.update_iter.pages.connect('page-row-deleted', on_page_row_deleted)
+		if self.index.update_iter is not None: # not for a snapshot
+			self.index.update_iter.pages.connect('page-row-changed', on_page_row_changed)
+			self.index.update_iter.pages.connect('page-row-deleted', on_page_row_deleted)
 
 		self.do_properties_changed()
 
@@ -424,6 +456,19 @@ class Notebook(ConnectorMixin, SignalEmitter):
 			self._page_cache[path.name] = page
 			return page
 
+	def get_cached_page(self, path):
+		'''Get a L{Page} object only if it is already loaded, e.g.
+		because it is open in the interface. Such a page can have
+		content that is not yet stored.
+		@param path: a L{Path} object
+		@returns: a L{Page} object or C{None}
+		'''
+		page = self._page_cache.get(path.name)
+		if page is not None and page.valid:
+			return page
+		else:
+			return None
+
 	def get_new_page(self, path):
 		'''Like get_page() but guarantees the page does not yet exist
 		by adding a number to the name to make it unique.
@@ -96,13 +96,14 @@ class NotebookExtension(ObjectExtension):
 		self._parser_key = self._get_parser_key()
 
 		self.index = notebook.index
-		if self.index.get_property(TasksIndexer.PLUGIN_NAME) != TasksIndexer.PLUGIN_DB_FORMAT:
-			with self.index.lock:
-				self.index._db.executescript(TasksIndexer.TEARDOWN_SCRIPT) # XXX
-				self.index.flag_reindex()
-
 		self.indexer = TasksIndexer.new_from_index(self.index, plugin.preferences)
 		self.connectto(plugin.preferences, 'changed', self.on_preferences_changed)
+		self.connectto(self.index, 'new-update-iter', self.on_new_update_iter)
+
+	def on_new_update_iter(self, index, update_iter):
+		# Index was flushed, tasks are indexed again with the pages
+		self.indexer.disconnect_all()
+		self.indexer = TasksIndexer.new_from_index(self.index, self.plugin.preferences)
 
 	def on_preferences_changed(self, preferences):
 		# Need to construct new parser, re-index pages
@@ -121,9 +122,7 @@ class NotebookExtension(ObjectExtension):
 
 	def teardown(self):
 		self.indexer.disconnect_all()
-		with self.index.lock:
-			self.index._db.executescript(TasksIndexer.TEARDOWN_SCRIPT) # XXX
-			self.index.set_property(TasksIndexer.PLUGIN_NAME, None)
+		self.index.drop_plugin_db(TasksIndexer.PLUGIN_NAME)
 
 
 @extends('MainWindow')
@@ -59,14 +59,15 @@ def _task_labels_re(labels):
 
 class TasksIndexer(IndexerBase):
 	'''Indexer that gets added to the L{Index} to keep track of tasks
-	in the database
+	in the database. The "tasklist" table is kept in a separate
+	database, see L{Index.attach_plugin_db()}.
 	'''
 
 	PLUGIN_NAME = "tasklist"
 	PLUGIN_DB_FORMAT = "0.8"
 
 	INIT_SCRIPT = '''
-		CREATE TABLE IF NOT EXISTS tasklist (
+		CREATE TABLE IF NOT EXISTS %(schema)s.tasklist (
 			id INTEGER PRIMARY KEY,
 			source INTEGER,
 			parent INTEGER,
@@ -79,13 +80,9 @@ class TasksIndexer(IndexerBase):
 			tags TEXT,
 			description TEXT
 		);
-		INSERT OR REPLACE INTO zim_index VALUES (%r, %r);
-	''' % (PLUGIN_NAME, PLUGIN_DB_FORMAT)
-
-	TEARDOWN_SCRIPT = '''
-		DROP TABLE IF EXISTS "tasklist";
-		DELETE FROM zim_index WHERE key = %r;
-	''' % PLUGIN_NAME
+		CREATE INDEX IF NOT EXISTS %(schema)s.tasklist_source ON tasklist(source);
+		CREATE INDEX IF NOT EXISTS %(schema)s.tasklist_parent ON tasklist(parent, open);
+	'''
 
 	__signals__ = {
 		'tasklist-changed': (None, None, ()),
@@ -93,11 +90,12 @@ class TasksIndexer(IndexerBase):
 
 	@classmethod
 	def new_from_index(cls, index, preferences):
+		schema = index.attach_plugin_db(cls.PLUGIN_NAME, cls.PLUGIN_DB_FORMAT)
 		db = index._db
 		pagesindexer = index.update_iter.pages
-		return cls(db, pagesindexer, preferences)
+		return cls(db, pagesindexer, preferences, schema)
 
-	def __init__(self, db, pagesindexer, preferences):
+	def __init__(self, db, pagesindexer, preferences, schema='main'):
 		IndexerBase.__init__(self, db)
 
 		self.parser = TaskParser(
@@ -115,7 +113,7 @@ class TasksIndexer(IndexerBase):
 			[n.strip() for n in preferences['excluded_subtrees'].split()] \
 				if preferences['excluded_subtrees'] else None
 
-		self.db.executescript(self.INIT_SCRIPT)
+		self.db.executescript(self.INIT_SCRIPT % {'schema': schema})
 
 		self.connectto_all(pagesindexer, (
 			'page-changed', 'page-row-deleted'
@@ -46,11 +46,22 @@ For content '*' can occur on both sides, but does not match whitespace
 
 import re
 import logging
+import threading
+import weakref
+import multiprocessing
+
+from itertools import islice
 
 from zim.parsing import split_quoted_strings, unescape_quoted_string, Re
+from zim.formats import get_format
+from zim.newfs import LocalFile
+from zim.signals import ConnectorMixin
+from zim.utils import OrderedDict
 from zim.notebook import Path, \
 	PageNotFoundError, IndexNotFoundError, \
 	LINK_DIR_BACKWARD, LINK_DIR_FORWARD
+from zim.notebook.index import TrigramsView, split_words
+from zim.notebook.index.trigrams import MIN_LENGTH as MIN_SUBSTRING_LENGTH
 
 
 logger = logging.getLogger('zim.search')
@@ -75,6 +86,17 @@ KEYWORDS = (
 	'links', 'linksfrom', 'linksto', 'tag'
 )
 
+# Cost classes used by the query planner, in order of increasing cost
+COST_INDEX = 1 # term is looked up in the index
+COST_NAMES = 2 # term is matched against page names
+COST_CONTENT = 3 # term needs the page content
+
+_cost_labels = {
+	COST_INDEX: 'index',
+	COST_NAMES: 'names',
+	COST_CONTENT: 'content',
+}
+
 keyword_re = Re('('+'|'.join(KEYWORDS)+'):(.*)', re.I)
 operators_re = Re(r'^(\|\||\&\&|\+|\-)')
 tag_re = Re(r'^\@(\w+)$', re.U)
@@ -210,6 +232,114 @@ class Query(object):
 			return None
 
 
+class QueryPlan(object):
+	'''Order in which the terms of a L{QueryGroup} are processed, made
+	by L{SearchSelection.plan()}. Terms that can be answered from the
+	index come first, sub-groups next and content terms last. Within an
+	AND group the terms are sorted by cost and by the estimated number
+	of results, so each term narrows the scope for the next ones and
+	the content is only parsed for the smallest set of pages. Within an
+	OR group all terms need to be processed anyway, so the order of the
+	query is kept.
+
+	The plan, and the estimated cost and number of results of each
+	term and sub-group, are attributes of the objects:
+		- C{cost}: one of C{COST_INDEX}, C{COST_NAMES} or C{COST_CONTENT}
+		- C{estimate}: the estimated number of pages, or C{None} if
+		this can not be estimated up front
+
+	@ivar group: the L{QueryGroup}
+	@ivar operator: the operator of the group
+	@ivar indexterms: list of L{QueryTerm} objects answered from the index
+	@ivar subgroups: list of L{QueryPlan} objects for sub-groups
+	@ivar contentterms: list of L{QueryTerm} objects that need content
+	'''
+
+	def __init__(self, group, indexterms, subgroups, contentterms):
+		self.group = group
+		self.operator = group.operator
+		self.indexterms = indexterms
+		self.subgroups = subgroups
+		self.contentterms = contentterms
+
+		steps = indexterms + subgroups + contentterms
+		self.cost = max(s.cost for s in steps) if steps else COST_INDEX
+		estimates = [s.estimate for s in steps if not getattr(s, 'inverse', False)]
+		if self.operator == OPERATOR_AND:
+			known = [e for e in estimates if e is not None]
+			self.estimate = min(known) if known else None
+		elif estimates and None not in estimates:
+			self.estimate = sum(estimates)
+		else:
+			self.estimate = None
+
+	def format(self, indent=0):
+		'''Format the plan as text, used for debugging
+		@param indent: indent level for nested groups
+		@returns: a string with one line per step
+		'''
+		prefix = '\t' * indent
+		op = 'AND' if self.operator == OPERATOR_AND else 'OR'
+		lines = [prefix + '%s %s' % (op, _format_estimate(self))]
+		for term in self.indexterms:
+			lines.append(prefix + '\t' + _format_term(term))
+		for plan in self.subgroups:
+			lines.append(plan.format(indent + 1))
+		for term in self.contentterms:
+			lines.append(prefix + '\t' + _format_term(term))
+		return '\n'.join(lines)
+
+
+def _format_term(term):
+	string = '%s%s: %s' % ('NOT ' if term.inverse else '', term.keyword, term.string)
+	return '%s %s' % (string, _format_estimate(term))
+
+
+def _format_estimate(step):
+	if step.estimate is None:
+		return '[%s]' % _cost_labels[step.cost]
+	else:
+		return '[%s, ~%i pages]' % (_cost_labels[step.cost], step.estimate)
+
+
+def _iter_terms(group):
+	# Yields all terms in a group, recursing in sub-groups
+	for term in group:
+		if isinstance(term, QueryGroup):
+			for t in _iter_terms(term):
+				yield t
+		else:
+			yield term
+
+
+def _is_local(group):
+	# Returns True if the results for a page only depend on the page
+	# itself, this is not the case for link keywords
+	return not any(
+		t.keyword in ('linksfrom', 'linksto') for t in _iter_terms(group))
+
+
+class ResultPath(Path):
+	'''Path in the results of a search, with data to show why the
+	page matched. See L{SearchSelection.ranked_results()}.
+
+	@ivar score: the score of the page, see L{SearchSelection.scores}
+	@ivar relevance: the BM25 relevance of the page content for the
+	content terms of the query, higher is better, C{0.0} if the page
+	content does not match or the full text index is not available
+	@ivar snippet: a piece of the page content with the words that
+	matched marked, or C{None}
+	'''
+
+	__slots__ = ('score', 'relevance', 'snippet')
+
+	def __init__(self, name, score=0, relevance=0.0, snippet=None):
+		Path.__init__(self, name)
+		self.score = score
+		self.relevance = relevance
+		self.snippet = snippet
+
+
 class PageSelection(set):
 	'''This class is just a container of path objects'''
 
@@ -223,11 +353,30 @@ class SearchSelection(PageSelection):
 	they match the query.
 	'''
 
-	def __init__(self, notebook):
+	parallel_min_pages = 50 #: min number of pages to scan for using worker processes
+
+	def __init__(self, notebook, cache=None, processes=1, ordered=False):
+		'''Constructor
+		@param notebook: a L{Notebook}
+		@param cache: a L{SearchCache} to re-use results of previous
+		searches, see L{get_search_cache()}
+		@param processes: number of worker processes used to scan the
+		content of pages, C{None} means the number of CPUs. Only used
+		when at least C{parallel_min_pages} pages need to be scanned,
+		see L{ContentScanPool}.
+		@param ordered: if C{True} results from the worker processes
+		are passed to the callback in a fixed order, so repeated
+		searches give the same order, e.g. for paging. Else they are
+		passed on in the order the worker processes are done.
+		'''
 		self.notebook = notebook
+		self.cache = cache
+		self.processes = processes
+		self.ordered = ordered
 		self.cancelled = False
 		self.query = None
 		self.scores = {}
+		self._pool = None
 
 	def search(self, query, selection=None, callback=None):
 		'''Populate this SearchSelection with results for a query.
@@ -252,43 +401,250 @@ class SearchSelection(PageSelection):
 		self.clear()
 		self.scores = {}
 
-		# Actual search
-		self.update(self._process_group(query.root, selection, callback))
+		entry = None
+		if self.cache is not None and selection is None:
+			entry = self.cache.get(query.string)
+			if entry is not None and entry.results is None:
+				entry = None # previous search did not finish
+
+		try:
+			if entry is not None:
+				# Re-use cached results, only search pages that changed
+				self.update(entry.results)
+				self.scores = dict(entry.scores)
+				changed = self.cache.pop_changed(entry)
+				if changed:
+					self._search_changed(query, changed, callback)
+			else:
+				if self.cache is not None and selection is None:
+					entry = self.cache.add(query.string, _is_local(query.root))
+
+				# Actual search
+				plan = self.plan(query)
+				if logger.isEnabledFor(logging.DEBUG):
+					logger.debug('Search plan for "%s":\n%s', query.string, plan.format())
+				self.update(self._process_group(plan, selection, callback))
+		finally:
+			# Worker processes are shared by all content terms of the
+			# query, stop them once the search is done
+			if self._pool is not None:
+				self._pool.close()
+				self._pool = None
 
 		# Clean up results
 		scored = set(self.scores.keys())
 		for path in scored - self:
 			self.scores.pop(path)
 
-	def _process_group(self, group, scope=None, callback=None):
-		# This method processes all search terms in a QueryGroup
-		# it is recursive for nested QueryGroup objects and calls
-		# _process_from_index and _process_content to handle
-		# QueryTerms in the group. It takes care of combining the
-		# results from various terms and calling the callback
-		# function when possible
+		if entry is not None:
+			if self.cancelled:
+				self.cache.remove(query.string)
+			else:
+				entry.results = frozenset(self)
+				entry.scores = dict(self.scores)
+
+	def ranked_results(self, markers=('[', ']'), tokens=10):
+		'''Get the results ordered by relevance, with a snippet of
+		the content for each page. Relevance and snippets come from the
+		full text index, pages are not parsed, so this is cheap even for
+		many results. Results with the same relevance, e.g. results that
+		only matched on page name or tags, are ordered by score.
+		@param markers: a 2-tuple with the strings to put before and
+		after matching words in the snippets
+		@param tokens: the max number of words in a snippet
+		@returns: a list of L{ResultPath} objects
+		'''
+		relevance = self.lookup_relevance(self.query, markers, tokens)
+		results = [
+			ResultPath(p.name, self.scores.get(p, 0),
+				*relevance.get(p.name, (0.0, None)))
+					for p in self
+		]
+		results.sort(key=lambda p: (-p.relevance, -p.score, p.name))
+		return results
 
+	def lookup_relevance(self, query, markers=('[', ']'), tokens=10):
+		'''Look up the relevance and a snippet for all pages that
+		match the content terms of a query in the full text index. This
+		does not depend on the search results, so it can be done before
+		searching, e.g. to show them while the search is running.
+		@param query: a L{Query} object
+		@param markers: a 2-tuple with the strings to put before and
+		after matching words in the snippets
+		@param tokens: the max number of words in a snippet
+		@returns: a dict mapping page names to 2-tuples of the
+		relevance and the snippet
+		'''
+		words = self._relevance_words(query)
+		if not words:
+			return {}
+
+		return dict(
+			(path.name, (relevance, snippet))
+				for path, relevance, snippet
+					in self.notebook.content.list_ranked(words, markers, tokens)
+		)
+
+	def _relevance_words(self, query):
+		# Words for the full text index from all positive content terms
+		if query is None or not self.notebook.content.is_available():
+			return []
+
+		trigrams = None
+		words = []
+		for term in _iter_terms(query.root):
+			if term.inverse or not term.keyword in ('content', 'contentorname'):
+				continue
+			elif term.string.startswith('*'):
+				# Use the trigram index to find words with the substring
+				if trigrams is None:
+					trigrams = TrigramsView.new_from_index(self.notebook.index)
+				if trigrams.is_available():
+					for word in split_words(term.string):
+						if len(word) >= MIN_SUBSTRING_LENGTH:
+							words.extend(islice(trigrams.list_words(word), 50))
+			else:
+				string, wildcard, x = term.string.partition('*')
+				mywords = split_words(string)
+				if mywords and wildcard:
+					mywords[-1] += '*'
+				words.extend(mywords)
+		return words
+
+	def _search_changed(self, query, names, callback):
+		# Update cached results for a set of pages that changed, only
+		# valid for queries where the result for a page only depends
+		# on the page itself
+		scope = set()
+		for name in names:
+			path = Path(name)
+			self.discard(path)
+			self.scores.pop(path, None)
+			try:
+				scope.add(self.notebook.pages.lookup_by_pagename(path))
+			except IndexNotFoundError:
+				pass # page was deleted
+
+		if scope:
+			plan = self.plan(query)
+			self.update(self._process_group(plan, scope, callback))
+
+	def plan(self, query):
+		'''Make a plan for processing a query, see L{QueryPlan}. The
+		estimates are based on index lookups, which are much cheaper
+		than reading pages. The results of these lookups are kept in
+		the terms and re-used when processing the query.
+		@param query: a L{Query} object
+		@returns: a L{QueryPlan} object for the root of the query
+		'''
+		return self._plan_group(query.root)
+
+	def explain(self, query):
+		'''Explain how a query will be processed
+		@param query: a L{Query} object or a query string
+		@returns: a string describing the plan
+		'''
+		if not isinstance(query, Query):
+			query = Query(query)
+		return self.plan(query).format()
+
+	def _plan_group(self, group):
 		# Special case to optimize for simple OR query to give callback results
 		if len(group) == 1 and isinstance(group[0], QueryGroup):
 			group = group[0]
 
-		# For optimization we sort the terms in the group based  on how
-		# easy we can get them. Anything that needs content is last.
 		indexterms = []
 		subgroups = []
 		contentterms = []
 		for term in group:
 			if isinstance(term, QueryGroup):
-				subgroups.append(term)
+				subgroups.append(self._plan_group(term))
 			else:
 				assert isinstance(term, QueryTerm)
+				self._estimate_term(term)
 				if term.keyword in ('content', 'contentorname'):
 					contentterms.append(term)
 				else:
 					indexterms.append(term)
 
-		# Decide what operator to use
 		if group.operator == OPERATOR_AND:
+			# Positive terms first, they give a scope for inverse
+			# terms, then the cheapest and most selective terms
+			total = self.notebook.pages.n_all_pages()
+			key = lambda s: (
+				getattr(s, 'inverse', False), s.cost,
+				total if s.estimate is None else s.estimate
+			)
+			indexterms.sort(key=key)
+			subgroups.sort(key=key)
+			contentterms.sort(key=key)
+
+		return QueryPlan(group, indexterms, subgroups, contentterms)
+
+	def _estimate_term(self, term):
+		# Set cost and estimated number of results for a term, also
+		# does the index lookups for names and content
+		term.cost = COST_NAMES
+		term.estimate = None
+		term.name_candidates = None
+		term.content_names = None
+
+		if term.keyword in ('tag', 'linksfrom', 'linksto'):
+			term.cost = COST_INDEX
+			try:
+				if term.keyword == 'tag':
+					term.estimate = self.notebook.tags.n_list_pages(term.string.strip('*'))
+				elif not term.string.endswith('*'):
+					dir = LINK_DIR_FORWARD if term.keyword == 'linksfrom' else LINK_DIR_BACKWARD
+					path = self.notebook.pages.lookup_from_user_input(term.string)
+					term.estimate = self.notebook.links.n_list_links(path, dir)
+			except (ValueError, IndexNotFoundError):
+				term.estimate = 0
+		elif term.keyword == 'name':
+			if not '*' in term.string:
+				term.estimate = 1
+			else:
+				term.name_candidates = self._lookup_name(term.string)
+				if term.name_candidates is not None:
+					term.estimate = len(term.name_candidates)
+		elif term.keyword in ('content', 'contentorname'):
+			term.cost = COST_CONTENT
+			if term.keyword == 'contentorname':
+				term.name_candidates = self._lookup_name('*'+term.string.strip('*')+'*')
+
+			# Use the full text index to skip pages that can not match,
+			# pages that can match are still parsed to verify the match
+			# and count the score
+			if not term.inverse and self.notebook.content.is_available():
+				term.content_names = self._lookup_content(term)
+				if term.content_names is not None:
+					term.estimate = len(term.content_names)
+					if term.keyword == 'contentorname':
+						if term.name_candidates is None:
+							term.estimate = None
+						else:
+							term.estimate += len(term.name_candidates)
+		# else namespace and section are matched against names, can
+		# not estimate without walking the pages
+
+		if term.inverse:
+			term.estimate = None
+
+	def _process_group(self, plan, scope=None, callback=None):
+		# This method processes all search terms in a QueryPlan
+		# it is recursive for nested QueryPlan objects and calls
+		# _process_from_index and _process_content to handle
+		# QueryTerms in the group. It takes care of combining the
+		# results from various terms and calling the callback
+		# function when possible
+		# The plan gives the terms in the order to process them, see
+		# QueryPlan. Anything that needs content is last.
+		indexterms = plan.indexterms
+		subgroups = plan.subgroups
+		contentterms = plan.contentterms
+
+		# Decide what operator to use
+		if plan.operator == OPERATOR_AND:
 			op_func = self._and_operator
 		else:
 			op_func = self._or_operator
@@ -300,7 +656,7 @@ class SearchSelection(PageSelection):
 				self._process_from_index(term, scope) )
 
 		if callback:
-			if group.operator == OPERATOR_AND:
+			if plan.operator == OPERATOR_AND:
 				cont = callback(None, None) # do not transmit results yet
 			else:
 				cont = callback(results, None)
@@ -322,7 +678,7 @@ class SearchSelection(PageSelection):
 				self._process_group(term, scope, callbackwrapper) )
 
 			if callback:
-				if group.operator == OPERATOR_AND:
+				if plan.operator == OPERATOR_AND:
 					cont = callback(None, None) # do not transmit results yet
 				else:
 					cont = callback(results, None)
@@ -341,7 +697,7 @@ class SearchSelection(PageSelection):
 					self._process_from_index(term, myscope, scoring=10) )
 
 		if callback and (
-			group.operator == OPERATOR_OR or
+			plan.operator == OPERATOR_OR or
 			all(term.keyword == 'contentorname' for term in contentterms)
 		):
 			cont = callback(results, None)
@@ -352,7 +708,7 @@ class SearchSelection(PageSelection):
 		# Now do the content terms all at once per page - slow or very slow
 		if contentterms:
 			results = self._process_content(
-				contentterms, results, scope, group.operator, callback)
+				contentterms, results, scope, plan.operator, callback)
 
 		# And return our results as summed by the operator
 		return results or set()
@@ -390,19 +746,28 @@ class SearchSelection(PageSelection):
 
 		if term.keyword in ('name', 'namespace', 'section', 'contentorname'):
 			scoped = True # for these keywords we use scope immediatly
-			if scope:
-				generator = iter(scope)
-			else:
-				generator = self.notebook.pages.walk()
-
+			glob = None
 			if term.keyword in ('namespace', 'section'):
 				regex = self._namespace_regex(term.string)
 			elif term.keyword == 'contentorname':
 				# More lax matching for default case
-				regex = self._name_regex('*'+term.string.strip('*')+'*')
+				glob = '*'+term.string.strip('*')+'*'
+				regex = self._name_regex(glob)
 				term.name_regex = regex # needed in _process_content
 			else:
-				regex = self._name_regex(term.string)
+				glob = term.string
+				regex = self._name_regex(glob)
+
+			candidates = term.name_candidates
+			if scope:
+				generator = iter(scope)
+				if candidates is not None:
+					names = set(p.name for p in candidates)
+					generator = (p for p in generator if p.name in names)
+			elif candidates is not None:
+				generator = iter(candidates)
+			else:
+				generator = self.notebook.pages.walk()
 
 			#~ print '!! REGEX: ' + regex.pattern
 			for path in generator:
@@ -489,38 +854,63 @@ class SearchSelection(PageSelection):
 		for term in terms:
 			term.content_regex = self._content_regex(term.string)
 			# term.name_regex already defined in _process_from_index
+			# term.content_names already defined in _estimate_term
+
+		def could_match(path, term):
+			return term.content_names is None \
+				or path.name in term.content_names \
+				or (term.keyword == 'contentorname' and term.name_regex.match(path.name))
+
+		check, candidates = None, None
+		if operator == OPERATOR_AND:
+			positive = [t for t in terms if not t.inverse]
+			if any(t.content_names is not None for t in positive):
+				check = lambda p: all(could_match(p, t) for t in positive)
+				indexed = [t.content_names for t in positive
+					if t.content_names is not None and t.keyword == 'content']
+				if indexed:
+					candidates = min(indexed, key=len)
+		else: # OPERATOR_OR
+			if all(t.content_names is not None for t in terms):
+				check = lambda p: any(could_match(p, t) for t in terms)
+				if all(t.keyword == 'content' for t in terms):
+					candidates = set()
+					for t in terms:
+						candidates |= t.content_names
 
 		if scope:
-			def page_generator():
-				for path in scope:
-					try:
-						yield self.notebook.get_page(path)
-					except PageNotFoundError:
-						pass
-			generator = page_generator()
+			paths = scope
+		elif candidates is not None:
+			paths = [Path(name) for name in sorted(candidates)]
 		else:
-			generator = map(self.notebook.get_page, self.notebook.pages.walk())
+			paths = self.notebook.pages.walk()
+
+		if check:
+			paths = (p for p in paths if check(p))
 
 		if results is None:
 			results = SearchSelection(None)
 
-		for page in generator:
-			#~ print '!! Search content', page
-			try:
-				tree = page.get_parsetree()
-			except:
-				logger.exception('Exception while reading: %s', page)
-				continue
+		pool = None
+		if self.processes != 1:
+			paths = list(paths)
+			if len(paths) >= self.parallel_min_pages:
+				if self._pool is None:
+					self._pool = ContentScanPool(self.processes)
+				pool = self._pool
 
-			if tree is None:
-				continue # Assume need to have content even for negative query
+		if pool:
+			generator = self._scan_parallel(pool, paths, terms)
+		else:
+			generator = self._scan(paths, terms)
 
-			path = Path(page.name)
+		for path, count in generator:
+			#~ print '!! Search content', path
 			if operator == OPERATOR_AND:
 				score = 0
-				for term in terms:
+				for i, term in enumerate(terms):
 					#~ print '!! Count AND %s' % term
-					myscore = tree.countre(term.content_regex)
+					myscore = count(i)
 					if term.keyword == 'contentorname' \
 					and term.name_regex.match(path.name):
 						myscore += 1 # effective score going to 11
@@ -535,9 +925,9 @@ class SearchSelection(PageSelection):
 					results.add(path)
 					self._count_score(path, score)
 			else: # OPERATOR_OR
-				for term in terms:
+				for i, term in enumerate(terms):
 					#~ print '!! Count OR %s' % term
-					score = tree.countre(term.content_regex)
+					score = count(i)
 					if term.keyword == 'contentorname' \
 					and term.name_regex.match(path.name):
 						score += 1 # effective score going to 11
@@ -553,9 +943,101 @@ class SearchSelection(PageSelection):
 				if not cont:
 					self.cancelled = True
 					break
-
 		return results
 
+	def _scan(self, paths, terms):
+		# Parse pages in this process, yields the path of each page
+		# with content and a function that gives the number of matches
+		# for the term with a given index
+		for path in paths:
+			try:
+				page = self.notebook.get_page(path)
+			except PageNotFoundError:
+				continue
+
+			try:
+				tree = page.get_parsetree()
+			except:
+				logger.exception('Exception while reading: %s', page)
+				continue
+
+			if tree is None:
+				continue # Assume need to have content even for negative query
+
+			yield Path(page.name), \
+				lambda i, tree=tree: tree.countre(terms[i].content_regex)
+
+	def _scan_parallel(self, pool, paths, terms):
+		# Like _scan() but lets the worker processes read and match the
+		# source files. Pages that are loaded in this process and have
+		# changes that are not stored, and pages that are not local
+		# files are parsed here first.
+		layout = self.notebook.layout
+		local, files = [], []
+		for path in paths:
+			file, folder = layout.map_page(path)
+			page = self.notebook.get_cached_page(path)
+			if isinstance(file, LocalFile) \
+			and not (page is not None and page.modified):
+				files.append((path, file, layout.get_format(file)))
+			else:
+				local.append(path)
+
+		for item in self._scan(local, terms):
+			yield item
+
+		regexes = [term.content_regex for term in terms]
+		for path, counts in pool.scan(files, regexes, self.ordered):
+			if counts is None:
+				# Missing file or error in the worker, parse the page
+				# here to get the same behavior as without the pool
+				for item in self._scan([path], terms):
+					yield item
+			else:
+				yield Path(path.name), counts.__getitem__
+
+	def _lookup_name(self, glob):
+		# Look up a glob for page names in the trigram index, returns a
+		# list of all pages that can match, or None if the index can not
+		# be used. Only useful for globs starting with "*", for others
+		# the regex is anchored and walking the pages is fast enough.
+		if not glob.startswith('*'):
+			return None
+
+		trigrams = TrigramsView.new_from_index(self.notebook.index)
+		if not trigrams.is_available():
+			return None
+
+		try:
+			return sorted(trigrams.list_pages_by_name(glob.strip('*')),
+				key=lambda p: p.name)
+		except ValueError:
+			return None # no substrings to look up
+
+	def _lookup_content(self, term):
+		# Look up a content term in the full text index, returns a set
+		# with names of all pages that can match, or None if the index
+		# can not be used for this term. Only the part before the first
+		# "*" is used, if it ends in part of a word that is a prefix.
+		# Terms starting with "*" are looked up in the trigram index.
+		if term.string.startswith('*'):
+			trigrams = TrigramsView.new_from_index(self.notebook.index)
+			if not trigrams.is_available():
+				return None
+
+			try:
+				return set(p.name for p in
+					trigrams.list_pages_by_content(term.string) )
+			except ValueError:
+				return None # no substrings to look up
+
+		string, wildcard, x = term.string.partition('*')
+		try:
+			return set(p.name for p in
+				self.notebook.content.list_pages(string, prefix=bool(wildcard)) )
+		except ValueError:
+			return None # no words in string
+
 	def _name_regex(self, string, case=False):
 		# Build a regex for matching a glob against a page name
 		# Don't use word delimiters here, since page names could be in
@@ -608,3 +1090,226 @@ class SearchSelection(PageSelection):
 			return re.compile(regex, re.U)
 		else:
 			return re.compile(regex, re.U | re.I)
+
+
+def _scan_files(args):
+	# Runs in the worker process - parse trees can not be pickled, and
+	# are not needed, so we only pass back the number of matches
+	id, files, regexes = args
+	results = []
+	for path, format_name in files:
+		try:
+			tree = get_format(format_name).Parser().parse(LocalFile(path).read())
+			results.append([tree.countre(regex) for regex in regexes])
+		except Exception:
+			results.append(None) # caller falls back to a normal scan
+	return id, results
+
+
+class ContentScanPool(object):
+	'''Pool of worker processes that read page source files and
+	count the matches for the content terms of a search. Used by
+	L{SearchSelection} for a full scan of many pages, e.g. when the
+	full text index can not be used for a query. The pages are divided
+	in small chunks, so results come in while the scan is running and
+	busy workers do not hold up the others.
+
+	The pool can be used for several scans, e.g. one for each group
+	in a query. L{close()} stops the workers right away, also when a
+	scan was cancelled.
+	'''
+
+	def __init__(self, processes=None):
+		'''Constructor
+		@param processes: number of worker processes, defaults to the
+		number of CPUs
+		'''
+		self.processes = processes or multiprocessing.cpu_count()
+		self._pool = multiprocessing.Pool(self.processes)
+
+	def scan(self, files, regexes, ordered=False):
+		'''Scan files in the worker processes
+		@param files: a list of 3-tuples of a key, a L{LocalFile} and
+		the format module for the file
+		@param regexes: a list of compiled regexes
+		@param ordered: if C{True} results are given in the order of
+		C{files}, else in the order the files are done
+		@returns: yields 2-tuples of the key and a list with the number
+		of matches for each regex, or C{None} if the file could not be
+		read or parsed
+		'''
+		size = max(1, min(20, len(files) // (self.processes * 4)))
+		chunks = []
+		tasks = []
+		for i in range(0, len(files), size):
+			chunk = files[i:i+size]
+			chunks.append([key for key, file, format in chunk])
+			tasks.append((len(tasks), [
+				(file.path, format.__name__.rsplit('.', 1)[-1])
+					for key, file, format in chunk
+			], regexes))
+
+		if ordered:
+			imap = self._pool.imap
+		else:
+			imap = self._pool.imap_unordered
+		for id, results in imap(_scan_files, tasks):
+			for key, counts in zip(chunks[id], results):
+				yield key, counts
+
+	def close(self):
+		'''Stop the worker processes'''
+		self._pool.terminate()
+		self._pool.join()
+
+
+class SearchCache(ConnectorMixin):
+	'''Cache for the results of L{SearchSelection.search()}, keyed by
+	the query string. The cache holds at most C{maxsize} queries, the
+	least recently used query is dropped first.
+
+	The cache follows the changes in the index. Pages that are changed
+	by the index are recorded for each cached query. Once the changes
+	are committed the C{generation} counter is increased. Since the
+	results for most keywords only depend on the page itself, the next
+	search for a cached query only checks the pages that changed. Queries
+	that use links depend on other pages as well, so they are dropped
+	when any page changes.
+
+	Typically there is one cache per notebook, see L{get_search_cache()}.
+	'''
+
+	def __init__(self, index, maxsize=20):
+		'''Constructor
+		@param index: the L{Index} object of the notebook
+		@param maxsize: the max number of queries in the cache
+		'''
+		self.index = index
+		self.maxsize = maxsize
+		self.generation = 0
+		self._entries = OrderedDict() # query string -> _CacheEntry
+		self._uncommitted = set() # page names
+		self._lock = threading.Lock()
+		self._pagesindexer = None
+		if index.update_iter is not None:
+			self.connectto_all(index, ('changed', 'new-update-iter'))
+			self._connect_pagesindexer(index.update_iter)
+
+	def _connect_pagesindexer(self, update_iter):
+		if self._pagesindexer is not None:
+			self.disconnect_from(self._pagesindexer)
+		self._pagesindexer = update_iter.pages
+		for signal in (
+			'page-row-inserted', 'page-row-changed', 'page-row-deleted'
+		):
+			self.connectto(self._pagesindexer, signal, self._on_page_row)
+		self.connectto(self._pagesindexer, 'page-changed')
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, string):
+		return string in self._entries
+
+	def get(self, string):
+		'''Get the cache entry for a query
+		@param string: the query string
+		@returns: a C{_CacheEntry} or C{None}
+		'''
+		with self._lock:
+			entry = self._entries.get(string)
+			if entry is not None:
+				del self._entries[string] # move to the end
+				self._entries[string] = entry
+			return entry
+
+	def add(self, string, local):
+		'''Add a new, empty, entry for a query. Changes are recorded
+		from the moment the entry is added, so it should be added before
+		searching.
+		@param string: the query string
+		@param local: C{True} if the results of the query for a page
+		only depend on the page itself
+		@returns: a C{_CacheEntry}
+		'''
+		with self._lock:
+			entry = _CacheEntry(local)
+			self._entries.pop(string, None)
+			self._entries[string] = entry
+			while len(self._entries) > self.maxsize:
+				del self._entries[iter(self._entries).next()]
+			return entry
+
+	def remove(self, string):
+		'''Remove the entry for a query
+		@param string: the query string
+		'''
+		with self._lock:
+			self._entries.pop(string, None)
+
+	def pop_changed(self, entry):
+		'''Get the names of the pages that changed since the last time
+		the entry was updated, and reset the entry
+		@param entry: a C{_CacheEntry}
+		@returns: a set of page names
+		'''
+		with self._lock:
+			changed, entry.changed = entry.changed, set()
+			return changed
+
+	def clear(self):
+		'''Remove all entries'''
+		with self._lock:
+			self._entries.clear()
+			self._uncommitted.clear()
+
+	def _on_page_row(self, o, row):
+		with self._lock:
+			self._uncommitted.add(row['name'])
+
+	def on_page_changed(self, o, row, doc):
+		self._on_page_row(o, row)
+
+	def on_changed(self, index):
+		with self._lock:
+			self.generation += 1
+			if not self._uncommitted:
+				return
+
+			for string, entry in self._entries.items():
+				if entry.local:
+					entry.changed.update(self._uncommitted)
+				else:
+					del self._entries[string]
+			self._uncommitted = set()
+
+	def on_new_update_iter(self, index, update_iter):
+		# Index was re-initialized, all page ids and names may change
+		self._connect_pagesindexer(update_iter)
+		with self._lock:
+			self.generation += 1
+		self.clear()
+
+
+class _CacheEntry(object):
+
+	__slots__ = ('local', 'results', 'scores', 'changed')
+
+	def __init__(self, local):
+		self.local = local
+		self.results = None # None while the search is running
+		self.scores = None
+		self.changed = set()
+
+
+_search_caches = weakref.WeakKeyDictionary()
+
+def get_search_cache(notebook):
+	'''Get the L{SearchCache} for a notebook, it is created on first
+	use and shared by all callers
+	@param notebook: a L{Notebook}
+	@returns: a L{SearchCache}
+	'''
+	if not notebook in _search_caches:
+		_search_caches[notebook] = SearchCache(notebook.index)
+	return _search_caches[notebook]
@@ -259,6 +259,7 @@ class SignalEmitter(object):
 		obj._signal_handlers = {}
 		obj._signal_blocks = {}
 		obj._signal_count = 0 # ensure signals execute in order of connecting
+		obj._signal_timer = None # optional timer for handlers, see zim.notebook.index.stats
 
 		for signal, order, closure in obj._signal_closures:
 			obj._signal_handlers[signal] = [(order, 0, closure)]
@@ -335,7 +336,11 @@ class SignalEmitter(object):
 		return_first = self.__signals__[signal][1] is not None
 		for c, i, handler in self._signal_handlers.get(signal, []):
 			try:
-				r = handler(self, *args)
+				if self._signal_timer is None:
+					r = handler(self, *args)
+				else:
+					with self._signal_timer(signal, handler):
+						r = handler(self, *args)
 			except:
 				logger.exception('Exception in signal handler for %s on %s', signal, self)
 			else:
@@ -84,10 +84,23 @@ def lookup_subclasses(module, klass):
 import locale
 import re
 import unicodedata
+import string as _string
+import base64
 
 
 _num_re = re.compile(r'\d+')
 
+# Encode sort keys with an alphabet that is in ascending ASCII order,
+# unlike standard base64. Thus the encoded keys sort the same as the
+# raw bytes, but need 4 characters per 3 bytes instead of 2 per byte.
+_sort_key_table = _string.maketrans(
+	'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/',
+	'-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+)
+
+_sort_key_cache = {}
+_SORT_KEY_CACHE_SIZE = 50000
+
 
 def natural_sort(list, key=None):
 	'''Natural sort a list in place.
@@ -127,12 +140,29 @@ def natural_sort_key(string, numeric_padding=5):
 	C{(sort_key, original_string)}. Or use either L{natural_sort()} or
 	L{natural_sorted()} instead.
 
+	Keys are cached, so calling this function repeatedly for the same
+	string is cheap. Since keys depend on the locale, the locale should
+	not change after keys are stored, e.g. in the index.
+
 	@param string: the string to format
 	@param numeric_padding: number of digits to use for padding
-	@returns: string transformed to sorting key
+	@returns: string transformed to sorting key, the key only contains
+	ASCII letters, digits, "-" and "_"
 	'''
+	try:
+		return _sort_key_cache[(string, numeric_padding)]
+	except KeyError:
+		pass
+
+	key = _natural_sort_key(string, numeric_padding)
+	if len(_sort_key_cache) >= _SORT_KEY_CACHE_SIZE:
+		_sort_key_cache.clear()
+	_sort_key_cache[(string, numeric_padding)] = key
+	return key
+
+
+def _natural_sort_key(string, numeric_padding):
 	templ = '%0' + str(numeric_padding) + 'i'
-	string.strip()
 	string = _num_re.sub(lambda m: templ % int(m.group()), string)
 	if isinstance(string, unicode):
 		string = unicodedata.normalize('NFKC', string)
@@ -141,13 +171,12 @@ def natural_sort_key(string, numeric_padding=5):
 
 	try:
 		bytestring = locale.strxfrm(string)
-			# 8-bit byte string - enode to hex -- in pyton3 check if byte data type is handled better by sqlite3 and others
+			# 8-bit byte string - encode as text for sqlite3 and others
 	except MemoryError:
 		# Known python issue :(
 		bytestring = string.encode('utf-8')
 
-	key = ''.join(["%02x" % ord(c) for c in bytestring])
-	return key
+	return base64.b64encode(bytestring).rstrip('=').translate(_sort_key_table)
 
 
 ####
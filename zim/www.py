@@ -31,6 +31,7 @@ import urllib
 
 from zim.errors import Error
 from zim.notebook import Notebook, Path, Page, encode_filename, PageNotFoundError
+from zim.notebook.index.snapshot import SnapshotIndex, TitlesView
 from zim.fs import File, Dir, FileNotFoundError
 from zim.config import data_file, ConfigManager
 from zim.plugins import PluginManager
@@ -110,7 +111,9 @@ class WWWInterface(object):
 
 	def __init__(self, notebook, config=None, template='Default'):
 		'''Constructor
-		@param notebook: a L{Notebook} object
+		@param notebook: a L{Notebook} object, this can be a read-only
+		notebook using an index snapshot, see
+		L{Notebook.new_from_snapshot()}
 		@param config: optional C{ConfigManager} object
 		@param template: html template for zim pages
 		'''
@@ -135,7 +138,13 @@ class WWWInterface(object):
 		self.dumper_factory = get_format('html').Dumper # XXX
 
 		self.plugins = PluginManager(self.config)
-		self.plugins.extend(notebook)
+		if isinstance(notebook.index, SnapshotIndex):
+			# Notebook extensions hook into index updates and editing,
+			# neither is supported for a snapshot
+			self.titles = TitlesView.new_from_index(notebook.index)
+		else:
+			self.titles = None
+			self.plugins.extend(notebook)
 		self.plugins.extend(self)
 
 		#~ self.notebook.indexer.check_and_update()
@@ -284,11 +293,15 @@ class WWWInterface(object):
 		'''
 		lines = []
 
+		title = None
+		if self.titles and page.hascontent:
+			title = self.titles.get_title(page)
+
 		context = ExportTemplateContext(
 			self.notebook,
 			self.linker_factory,
 			self.dumper_factory,
-			title=page.get_title(),
+			title=title or page.get_title(),
 			content=[page],
 			home=self.notebook.get_home_page(),
 			up=page.parent if page.parent and not page.parent.isroot else None,